@@ -5,37 +5,49 @@ import pandas as pd
 import numpy as np
 import ast
 import logging.config
+from concurrent.futures import ProcessPoolExecutor
 # .. other safe imports
-try:
-    # z test
-    from statsmodels.stats.proportion import proportions_ztest
-
-    # bayesian bootstrap and vis
-    import matplotlib.pyplot as plt
-    import seaborn as sns
-    import bayesian_bootstrap.bootstrap as bb
-    from astropy.utils import NumpyRNGContext
-
-    # progress bar
-    from tqdm import tqdm
-
-    # are these needed?
-    from scipy import stats
-    from collections import Counter
-except ImportError:
-    logging.error("Missing niche library")
-    sys.exit()
+# statsmodels, scipy, bayesian_bootstrap, astropy and tqdm are imported by the functions that use them, so importing
+# this module, running --help or starting a worker process doesn't load them; the notebooks import their own plotting
+# libraries
+from journey_arrays import event_arrays, is_journey_arrays, open_journey_arrays
+from journey_io import (OUTPUT_CODECS, iter_journeys, list_journey_files,
+                        output_extension, read_journeys,
+                        strip_journey_extension, write_journeys)
+from journey_keys import REQUIRED_COLUMNS_WITHOUT_OCC, hash_journeys
+from journey_patterns import compile_pattern, count_patterns
+from journey_store import date_range_suffix, load_store
+from ratio_metrics import (RATIO_METRICS, bootstrap_ratio, delta_method_intervals, ratio_columns,
+                           ratio_histograms, sufficient_statistics)
+from results_store import open_results_store
+from streaming_bootstrap import WEIGHTS, BootstrapAccumulator, salt_keys
 
 logging.debug("other modules loaded")
 
-# instantiate progress bar goodness
-tqdm.pandas()
+# the same logger the command line sets up, so the functions also log when imported
+logger = logging.getLogger('sample_processed_journey')
 
 # cols for related links A/B tests
 REQUIRED_COLUMNS = ["Occurrences", "ABVariant", "Page_Event_List",
                     "Page_List",  "Event_cat_act_agg"
                     ]
 
+# the metrics we run z_prop tests and Bayesian bootstraps on
+TESTED_METRICS = ["Has_Related", "Has_No_Nav_Or_Search",
+                  "Content_Nav_or_Search_Count", "Page_List_Length"]
+BOOTSTRAP_METRICS = ["Content_Nav_or_Search_Count", "Page_List_Length"]
+
+# the nav and search metrics as journey_patterns, matching count_nav_events and count_search_from_content, with
+# thing the set of thing_page_paths
+CONTENT_PAGE_PATTERNS = {
+    'Content_Page_Nav_Event_Count': "[breadcrumbClicked|homeLinkClicked|relatedLinkClicked&'Explore the topic'] on thing",
+    'Content_Search_Event_Count': "thing -> /search?q=",
+}
+
+# dirichlet draws the Bayesian bootstrap weights from one histogram of the
+# metric per variant, the streaming_bootstrap WEIGHTS from hashes of each row
+BOOTSTRAP_WEIGHTS = ["dirichlet"] + list(WEIGHTS)
+
 
 def is_a_b(variant, variant_dict):
     """
@@ -55,9 +67,34 @@ def get_number_of_events_rl(event):
 
 
 def sum_related_click_events(event_list):
+    """
+    Counts the related link clicks in an Event_cat_act_agg list, one journey at a time.
+
+    Kept as the reference definition count_related_click_events must match, e.g. for journey_sql.py's checks and the
+    notebooks.
+    """
     return sum([get_number_of_events_rl(event) for event in event_list])
 
 
+def is_related_click(event):
+    """Is a (category, action) event a related link click? See get_number_of_events_rl."""
+    return get_number_of_events_rl((event, 1)) == 1
+
+
+def count_related_click_events(journeys):
+    """
+    sum_related_click_events of each journey's Event_cat_act_agg, checking each distinct (category, action) pair
+    once.
+
+    Parameters:
+        journeys: a DataFrame of processed journeys, or journey arrays from journey_arrays.open_journey_arrays.
+
+    Returns:
+       numpy.ndarray: int64 related link clicks, one per journey.
+    """
+    return event_arrays(journeys, 'Event_cat_act_agg').count(is_related_click)
+
+
 def is_related(x):
     """Compute whether a journey includes at least one related link click."""
     return x > 0
@@ -80,6 +117,9 @@ def count_nav_events(page_event_list):
 
     Helper function dependent on thing_page_paths instantiated in analyse_sampled_processed_journey.
 
+    Kept as the reference definition the Content_Page_Nav_Event_Count pattern in CONTENT_PAGE_PATTERNS must match, one
+    journey at a time, e.g. for journey_sql.py's checks and the notebooks.
+
     """
     content_page_nav_events = 0
     for pair in page_event_list:
@@ -95,6 +135,9 @@ def count_search_from_content(page_list):
      as specified by the list of content pages, `thing_page_paths`.
 
     Helper function dependent on thing_page_paths instantiated in analyse_sampled_processed_journey.
+
+    Kept as the reference definition the Content_Search_Event_Count pattern in CONTENT_PAGE_PATTERNS must match, one
+    journey at a time, e.g. for journey_sql.py's checks and the notebooks.
     """
     search_from_content = 0
     for i, page in enumerate(page_list):
@@ -180,6 +223,7 @@ def z_prop(df, col_name, variant_dict):
     assert (n_b * (1 - p)) >= 5, "Assumptions for z prop test invalid!"
 
     # using statsmodels
+    from statsmodels.stats.proportion import proportions_ztest
     # successes
     count = np.array([x_a, x_b])
     # number of trials
@@ -225,6 +269,8 @@ def zconf_interval_two_samples(x_a, n_a, x_b, n_b, alpha=0.05):
 
     If the CI includes one then we accept the null hypothesis at the defined alpha.
     """
+    from scipy import stats
+
     p1 = x_a / n_a
     p2 = x_b / n_b
     se = compute_standard_error_prop_two_samples(x_a, n_a, x_b, n_b)
@@ -245,7 +291,8 @@ def mean_bb(counter_X_keys, counter_X_vals, n_replications):
     return samples
 
 
-def bayesian_bootstrap_analysis(df, col_name=None, boot_reps=10000, seed=1337, variant_dict=None):
+def bayesian_bootstrap_analysis(df, col_name=None, boot_reps=10000, seed=1337, variant_dict=None,
+                                weights="dirichlet"):
     """Run bayesian bootstrap on the mean of a variable of interest between Page Variants.
 
     Args:
@@ -254,6 +301,9 @@ def bayesian_bootstrap_analysis(df, col_name=None, boot_reps=10000, seed=1337, v
         boot_reps: An int of number of resamples with replacement.
         seed: A int random seed for reproducibility.
         variant_dict:dictionary containing letter codes for CONTROL_GROUP and INTERVENTION_GROUP
+        weights: 'dirichlet', or 'gamma' or 'poisson' to weight each value of the variable by a draw from a hash of
+            the value and the replicate, see streaming_bootstrap.BootstrapAccumulator. 'gamma' gives the same
+            posterior as 'dirichlet'.
 
     Returns:
         a_bootstrap: a vector of boot_reps n resampled means from A.
@@ -266,6 +316,18 @@ def bayesian_bootstrap_analysis(df, col_name=None, boot_reps=10000, seed=1337, v
         }
         logging.info('assigning defaults for variants: control group = "A" and intervention = "B"')
 
+    if weights != "dirichlet":
+        variants = [variant_dict['CONTROL_GROUP'], variant_dict['INTERVENTION_GROUP']]
+        # one row per variant and value, so every row has its own key
+        histogram = df[df.ABVariant.isin(variants)].groupby(
+            ['ABVariant', col_name])['Occurrences'].sum().reset_index()
+        accumulator = BootstrapAccumulator([col_name], variants, boot_reps=boot_reps, seed=seed, weights=weights)
+        accumulator.add_frame(histogram, hash_journeys(histogram, ['ABVariant', col_name]).values)
+        means = accumulator.means()[col_name]
+        return means[variants[0]], means[variants[1]]
+
+    from astropy.utils import NumpyRNGContext
+
     with NumpyRNGContext(seed):
         A_grouped_by_length = df[df.ABVariant == variant_dict['CONTROL_GROUP']].groupby(
             col_name).sum().reset_index()
@@ -300,6 +362,8 @@ def bb_hdi(a_bootstrap, b_bootstrap, alpha=0.05):
         prob_b_>_a: number of values greater than 0 divided by num of obs for mean diff posterior. Or
         the probability that B's mean metric was greater than A's mean metric.
         """
+    import bayesian_bootstrap.bootstrap as bb
+
     # Calculate a 95% HDI
     a_ci_low, a_ci_hi = bb.highest_density_interval(a_bootstrap, alpha=alpha)
     # Calculate a 95% HDI
@@ -324,95 +388,203 @@ def bb_hdi(a_bootstrap, b_bootstrap, alpha=0.05):
             'prob_b_>_a': p_value}
 
 
-# main
-def analyse_sampled_processed_journey(data_dir, filename, alpha, boot_reps, variants):
-    """
-        Conducts various A/B tests on one sampled processed journey file.
-
-        This function is dependent on document_types.csv.gz existing in data/metadata dir.
-
-        As this takes some time to run ~ 1 hour, we output an additional dataframe as .csv.gz
-        to the rl_sampled_processed dir as a side effect.
-        This can allow the user to revisit the metrics
-        at a later date without having to rerun the analysis.
-
-        Parameters:
-            data_dir: The directory processed_journey and sampled_journey can be
-                found in.
-            filename (str): The filename of the sampled processed journey, please include
-            any .csv.gz etc extensions.
-            alpha: The corrected false positive rate.
-            boot_reps: int of number of statistics generated from resampling to create distribution.
-            variants: list containing two str elements defining the control and intervention group labels
-        Returns:
-           pandas.core.frame.DataFrame: A data frame containing statistics of the A/B tests on various metrics.
-        """
-    variant_dict = {
-        'CONTROL_GROUP': variants[0],
-        'INTERVENTION_GROUP': variants[1]
-    }
-
-    logger.info(f"Analysing {filename} - calculating A/B test statistics...")
-
-    in_path = os.path.join(data_dir, "sampled_journey", filename)
-
-    logger.info("Reading in file...")
+def progress_bars():
+    """Add tqdm's progress_apply and progress_map to pandas, returning False if tqdm isn't installed."""
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        logger.warning("Missing tqdm library, no progress bars")
+        return False
+    # instantiate progress bar goodness
+    tqdm.pandas()
+    return True
 
-    df = pd.read_csv(in_path, sep='\t', usecols=REQUIRED_COLUMNS)
 
-    logger.debug(f'{filename} DataFrame shape {df.shape}')
+def derive_metrics(df, progress=True, lean=False):
+    """
+    Derive the related links, navigation and search metrics of each journey, adding them to df as columns.
 
-    logger.info("Finished reading, defensively removing any non A or B variants,"
-                " in-case the user did not sample...")
+    Helper function dependent on thing_page_paths, the thing page set of CONTENT_PAGE_PATTERNS.
 
-    # filter out any weird values like Object object
-    df.query("ABVariant in @variants", inplace=True)
+    Parameters:
+        df (pandas.core.frame.DataFrame): processed journeys, with the list columns as the strings read from file.
+        progress (bool): whether to show progress bars, which are noise when deriving chunk by chunk.
+        lean (bool): drop each list column as soon as the metrics that need it are derived, rather than keeping the
+            parsed lists, by far the largest part of df, for the rest of the analysis.
 
-    logger.debug(f'Cleaned DataFrame shape {df.shape}')
+    Returns:
+       pandas.core.frame.DataFrame: df, modified in place.
+    """
+    apply = 'progress_apply' if progress and progress_bars() else 'apply'
 
     logger.info('Preparing variables / cols for analysis...')
 
-    logger.debug('Convert three variables from str to list...')
-
-    df['Event_cat_act_agg'] = df['Event_cat_act_agg'].progress_apply(ast.literal_eval)
-    df['Page_Event_List'] = df['Page_Event_List'].progress_apply(ast.literal_eval)
-    df['Page_List'] = df['Page_List'].progress_apply(ast.literal_eval)
-
-    logger.debug('Create Page_Length_List col...')
+    logger.debug('Convert Event_cat_act_agg from str to list...')
 
-    df['Page_List_Length'] = df['Page_List'].progress_apply(len)
+    df['Event_cat_act_agg'] = getattr(df['Event_cat_act_agg'], apply)(ast.literal_eval)
 
     logger.info('Related link preparation...')
     logger.debug('Get the number of related links clicks per Sequence')
-    df['Related Links Clicks per seq'] = df['Event_cat_act_agg'].progress_map(sum_related_click_events)
+    df['Related Links Clicks per seq'] = count_related_click_events(df)
+    if lean:
+        del df['Event_cat_act_agg']
     logger.debug('Calculate number of related links per experimental unit.')
-    df["Has_Related"] = df["Related Links Clicks per seq"].progress_map(is_related)
+    df["Has_Related"] = is_related(df["Related Links Clicks per seq"])
     df['Related Links Clicks row total'] = df['Related Links Clicks per seq'] * df['Occurrences']
 
     # needs finding_thing_df read in from document_types.csv.gz
-    logger.info('Navigation events preparation...')
-    df['Content_Page_Nav_Event_Count'] = df['Page_Event_List'].progress_map(count_nav_events)
-    logger.info('Search events preparation...')
-    df['Content_Search_Event_Count'] = df['Page_List'].progress_map(count_search_from_content)
+    logger.info('Navigation and search events preparation...')
+    page_sets = {'thing': set(thing_page_paths)}
+    # one list column at a time, so with lean only one is ever parsed
+    for column in ['Page_Event_List', 'Page_List']:
+        logger.debug(f'Convert {column} from str to list...')
+        df[column] = getattr(df[column], apply)(ast.literal_eval)
+        if column == 'Page_List':
+            logger.debug('Create Page_Length_List col...')
+            df['Page_List_Length'] = getattr(df['Page_List'], apply)(len)
+        patterns = {metric: text for metric, text in CONTENT_PAGE_PATTERNS.items()
+                    if compile_pattern(text).column == column}
+        counts = count_patterns(df, patterns, page_sets)
+        if lean:
+            del df[column]
+        for metric in patterns:
+            df[metric] = counts[metric]
     logger.debug('Summing Nav and Search Events')
     df['Content_Nav_or_Search_Count'] = df['Content_Page_Nav_Event_Count'] + df['Content_Search_Event_Count']
 
     logger.debug('Sum content page nav event and search events, then multiply by occurrences for row total.')
     df['Content_Nav_Search_Event_Sum_row_total'] = df['Content_Nav_or_Search_Count'] * df['Occurrences']
-    logger.debug('Calculating the ratio of clicks on navigation elements vs. clicks on related links')
-    # avoid NaN with +1
-    df['Ratio_Nav_Search_to_Rel'] = (df['Content_Nav_Search_Event_Sum_row_total'] + 1) / \
-                                    (df['Related Links Clicks row total'] + 1)
 
     # if (Content_Nav_Search_Event_Sum == 0) that's our success
     # Has_No_Nav_Or_Search will equal 1, that's our success, works with z_prop function
     df['Has_No_Nav_Or_Search'] = df['Content_Nav_Search_Event_Sum_row_total'] == 0
 
     logger.info('All necessary variables derived for pending statistical tests...')
+    return df
+
+
+def derive_array_metrics(arrays):
+    """
+    derive_metrics for journey arrays opened by journey_arrays.open_journey_arrays, without parsing any lists.
+
+    Related link clicks are counted by count_related_click_events, and the nav and search metrics by their
+    CONTENT_PAGE_PATTERNS.
+
+    Helper function dependent on thing_page_paths, the thing page set of CONTENT_PAGE_PATTERNS.
+
+    Returns:
+       pandas.core.frame.DataFrame: Occurrences, ABVariant and the metrics of derive_metrics that the tests use.
+    """
+    logger.info('Deriving metrics from journey arrays...')
+    df = pd.DataFrame({'Occurrences': np.asarray(arrays.occurrences),
+                       'ABVariant': np.array(arrays.variants, dtype=object)[arrays.variant_codes]})
+    df['Page_List_Length'] = arrays.page_list_lengths()
+
+    df['Related Links Clicks per seq'] = count_related_click_events(arrays)
+    df['Has_Related'] = is_related(df['Related Links Clicks per seq'])
+
+    counts = count_patterns(arrays, CONTENT_PAGE_PATTERNS, {'thing': set(thing_page_paths)})
+    for metric in CONTENT_PAGE_PATTERNS:
+        df[metric] = counts[metric].values
+
+    df['Content_Nav_or_Search_Count'] = df['Content_Page_Nav_Event_Count'] + df['Content_Search_Event_Count']
+    df['Has_No_Nav_Or_Search'] = df['Content_Nav_or_Search_Count'] * df['Occurrences'] == 0
+    return df
+
+
+def lean_frame(df, metrics=TESTED_METRICS):
+    """
+    Only what the tests need of a frame of derived metrics: Occurrences, ABVariant as a categorical and metrics,
+    downcast to the smallest integer dtypes that hold their values. Flags are already one byte bools.
+
+    Returns:
+       pandas.core.frame.DataFrame: a new, lean, frame, so df can be freed.
+    """
+    lean = pd.DataFrame({'ABVariant': df['ABVariant'].astype('category')}, index=df.index)
+    for column in ['Occurrences'] + list(metrics):
+        values = df[column]
+        lean[column] = values if values.dtype == bool else pd.to_numeric(values, downcast='integer')
+    return lean
+
+
+def log_memory(df, stage):
+    """Log the memory df uses after a stage of the analysis, and the peak memory of the process so far."""
+    frame_mb = df.memory_usage(deep=True).sum() / 2 ** 20
+    try:
+        import resource
+    except ImportError:  # not on Windows
+        logger.info(f"Memory after {stage}: frame {frame_mb:.1f} MB")
+        return
+    # kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+    logger.info(f"Memory after {stage}: frame {frame_mb:.1f} MB, process peak {peak_mb:.1f} MB")
+
+
+def metric_histograms(df, metrics=TESTED_METRICS, ratio_metrics=RATIO_METRICS):
+    """
+    Occurrences per variant and value of each tested metric, and per variant, numerator and denominator value of each
+    ratio metric, see ratio_metrics.ratio_histograms.
+
+    All our tests only depend on how many occurrences each variant has of each value of a metric, so these small
+    tables are all we need to keep, and tables for different files or chunks can be added together.
+
+    Returns:
+       dict: metric name to a pandas Series of Occurrences indexed by ABVariant and the metric's value, or for a ratio
+       metric by ABVariant, numerator and denominator.
+    """
+    histograms = {}
+    for metric in metrics:
+        histogram = df.groupby(['ABVariant', metric], observed=True)['Occurrences'].sum().astype(np.int64)
+        # the same histogram whatever the dtypes of df, e.g. a lean_frame, so histograms can be added together
+        variant_values, metric_values = (histogram.index.get_level_values(level) for level in range(2))
+        if metric_values.dtype.kind in 'iu':
+            metric_values = metric_values.astype(np.int64)
+        histogram.index = pd.MultiIndex.from_arrays([variant_values.astype(object), metric_values],
+                                                    names=histogram.index.names)
+        histograms[metric] = histogram
+    histograms.update(ratio_histograms(df, ratio_metrics))
+    return histograms
+
+
+def add_metric_histograms(histograms, other):
+    """Add two sets of metric_histograms together."""
+    if histograms is None:
+        return other
+    return {metric: histograms[metric].add(other[metric], fill_value=0).astype(np.int64)
+            for metric in histograms}
+
+
+def bootstrap_metric_histograms(histograms, boot_reps, variant_dict, bootstrap_weights="dirichlet"):
+    """
+    The Bayesian bootstraps of BOOTSTRAP_METRICS on metric_histograms.
+
+    Returns:
+       dict: metric name to (a_bootstrap, b_bootstrap).
+    """
+    return {metric: bayesian_bootstrap_analysis(histograms[metric].reset_index(), col_name=metric,
+                                                boot_reps=boot_reps, variant_dict=variant_dict,
+                                                weights=bootstrap_weights)
+            for metric in BOOTSTRAP_METRICS}
+
+
+def test_metric_histograms(histograms, alpha, boot_reps, variant_dict, bootstrap_weights="dirichlet",
+                           bootstraps=None):
+    """
+    The z proportion tests and Bayesian bootstraps of analyse_sampled_processed_journey, on metric_histograms.
+
+    bootstrap_weights is passed to bayesian_bootstrap_analysis as its weights, unless the bootstraps of
+    BOOTSTRAP_METRICS have already been accumulated, e.g. row by row while streaming, and are given in bootstraps as
+    a dict of metric name to (a_bootstrap, b_bootstrap).
+
+    Returns:
+       (pandas.core.frame.DataFrame, pandas.core.frame.DataFrame): the z_prop and Bayesian bootstrap results.
+    """
+    frames = {metric: histogram.reset_index() for metric, histogram in histograms.items()}
 
     logger.debug('Performing z_prop test on prop with at least one related link.')
 
-    rl_stats = z_prop(df, 'Has_Related', variant_dict)
+    rl_stats = z_prop(frames['Has_Related'], 'Has_Related', variant_dict)
     # as it's one row needs to be a Series
     df_ab = pd.Series(rl_stats).to_frame().T
     logger.debug(df_ab)
@@ -425,7 +597,7 @@ def analyse_sampled_processed_journey(data_dir, filename, alpha, boot_reps, vari
 
     logger.debug('Performing z_prop test on prop with content page nav event.')
 
-    nav_stats = z_prop(df, 'Has_No_Nav_Or_Search', variant_dict)
+    nav_stats = z_prop(frames['Has_No_Nav_Or_Search'], 'Has_No_Nav_Or_Search', variant_dict)
     # concat rows
     df_ab_nav = pd.Series(nav_stats).to_frame().T
     logger.debug(df_ab_nav)
@@ -441,16 +613,13 @@ def analyse_sampled_processed_journey(data_dir, filename, alpha, boot_reps, vari
 
     df_ab = pd.concat([df_ab, df_ab_nav])
 
-    logger.info('Saving df with related links derived variables to rl_sampled_processed_journey dir')
-    out_path = os.path.join(DATA_DIR, "rl_sampled_processed_journey", ("zprop_" + f"{filename}"))
-    logger.info(f"Saving to {out_path}")
-    df_ab.to_csv(out_path, compression="gzip", index=False)
+    logger.info('Performing Bayesian bootstrap on count of nav or search and Page_List_Length.')
 
-    logger.info('Performing Bayesian bootstrap on count of nav or search.')
+    if bootstraps is None:
+        bootstraps = bootstrap_metric_histograms(histograms, boot_reps, variant_dict,
+                                                 bootstrap_weights=bootstrap_weights)
 
-    a_bootstrap, b_bootstrap = bayesian_bootstrap_analysis(df, col_name='Content_Nav_or_Search_Count',
-                                                           boot_reps=boot_reps,
-                                                           variant_dict=variant_dict)
+    a_bootstrap, b_bootstrap = bootstraps['Content_Nav_or_Search_Count']
     # high density interval of page variants and difference posteriors
     # ratio is vestigial name
     ratio_nav_stats = bb_hdi(a_bootstrap, b_bootstrap, alpha=alpha)
@@ -458,9 +627,9 @@ def analyse_sampled_processed_journey(data_dir, filename, alpha, boot_reps, vari
     df_ab_ratio = pd.Series(ratio_nav_stats).to_frame().T
     logger.debug(df_ab_ratio)
 
-    logger.info('Performing Bayesian bootstrap on Page_List_Length')
+    logger.info('High density intervals for Page_List_Length')
 
-    a_bootstrap, b_bootstrap = bayesian_bootstrap_analysis(df, col_name='Page_List_Length', boot_reps=boot_reps)
+    a_bootstrap, b_bootstrap = bootstraps['Page_List_Length']
     # high density interval of page variants and difference posteriors
     length_stats = bb_hdi(a_bootstrap, b_bootstrap, alpha=alpha)
 
@@ -473,14 +642,313 @@ def analyse_sampled_processed_journey(data_dir, filename, alpha, boot_reps, vari
     # modifies in place
     df_bayes.insert(0, 'Metric', ['Content_Nav_or_Search_Count', 'Page_List_Length'])
 
+    return df_ab, df_bayes
+
+
+def test_ratio_histograms(histograms, alpha, boot_reps, variant_dict, bootstrap_weights="dirichlet",
+                          ratio_metrics=RATIO_METRICS):
+    """
+    Delta method confidence intervals and Bayesian bootstrap high density intervals of each ratio metric, from the
+    ratio histograms of metric_histograms.
+
+    The delta method intervals are closed form, from each variant's sums of the numerator, denominator, their squares
+    and product, see ratio_metrics.delta_method. The bootstrap draws one weight matrix per variant for both the
+    numerator and denominator, see ratio_metrics.bootstrap_ratio, so each ratio metric costs about as much as a mean.
+
+    Returns:
+       (pandas.core.frame.DataFrame, dict): one row per ratio metric and stats_method, delta_method or bootstrap,
+       with each variant's ratio and the columns of bb_hdi, and the bootstraps as metric name to
+       (a_bootstrap, b_bootstrap). A metric whose denominator totals 0 for either variant is skipped with a warning.
+    """
+    variants = [variant_dict['CONTROL_GROUP'], variant_dict['INTERVENTION_GROUP']]
+    rows = []
+    bootstraps = {}
+    for metric in ratio_metrics:
+        statistics = sufficient_statistics(histograms[metric])
+        zero_totals = [variant for variant in variants
+                       if statistics['sum_y'].get(variant, 0) == 0]
+        if zero_totals:
+            logger.warning(f'Skipping ratio metric {metric}, its denominator totals 0 for variant(s) {zero_totals}.')
+            continue
+        logger.debug(f'Delta method and Bayesian bootstrap of ratio metric {metric}.')
+        delta_stats = delta_method_intervals(statistics, variant_dict, alpha=alpha)
+        rows.append({'Metric': metric, 'stats_method': 'delta_method', **delta_stats})
+
+        ratios = bootstrap_ratio(histograms[metric], variants, boot_reps=boot_reps, weights=bootstrap_weights)
+        bootstraps[metric] = ratios[variants[0]], ratios[variants[1]]
+        rows.append({'Metric': metric, 'stats_method': 'bootstrap', 'a_ratio': delta_stats['a_ratio'],
+                     'b_ratio': delta_stats['b_ratio'], **bb_hdi(*bootstraps[metric], alpha=alpha)})
+    df_ratio = pd.DataFrame(rows)
+    logger.debug(df_ratio)
+    return df_ratio, bootstraps
+
+
+def record_test_results(df_ab, df_bayes, bootstraps, data_dir, filename, variant_dict, alpha, boot_reps,
+                        bootstrap_weights, test=None, stratum=None, df_ratio=None):
+    """
+    Record the results of test_metric_histograms, and test_ratio_histograms if given in df_ratio, and the bootstraps
+    they were computed from, in the results store in data_dir, under test, or filename without its extension if no
+    test is given.
+
+    Returns:
+       int: the run_id of the results.
+    """
+    return open_results_store(data_dir).record(
+        df_ab, df_bayes, bootstraps, df_ratio=df_ratio, test=test or strip_journey_extension(filename),
+        stratum=stratum,
+        filename=filename, control_group=variant_dict['CONTROL_GROUP'],
+        intervention_group=variant_dict['INTERVENTION_GROUP'], alpha=alpha, boot_reps=boot_reps,
+        bootstrap_weights=bootstrap_weights)
+
+
+def save_test_results(df_ab, df_bayes, data_dir, filename, output_format="csv", codec="gzip", df_ratio=None):
+    """
+    Save the results of test_metric_histograms as zprop_ and bayesbootstrap_ files named after filename, and those of
+    test_ratio_histograms, if given in df_ratio, as a ratio_ file.
+    """
     logger.info('Saving df with related links derived variables to rl_sampled_processed_journey dir')
-    out_path = os.path.join(DATA_DIR, "rl_sampled_processed_journey", ("bayesbootstrap_" + f"{filename}"))
+    out_filename = strip_journey_extension(filename) + output_extension(output_format, codec)
+    out_path = os.path.join(data_dir, "rl_sampled_processed_journey", ("zprop_" + f"{out_filename}"))
+    logger.info(f"Saving to {out_path}")
+    write_journeys(df_ab, out_path, output_format=output_format, codec=codec, sep=",")
+
+    out_path = os.path.join(data_dir, "rl_sampled_processed_journey", ("bayesbootstrap_" + f"{out_filename}"))
     logger.info(f"Saving to {out_path}")
-    df_bayes.to_csv(out_path, compression="gzip", index=False)
+    write_journeys(df_bayes, out_path, output_format=output_format, codec=codec, sep=",")
+
+    if df_ratio is not None:
+        out_path = os.path.join(data_dir, "rl_sampled_processed_journey", ("ratio_" + f"{out_filename}"))
+        logger.info(f"Saving to {out_path}")
+        write_journeys(df_ratio, out_path, output_format=output_format, codec=codec, sep=",")
+
+
+# main
+def analyse_sampled_processed_journey(data_dir, filename, alpha, boot_reps, variants,
+                                      output_format="csv", codec="gzip", df=None, bootstrap_weights="dirichlet",
+                                      stratum=None, test=None, lean=False):
+    """
+        Conducts various A/B tests on one sampled processed journey file.
+
+        This function is dependent on document_types.csv.gz existing in data/metadata dir.
+
+        As this takes some time to run ~ 1 hour, we output an additional dataframe as .csv.gz
+        to the rl_sampled_processed dir as a side effect.
+        This can allow the user to revisit the metrics
+        at a later date without having to rerun the analysis.
+
+        Parameters:
+            data_dir: The directory processed_journey and sampled_journey can be
+                found in.
+            filename (str): The filename of the sampled processed journey, please include
+            any .csv.gz etc extensions. Any format written by sample_processed.py can be read,
+            it is detected from the file itself.
+            alpha: The corrected false positive rate.
+            boot_reps: int of number of statistics generated from resampling to create distribution.
+            variants: list containing two str elements defining the control and intervention group labels
+            output_format (str): 'csv' or 'parquet', the format of the results files.
+            codec (str): compression codec for the results files, see journey_io.OUTPUT_CODECS.
+            df (pandas.core.frame.DataFrame): journeys in the processed journey format to analyse instead of
+            reading filename, e.g. a date range read from a journey store. filename then only names the results
+            files.
+            bootstrap_weights (str): how to weight the Bayesian bootstrap replicates, one of BOOTSTRAP_WEIGHTS.
+            stratum (str): the stratum of the journeys, e.g. loved, recorded with the results. When filename is a
+            directory of journey arrays written by journey_arrays.py, only the journeys of this stratum are analysed,
+            and it is added to the names of the results files.
+            test (str): the name of the test, e.g. ab1, the results are recorded under in the results store in
+            data_dir, filename without its extension if None.
+            lean (bool): keep as little in memory as the tests need, with ABVariant as a categorical, each list
+            column dropped once its metrics are derived and then only the tested metrics, downcast, see
+            lean_frame, logging the memory used after each stage.
+        Returns:
+           pandas.core.frame.DataFrame: A data frame containing statistics of the A/B tests on various metrics.
+        """
+    variant_dict = {
+        'CONTROL_GROUP': variants[0],
+        'INTERVENTION_GROUP': variants[1]
+    }
+
+    logger.info(f"Analysing {filename} - calculating A/B test statistics...")
+
+    # strata of the same journeys are recorded under the same test
+    test = test or strip_journey_extension(filename)
+    arrays = None
+    if df is None:
+        in_path = os.path.join(data_dir, "sampled_journey", filename)
+
+        if is_journey_arrays(in_path):
+            logger.info("Opening journey arrays...")
+            arrays = open_journey_arrays(in_path)
+            if stratum is not None:
+                arrays = arrays.select(stratum=stratum)
+                filename = strip_journey_extension(filename) + "_" + stratum
+        else:
+            logger.info("Reading in file...")
+
+            df = read_journeys(in_path, usecols=REQUIRED_COLUMNS)
+    else:
+        df = df[REQUIRED_COLUMNS].copy()
+
+    if arrays is not None:
+        # nothing to parse, so derive the metrics before filtering
+        df = derive_array_metrics(arrays)
+
+    logger.debug(f'{filename} DataFrame shape {df.shape}')
+    if lean:
+        df['ABVariant'] = df['ABVariant'].astype('category')
+        log_memory(df, "reading")
+
+    logger.info("Finished reading, defensively removing any non A or B variants,"
+                " in-case the user did not sample...")
+
+    # filter out any weird values like Object object
+    df.query("ABVariant in @variants", inplace=True)
+
+    logger.debug(f'Cleaned DataFrame shape {df.shape}')
+
+    if arrays is None:
+        derive_metrics(df, lean=lean)
+    if lean:
+        log_memory(df, "deriving metrics")
+        df = lean_frame(df, TESTED_METRICS + ratio_columns())
+        log_memory(df, "narrowing to the tested metrics")
+
+    histograms = metric_histograms(df)
+    bootstraps = bootstrap_metric_histograms(histograms, boot_reps, variant_dict,
+                                             bootstrap_weights=bootstrap_weights)
+    df_ab, df_bayes = test_metric_histograms(histograms, alpha, boot_reps, variant_dict, bootstraps=bootstraps)
+    df_ratio, ratio_bootstraps = test_ratio_histograms(histograms, alpha, boot_reps, variant_dict,
+                                                       bootstrap_weights=bootstrap_weights)
+    save_test_results(df_ab, df_bayes, data_dir, filename, output_format=output_format, codec=codec,
+                      df_ratio=df_ratio)
+    record_test_results(df_ab, df_bayes, {**bootstraps, **ratio_bootstraps}, data_dir, filename, variant_dict,
+                        alpha, boot_reps, bootstrap_weights, test=test, stratum=stratum, df_ratio=df_ratio)
 
     return
 
 
+def set_thing_page_paths(page_paths):
+    """Set the thing pages the metric helpers look up, e.g. in a worker process."""
+    global thing_page_paths
+    thing_page_paths = set(page_paths)
+
+
+def population_metric_histograms(filepath, variants, chunksize=100000, bootstrap_weights="dirichlet",
+                                 boot_reps=10000, seed=1337):
+    """
+    metric_histograms of every journey in one processed journey file, deriving the metrics a chunk at a time so
+    only one chunk of journeys is ever in memory.
+
+    Unless bootstrap_weights is 'dirichlet', each journey row is also added to a streaming_bootstrap
+    BootstrapAccumulator of BOOTSTRAP_METRICS, keyed by its journey and the file it is in, which draws each row's
+    weights once for all the metrics.
+
+    Returns:
+       (dict, streaming_bootstrap.BootstrapAccumulator): the metric_histograms and the accumulator, or None for
+       'dirichlet'.
+    """
+    logger.info(f"Accumulating metrics for {filepath}")
+    histograms = None
+    accumulator = None
+    if bootstrap_weights != "dirichlet":
+        accumulator = BootstrapAccumulator(BOOTSTRAP_METRICS, variants, boot_reps=boot_reps, seed=seed,
+                                           weights=bootstrap_weights)
+    for df in iter_journeys(filepath, usecols=REQUIRED_COLUMNS, chunksize=chunksize):
+        # filter out any weird values like Object object
+        df = df[df.ABVariant.isin(variants)].copy()
+        if accumulator is not None:
+            # the same journey on different days needs different weights
+            row_keys = salt_keys(hash_journeys(df, REQUIRED_COLUMNS_WITHOUT_OCC).values,
+                                 strip_journey_extension(os.path.basename(filepath)))
+        derive_metrics(df, progress=False, lean=True)
+        histograms = add_metric_histograms(histograms, metric_histograms(df))
+        if accumulator is not None:
+            accumulator.add_frame(df, row_keys)
+    return histograms, accumulator
+
+
+def _population_metric_histograms(args):
+    """Unpack arguments for population_metric_histograms in a worker process."""
+    return population_metric_histograms(*args)
+
+
+def analyse_population_processed_journey(data_dir, filename_prefix, alpha, boot_reps, variants, workers=None,
+                                         chunksize=100000, output_format="csv", codec="gzip",
+                                         bootstrap_weights="dirichlet", seed=1337, test=None):
+    """
+        Conducts the A/B tests of analyse_sampled_processed_journey on every journey in the processed journey files
+        for a test, rather than a sample.
+
+        Every metric we test is occurrence weighted, so the exact totals for a whole test are small histograms of
+        occurrences per variant and metric value. Each file is streamed in chunks in its own worker process, and the
+        histograms are added together before testing, so memory use does not grow with the number of days.
+
+        With 'gamma' or 'poisson' bootstrap_weights the bootstrap replicates are also accumulated row by row as the
+        files are streamed, and the accumulators from each worker added together.
+
+        Parameters:
+            data_dir: The directory processed_journey can be found in.
+            filename_prefix (str): The filename prefix of the processed journeys, every file starting with it in
+            data_dir/processed_journey is analysed.
+            alpha: The corrected false positive rate.
+            boot_reps: int of number of statistics generated from resampling to create distribution.
+            variants: list containing two str elements defining the control and intervention group labels
+            workers (int): number of processes, all cores if None.
+            chunksize (int): number of journeys to derive metrics for at a time.
+            output_format (str): 'csv' or 'parquet', the format of the results files.
+            codec (str): compression codec for the results files, see journey_io.OUTPUT_CODECS.
+            bootstrap_weights (str): how to weight the Bayesian bootstrap replicates, one of BOOTSTRAP_WEIGHTS.
+            seed (int): the random seed of the bootstrap.
+            test (str): the name of the test the results are recorded under in the results store in data_dir.
+        Returns:
+           (pandas.core.frame.DataFrame, pandas.core.frame.DataFrame): the z_prop and Bayesian bootstrap results,
+           also saved as zprop_population_<<filename_prefix>> and bayesbootstrap_population_<<filename_prefix>>, with
+           the tests of the ratio metrics saved as ratio_population_<<filename_prefix>>.
+        """
+    variant_dict = {
+        'CONTROL_GROUP': variants[0],
+        'INTERVENTION_GROUP': variants[1]
+    }
+
+    filepath_list = list_journey_files(os.path.join(data_dir, "processed_journey"), filename_prefix)
+    logger.info(f"Analysing every journey in {filepath_list}")
+
+    tasks = [(filepath, variants, chunksize, bootstrap_weights, boot_reps, seed) for filepath in filepath_list]
+    if len(tasks) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_thing_page_paths,
+                                 initargs=(thing_page_paths,)) as executor:
+            results = list(executor.map(_population_metric_histograms, tasks))
+    else:
+        set_thing_page_paths(thing_page_paths)
+        results = [_population_metric_histograms(task) for task in tasks]
+
+    histograms = None
+    accumulator = None
+    for file_histograms, file_accumulator in results:
+        histograms = add_metric_histograms(histograms, file_histograms)
+        if accumulator is None:
+            accumulator = file_accumulator
+        elif file_accumulator is not None:
+            accumulator.merge(file_accumulator)
+
+    if accumulator is not None:
+        bootstraps = {metric: (means[variants[0]], means[variants[1]])
+                      for metric, means in accumulator.means().items()}
+    else:
+        bootstraps = bootstrap_metric_histograms(histograms, boot_reps, variant_dict,
+                                                 bootstrap_weights=bootstrap_weights)
+
+    df_ab, df_bayes = test_metric_histograms(histograms, alpha, boot_reps, variant_dict, bootstraps=bootstraps)
+    # the ratio bootstraps weight each histogram cell, as they only need the histograms
+    df_ratio, ratio_bootstraps = test_ratio_histograms(histograms, alpha, boot_reps, variant_dict,
+                                                       bootstrap_weights=bootstrap_weights)
+    save_test_results(df_ab, df_bayes, data_dir, "population_" + filename_prefix,
+                      output_format=output_format, codec=codec, df_ratio=df_ratio)
+    record_test_results(df_ab, df_bayes, {**bootstraps, **ratio_bootstraps}, data_dir,
+                        "population_" + filename_prefix, variant_dict, alpha, boot_reps, bootstrap_weights,
+                        test=test, df_ratio=df_ratio)
+    return df_ab, df_bayes
+
+
 if __name__ == "__main__":  # our module is being executed as a program
     parser = argparse.ArgumentParser(
         description='Analysing sampled processed data module')
@@ -489,10 +957,11 @@ if __name__ == "__main__":  # our module is being executed as a program
         Prefix of files we want to analyse without csv.gz ending. We will read from
                         the sampled_journey directory from the DATA_DIR
                         specified in your .envrc, and write to the
-                        rl_sampled_processed_journey directory in DATA_DIR, the two dataframes with analyses outputs, 
+                        rl_sampled_processed_journey directory in DATA_DIR, the three dataframes with analyses outputs, 
                         will be saved as
-                        bayesbootstrap_<<filename_prefix>>.csv.gz and
-                         zprop_<<filename_prefix>>.csv.gz
+                        bayesbootstrap_<<filename_prefix>>.csv.gz,
+                         zprop_<<filename_prefix>>.csv.gz and
+                         ratio_<<filename_prefix>>.csv.gz
         ''')
     parser.add_argument(
         'document_types_filename', default='document_types', help='''
@@ -502,14 +971,14 @@ if __name__ == "__main__":  # our module is being executed as a program
         "finding" or a "thing" page. See README for details of getting this data.
         ''')
     parser.add_argument(
-        '--alpha', default=0.05, help='''
+        '--alpha', default=0.05, type=float, help='''
            The false positive rate.
            
            With respect to hypothesis tests , alpha refers to significance level, 
            the probability of making a Type I error.
             ''')
     parser.add_argument(
-        '--m', default=4, help='''
+        '--m', default=4, type=int, help='''
                The number of hypotheses tested.
                
                Given we are testing 4 null hypotheses we should control for multiple comparisons, 
@@ -522,7 +991,7 @@ if __name__ == "__main__":  # our module is being executed as a program
  
                 ''')
     parser.add_argument(
-        '--boot_reps', default=10000, help='''
+        '--boot_reps', default=10000, type=int, help='''
                The number of bootstrap replicates.
                
                The number of times we draw n-1 times with replacement from a sample and estimate a statistic. 
@@ -540,6 +1009,65 @@ if __name__ == "__main__":  # our module is being executed as a program
         '--intervention_group', default="C", help='''
                    Capital letter that defines the intervention variant (e.g., "C")
                     ''')
+    parser.add_argument(
+        '--output_format', default="csv", choices=list(OUTPUT_CODECS), help='''
+                   Format of the two results files, csv or parquet.
+                    ''')
+    parser.add_argument(
+        '--codec', default=None, choices=sorted(set(sum(OUTPUT_CODECS.values(), []))), help='''
+                   Compression codec for the results files, defaults to gzip for csv and zstd for parquet.
+                    ''')
+    parser.add_argument(
+        '--stratum', default=None, help='''
+                   When filename is a directory of journey arrays written by journey_arrays.py, only analyse the
+                   journeys of this stratum, e.g. loved.
+                    ''')
+    parser.add_argument(
+        '--population', action='store_true', help='''
+                   Analyse every journey in the processed_journey files instead of a sample, streaming each file
+                   in chunks with one worker process per file. filename is then the prefix of the processed journey
+                   files, and the results are saved as zprop_population_<<filename>> and
+                   bayesbootstrap_population_<<filename>>.
+                    ''')
+    parser.add_argument(
+        '--workers', default=None, type=int, help='''
+                   With --population, the number of processes, all cores if not given.
+                    ''')
+    parser.add_argument(
+        '--chunksize', default=100000, type=int, help='''
+                   With --population, the number of journeys to derive metrics for at a time.
+                    ''')
+    parser.add_argument(
+        '--bootstrap_weights', default="dirichlet", choices=BOOTSTRAP_WEIGHTS, help='''
+                   How to weight the Bayesian bootstrap replicates. dirichlet draws weights for a histogram of each
+                   metric per variant. gamma (the same posterior) and poisson weight each journey by a draw from a
+                   hash of the journey and the replicate, so with --population the replicates are accumulated as
+                   the files are streamed.
+                    ''')
+    parser.add_argument(
+        '--store', action='store_true', help='''
+                   Analyse every journey from the journey store built by journey_store.py instead of a sample,
+                   filename is then the filename prefix the store was built for.
+                    ''')
+    parser.add_argument(
+        '--start_date', default=None, help='''
+                   With --store, the first day to analyse, e.g. 2019-02-14.
+                    ''')
+    parser.add_argument(
+        '--end_date', default=None, help='''
+                   With --store, the last day to analyse.
+                    ''')
+    parser.add_argument(
+        '--lean', action='store_true', help='''
+                   Keep as little in memory as the tests need: ABVariant as a categorical, each list column dropped
+                   once the metrics needing it are derived, and then only the tested metrics, downcast. The memory
+                   used after each stage is logged.
+                    ''')
+    parser.add_argument(
+        '--test', default=None, help='''
+                   Name of the test the results are recorded under in the results store in DATA_DIR, e.g. ab1,
+                   defaults to the name of the results files without zprop_ or bayesbootstrap_.
+                    ''')
     parser.add_argument('--debug-level', default="INFO",
                         help='debug level of messages (DEBUG, INFO, WARNING'
                              ' etc...)')
@@ -547,7 +1075,7 @@ if __name__ == "__main__":  # our module is being executed as a program
 
     # Logger setup
     LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
-    logging.config.fileConfig(LOGGING_CONFIG)
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
     logger = logging.getLogger('sample_processed_journey')
     logger.setLevel(getattr(logging, args.debug_level))
 
@@ -573,5 +1101,24 @@ if __name__ == "__main__":  # our module is being executed as a program
     finding_page_paths = df_finding_thing[
         df_finding_thing['is_finding'] == 1]['pagePath'].tolist()
 
-    analyse_sampled_processed_journey(DATA_DIR, args.filename, alpha=args.alpha / args.m, boot_reps=args.boot_reps,
-                                      variants=list(args.control_group, args.intervention_group))
+    variants = [args.control_group, args.intervention_group]
+    codec = args.codec or OUTPUT_CODECS[args.output_format][0]
+    if args.population:
+        analyse_population_processed_journey(DATA_DIR, args.filename, alpha=args.alpha / args.m,
+                                             boot_reps=args.boot_reps, variants=variants, workers=args.workers,
+                                             chunksize=args.chunksize, output_format=args.output_format,
+                                             codec=codec, bootstrap_weights=args.bootstrap_weights,
+                                             test=args.test)
+    else:
+        filename, df = args.filename, None
+        if args.store:
+            logger.info(f'Reading {args.filename} journeys from the journey store...')
+            df = load_store(DATA_DIR, args.filename).read_journeys(
+                start_date=args.start_date, end_date=args.end_date, variants=variants)
+            filename = "store_" + args.filename + date_range_suffix(args.start_date, args.end_date)
+
+        analyse_sampled_processed_journey(DATA_DIR, filename, alpha=args.alpha / args.m, boot_reps=args.boot_reps,
+                                          variants=variants,
+                                          output_format=args.output_format,
+                                          codec=codec, df=df, bootstrap_weights=args.bootstrap_weights,
+                                          stratum=args.stratum, test=args.test, lean=args.lean)
@@ -0,0 +1,494 @@
+import os
+import sys
+import ast
+import argparse
+import logging.config
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+    from scipy import stats
+    from statsmodels.stats.multitest import multipletests
+except ImportError:
+    logging.error("Missing pandas, numpy, scipy and/or statsmodels library")
+    sys.exit()
+
+try:
+    # optional, reads the nested parquet copies made by journey_sql.py
+    # without parsing any python literals
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pc = None
+    pq = None
+
+from journey_io import (OUTPUT_CODECS, detect_format, iter_journeys,
+                        list_journey_files, output_extension, write_journeys)
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('breakdown')
+
+REQUIRED_COLUMNS = ["Occurrences", "ABVariant", "Page_Event_List",
+                    "Page_List"]
+
+# occurrence weighted counts per variant and page (or document type), the
+# Journeys_With_ columns count journeys with at least one such event on the
+# page, i.e. the successes for the proportion tests
+COUNT_COLUMNS = ["Journeys", "Page_Views", "Related_Links_Clicks",
+                 "Journeys_With_Related", "Nav_Events", "Searches_From_Page",
+                 "Journeys_With_Nav_Or_Search"]
+
+# the proportions tested per group, as (metric name, successes column)
+TESTED_PROPORTIONS = [("Has_Related", "Journeys_With_Related"),
+                      ("Has_Nav_Or_Search", "Journeys_With_Nav_Or_Search")]
+
+UNKNOWN_GROUP = "unknown"
+
+
+def explode_pages(page_lists):
+    """
+    Every page view of every journey, with the position of its journey.
+
+    Parameters:
+        page_lists (pandas.core.series.Series): parsed Page_List lists.
+
+    Returns:
+       (numpy.ndarray, numpy.ndarray): journey positions and page paths.
+    """
+    lengths = page_lists.map(len).values
+    journeys = np.repeat(np.arange(len(page_lists)), lengths)
+    pages = np.array(list(chain.from_iterable(page_lists)), dtype=object)
+    return journeys, pages
+
+
+def explode_page_events(page_event_lists):
+    """
+    Every (page, event) pair of every journey, with the position of its
+    journey.
+
+    Parameters:
+        page_event_lists (pandas.core.series.Series): parsed Page_Event_List
+            lists of ('/page', ('category', 'action')).
+
+    Returns:
+       pandas.core.frame.DataFrame: journey, page, category and action.
+    """
+    lengths = page_event_lists.map(len).values
+    pairs = pd.DataFrame(list(chain.from_iterable(page_event_lists)),
+                         columns=["page", "event"])
+    events = pd.DataFrame(pairs["event"].tolist(), index=pairs.index,
+                          columns=["category", "action"])
+    return pd.concat([
+        pd.DataFrame({"journey": np.repeat(np.arange(len(lengths)), lengths),
+                      "page": pairs["page"]}),
+        events], axis=1)
+
+
+def related_link_clicks(events):
+    """
+    Whether each event is a related link click, vectorised
+    analysis.get_number_of_events_rl.
+    """
+    return ((events["category"] == 'relatedLinkClicked')
+            & events["action"].str.contains('Related content', regex=False))
+
+
+def nav_events(events):
+    """
+    Whether each event is navigation related, vectorised
+    analysis.is_nav_event, which looks for the names in either element of
+    the (category, action) tuple.
+    """
+    def in_event(name):
+        return (events["category"] == name) | (events["action"] == name)
+
+    return (in_event('breadcrumbClicked') | in_event('homeLinkClicked')
+            | (in_event('relatedLinkClicked') & in_event('Explore the topic')))
+
+
+def searches_from_pages(journeys, pages):
+    """
+    The pages viewed immediately before a GOV.UK search, as in
+    analysis.count_search_from_content but from any page.
+
+    Returns:
+       (numpy.ndarray, numpy.ndarray): journey positions and page paths.
+    """
+    is_search = pd.Series(pages).str.contains('/search?q=', regex=False).values
+    before_search = (journeys[1:] == journeys[:-1]) & is_search[1:]
+    return journeys[:-1][before_search], pages[:-1][before_search]
+
+
+def explode_nested(batch):
+    """
+    explode_pages and explode_page_events for a pyarrow RecordBatch of the
+    nested parquet made by journey_sql.convert_to_parquet, flattening the
+    list columns without any parsing.
+    """
+    journeys = pc.list_parent_indices(batch["Page_List"]).to_numpy()
+    pages = pc.list_flatten(batch["Page_List"]).to_numpy(
+        zero_copy_only=False)
+    flat_events = pc.list_flatten(batch["Page_Event_List"])
+    events = pd.DataFrame({
+        "journey": pc.list_parent_indices(
+            batch["Page_Event_List"]).to_numpy(),
+        "page": flat_events.field("page").to_numpy(zero_copy_only=False),
+        "category": flat_events.field("category").to_numpy(
+            zero_copy_only=False),
+        "action": flat_events.field("action").to_numpy(zero_copy_only=False)})
+    return journeys, pages, events
+
+
+def journey_page_counts(journeys, pages, events):
+    """
+    The page views, related link clicks, nav events and searches from each
+    page of each journey.
+
+    Parameters:
+        journeys (numpy.ndarray), pages (numpy.ndarray): every page view,
+            from explode_pages.
+        events (pandas.core.frame.DataFrame): every page event, from
+            explode_page_events.
+
+    Returns:
+       pandas.core.frame.DataFrame: journey, page and a count column for
+       each of Page_Views, Related_Links_Clicks, Nav_Events and
+       Searches_From_Page, one row per journey page view, event or search.
+    """
+    search_journeys, search_pages = searches_from_pages(journeys, pages)
+    return pd.concat([
+        pd.DataFrame({"journey": journeys, "page": pages, "Page_Views": 1}),
+        pd.DataFrame({
+            "journey": events["journey"].values,
+            "page": events["page"].values,
+            "Related_Links_Clicks": related_link_clicks(events).astype(int),
+            "Nav_Events": nav_events(events).astype(int)}),
+        pd.DataFrame({"journey": search_journeys, "page": search_pages,
+                      "Searches_From_Page": 1})
+    ], ignore_index=True).fillna(0)
+
+
+def group_counts(df, counts, groups=None):
+    """
+    Occurrence weighted COUNT_COLUMNS per variant and page, or per variant
+    and group of pages.
+
+    Parameters:
+        df (pandas.core.frame.DataFrame): the processed journeys counts was
+            made from.
+        counts (pandas.core.frame.DataFrame): from journey_page_counts.
+        groups (pandas.core.series.Series): the group of each page path, e.g.
+            its document type, None to count per page. Pages not in groups
+            are counted in UNKNOWN_GROUP.
+
+    Returns:
+       pandas.core.frame.DataFrame: COUNT_COLUMNS indexed by ABVariant and
+       page or group.
+    """
+    keys = counts["page"]
+    if groups is not None:
+        keys = keys.map(groups).fillna(UNKNOWN_GROUP)
+    codes, names = pd.factorize(keys)
+
+    # one row per journey and page (or group)
+    per_journey = counts.drop(columns="page").assign(key=codes).groupby(
+        ["journey", "key"], sort=False).sum().reset_index()
+    journey = per_journey["journey"].values
+    occurrences = df["Occurrences"].values[journey]
+
+    weighted = pd.DataFrame({
+        "ABVariant": df["ABVariant"].values[journey],
+        "key": names[per_journey["key"].values],
+        "Journeys": occurrences,
+        "Page_Views": per_journey["Page_Views"].values * occurrences,
+        "Related_Links_Clicks":
+            per_journey["Related_Links_Clicks"].values * occurrences,
+        "Journeys_With_Related":
+            (per_journey["Related_Links_Clicks"].values > 0) * occurrences,
+        "Nav_Events": per_journey["Nav_Events"].values * occurrences,
+        "Searches_From_Page":
+            per_journey["Searches_From_Page"].values * occurrences,
+        "Journeys_With_Nav_Or_Search":
+            ((per_journey["Nav_Events"].values
+              + per_journey["Searches_From_Page"].values) > 0) * occurrences,
+    })
+    return weighted.groupby(["ABVariant", "key"]).sum().astype(np.int64)
+
+
+def add_counts(counts, other):
+    """Add two group_counts tables together."""
+    if counts is None:
+        return other
+    return counts.add(other, fill_value=0).astype(np.int64)
+
+
+def breakdown_file(filepath, variants, groups, chunksize=100000):
+    """
+    group_counts per page and per group of every journey in one file, a
+    chunk at a time.
+
+    Returns:
+       (pandas.core.frame.DataFrame, pandas.core.frame.DataFrame): the counts
+       per page and per group.
+    """
+    logger.info(f"Breaking down {filepath}")
+    page_counts, group_counts_ = None, None
+    for df, journeys, pages, events in iter_exploded(filepath, variants,
+                                                     chunksize):
+        counts = journey_page_counts(journeys, pages, events)
+        page_counts = add_counts(page_counts, group_counts(df, counts))
+        group_counts_ = add_counts(group_counts_,
+                                   group_counts(df, counts, groups))
+    return page_counts, group_counts_
+
+
+def is_nested_parquet(filepath):
+    """Whether filepath is parquet with list columns, from journey_sql.py."""
+    if pq is None or detect_format(filepath)[0] != "parquet":
+        return False
+    schema = pq.read_schema(filepath)
+    return "Page_List" in schema.names and str(
+        schema.field("Page_List").type).startswith("list")
+
+
+def iter_exploded(filepath, variants, chunksize=100000):
+    """
+    Each chunk of journeys in filepath in the variants, exploded.
+
+    Yields:
+       (pandas.core.frame.DataFrame, numpy.ndarray, numpy.ndarray,
+       pandas.core.frame.DataFrame): Occurrences and ABVariant of each
+       journey, and from explode_pages and explode_page_events.
+    """
+    if is_nested_parquet(filepath):
+        parquet_file = pq.ParquetFile(filepath)
+        for batch in parquet_file.iter_batches(batch_size=chunksize,
+                                               columns=REQUIRED_COLUMNS):
+            # filter out any weird values like Object object
+            batch = batch.filter(pc.is_in(batch["ABVariant"],
+                                          value_set=pa.array(variants)))
+            df = batch.select(["Occurrences", "ABVariant"]).to_pandas()
+            yield (df,) + explode_nested(batch)
+        return
+
+    for df in iter_journeys(filepath, usecols=REQUIRED_COLUMNS,
+                            chunksize=chunksize):
+        # filter out any weird values like Object object
+        df = df[df["ABVariant"].isin(variants)].reset_index(drop=True)
+        journeys, pages = explode_pages(
+            df["Page_List"].map(ast.literal_eval))
+        events = explode_page_events(
+            df["Page_Event_List"].map(ast.literal_eval))
+        yield df, journeys, pages, events
+
+
+def _breakdown_file(args):
+    """Unpack arguments for breakdown_file in a worker process."""
+    return breakdown_file(*args)
+
+
+def breakdown_files(filepath_list, variants, groups, chunksize=100000,
+                    workers=None):
+    """breakdown_file for many files, one process per file, added together."""
+    tasks = [(filepath, variants, groups, chunksize)
+             for filepath in filepath_list]
+    if len(tasks) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_breakdown_file, tasks))
+    else:
+        results = [_breakdown_file(task) for task in tasks]
+
+    page_counts, group_counts_ = None, None
+    for file_page_counts, file_group_counts in results:
+        page_counts = add_counts(page_counts, file_page_counts)
+        group_counts_ = add_counts(group_counts_, file_group_counts)
+    return page_counts, group_counts_
+
+
+def page_groups(df_finding_thing):
+    """
+    The group of each page path in the document types lookup, its
+    document_type if the lookup has one, or else whether it is a 'finding'
+    or 'thing' page.
+    """
+    lookup = df_finding_thing.drop_duplicates("pagePath").set_index(
+        "pagePath")
+    if "document_type" in lookup.columns:
+        return lookup["document_type"]
+    return lookup["is_finding"].map({1: "finding", 0: "thing"})
+
+
+def z_prop_groups(counts, variant_dict, key_name="pagePath", alpha=0.05,
+                  correction="fdr_bh", min_journeys=0):
+    """
+    The z proportion test of analysis.z_prop for each page or group at once,
+    for each of TESTED_PROPORTIONS, with p-values corrected for the number of
+    groups tested.
+
+    Groups where the z test's assumptions do not hold (fewer than 5 expected
+    successes or failures in a variant), or with fewer than min_journeys
+    journeys in a variant, are not tested and have no p-value.
+
+    Parameters:
+        counts (pandas.core.frame.DataFrame): from group_counts.
+        variant_dict (dict): CONTROL_GROUP and INTERVENTION_GROUP variants.
+        key_name (str): the name of the page or group column in the result.
+        alpha (float): the family-wise false positive rate (or false
+            discovery rate) for the correction and the confidence intervals.
+        correction (str): a statsmodels multipletests method, e.g.
+            'bonferroni', 'holm' or 'fdr_bh'.
+        min_journeys (int): the fewest journeys a variant needs for a group
+            to be tested.
+
+    Returns:
+       pandas.core.frame.DataFrame: one row per group and metric, with the
+       columns of z_prop's results plus ci_low, ci_upp, p-value_corrected
+       and reject.
+    """
+    control = counts.xs(variant_dict['CONTROL_GROUP'], level="ABVariant")
+    intervention = counts.xs(variant_dict['INTERVENTION_GROUP'],
+                             level="ABVariant")
+    control, intervention = control.align(intervention, join="outer",
+                                          fill_value=0)
+    z_critical = stats.norm.ppf(1 - 0.5 * alpha)
+
+    results = []
+    for metric_name, successes in TESTED_PROPORTIONS:
+        x_a = control[successes].values.astype(float)
+        n_a = control["Journeys"].values.astype(float)
+        x_b = intervention[successes].values.astype(float)
+        n_b = intervention["Journeys"].values.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p = (x_a + x_b) / (n_a + n_b)
+            p_a, p_b = x_a / n_a, x_b / n_b
+            # pooled standard error, as statsmodels proportions_ztest
+            pooled_se = np.sqrt(p * (1 - p) * (1 / n_a + 1 / n_b))
+            z = (p_a - p_b) / pooled_se
+            # unpooled standard error, as zconf_interval_two_samples
+            se = np.sqrt(p_a * (1 - p_a) / n_a + p_b * (1 - p_b) / n_b)
+
+        testable = ((n_a * p >= 5) & (n_a * (1 - p) >= 5)
+                    & (n_b * p >= 5) & (n_b * (1 - p) >= 5)
+                    & (n_a >= min_journeys) & (n_b >= min_journeys))
+        p_value = np.where(testable, 2 * stats.norm.sf(np.abs(z)), np.nan)
+        corrected = np.full(len(p_value), np.nan)
+        reject = np.zeros(len(p_value), dtype=bool)
+        if testable.any():
+            reject[testable], corrected[testable], _, _ = multipletests(
+                p_value[testable], alpha=alpha, method=correction)
+
+        results.append(pd.DataFrame({
+            key_name: control.index.values,
+            'metric_name': metric_name, 'stats_method': 'z_prop_test',
+            'x_ab': x_a + x_b, 'n_ab': n_a + n_b, 'p': p,
+            'x_a': x_a, 'n_a': n_a, 'p_a': p_a,
+            'x_b': x_b, 'n_b': n_b, 'p_b': p_b,
+            'test_statistic': np.where(testable, z, np.nan),
+            'p-value': p_value,
+            'ci_low': p_b - p_a - z_critical * se,
+            'ci_upp': p_b - p_a + z_critical * se,
+            'p-value_corrected': corrected, 'reject': reject}))
+
+    return pd.concat(results, ignore_index=True).sort_values(
+        ['metric_name', 'p-value_corrected', key_name])
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Break down related link clicks, navigation and search '
+                    'by page and by document type, with a z test per page',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filename_prefix', help='''
+        Prefix of the journey files to break down. We will read from
+        the processed_journey directory (or --input_dir) in DATA_DIR, or much
+        faster from the parquet copies journey_sql.py makes in
+        processed_journey_parquet, and
+        write pagebreakdown_<<filename_prefix>>.csv.gz and
+        doctypebreakdown_<<filename_prefix>>.csv.gz to the
+        rl_sampled_processed_journey directory in DATA_DIR.
+        ''')
+    parser.add_argument(
+        'document_types_filename', help='''
+        Filename of the lookup table in DATA_DIR/metadata for page document
+        type, e.g. document_types.csv.gz. Pages are grouped by its
+        document_type column if it has one, or else as finding or thing
+        pages.
+        ''')
+    parser.add_argument(
+        '--input_dir', default="processed_journey",
+        help='directory in DATA_DIR to read, e.g. sampled_journey')
+    parser.add_argument(
+        '--control_group', default="B",
+        help='Capital letter that defines the control variant (e.g., "B")')
+    parser.add_argument(
+        '--intervention_group', default="C",
+        help='Capital letter that defines the intervention variant '
+             '(e.g., "C")')
+    parser.add_argument(
+        '--alpha', default=0.05, type=float,
+        help='the false positive (or false discovery) rate, after correction')
+    parser.add_argument(
+        '--correction', default="fdr_bh", help='''
+        multiple comparison correction, any statsmodels multipletests method,
+        e.g. bonferroni, holm or fdr_bh
+        ''')
+    parser.add_argument(
+        '--min_journeys', default=100, type=int,
+        help='the fewest journeys per variant for a page to be tested')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='number of processes, all cores if not given')
+    parser.add_argument(
+        '--chunksize', default=100000, type=int,
+        help='number of journeys to explode at a time')
+    parser.add_argument(
+        '--output_format', default="csv", choices=list(OUTPUT_CODECS),
+        help='format of the breakdown files')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('breakdown')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+
+    metadata_path = os.path.join(
+        DATA_DIR, 'metadata', args.document_types_filename)
+    logger.info(f'Reading in metadata from {metadata_path}')
+    groups = page_groups(pd.read_csv(metadata_path, sep="\t"))
+
+    variant_dict = {'CONTROL_GROUP': args.control_group,
+                    'INTERVENTION_GROUP': args.intervention_group}
+    filepath_list = list_journey_files(
+        os.path.join(DATA_DIR, args.input_dir), args.filename_prefix)
+    logger.info(f"work with files {filepath_list}")
+    page_counts, doctype_counts = breakdown_files(
+        filepath_list, list(variant_dict.values()), groups,
+        chunksize=args.chunksize, workers=args.workers)
+
+    for name, counts, key_name in [
+            ("pagebreakdown_", page_counts, "pagePath"),
+            ("doctypebreakdown_", doctype_counts, "document_type")]:
+        logger.info(f"Testing {counts.index.get_level_values(1).nunique()} "
+                    f"values of {key_name}")
+        df_tests = z_prop_groups(
+            counts, variant_dict, key_name=key_name, alpha=args.alpha,
+            correction=args.correction, min_journeys=args.min_journeys)
+        out_path = os.path.join(
+            DATA_DIR, "rl_sampled_processed_journey",
+            name + args.filename_prefix
+            + output_extension(args.output_format,
+                               OUTPUT_CODECS[args.output_format][0]))
+        logger.info(f"Saving to {out_path}")
+        write_journeys(df_tests, out_path, output_format=args.output_format,
+                       codec=OUTPUT_CODECS[args.output_format][0], sep=",")
@@ -0,0 +1,299 @@
+import os
+import ast
+import sys
+import argparse
+import logging.config
+from itertools import chain
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+except ImportError:
+    logging.error("Missing pandas and/or numpy library")
+    sys.exit()
+
+from journey_io import (OUTPUT_CODECS, iter_journeys, list_journey_files,
+                        output_extension, write_journeys)
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('heavy_hitters')
+
+REQUIRED_COLUMNS = ["Occurrences", "ABVariant", "Page_List"]
+
+DEFAULT_VARIANTS = ("A", "B", "C")
+
+# what each report counts the occurrences of, and the name of its column
+KINDS = {"journey": "Page_List", "page": "pagePath"}
+
+
+def hash_strings(values):
+    """A 64-bit hash of each string, as journey_keys hashes journeys."""
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+class HeavyHitters:
+    """
+    A bounded summary of the most frequent keys in a stream of weighted
+    items, e.g. journeys weighted by Occurrences, after SpaceSaving.
+
+    At most capacity keys are kept, each with a count that is at least its
+    true total and a count - error that is at most its true total. Any key
+    not kept has a true total of at most floor. Summaries of different
+    chunks, days or processes can be merged, and the bounds still hold for
+    the merged stream, so memory is fixed however many days are summarised.
+    """
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.table = pd.DataFrame(
+            {"count": pd.Series([], dtype=np.int64),
+             "error": pd.Series([], dtype=np.int64),
+             "label": pd.Series([], dtype=object)},
+            index=pd.Index([], dtype=np.uint64))
+        self.floor = 0
+        self.total = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def _truncate(self):
+        """Keep the capacity largest counts, raising floor to the largest dropped."""
+        if len(self.table) > self.capacity:
+            table = self.table.sort_values("count", ascending=False, kind="stable")
+            self.floor = max(self.floor, int(table["count"].iloc[self.capacity]))
+            self.table = table.iloc[:self.capacity]
+
+    def update(self, keys, weights, labels):
+        """
+        Add a chunk of items.
+
+        Parameters:
+            keys (array like): uint64 key of each item.
+            weights (array like): weight of each item, e.g. Occurrences.
+            labels (array like): what to show for each key in a report.
+        """
+        chunk = pd.DataFrame({"count": np.asarray(weights, dtype=np.int64),
+                              "label": labels},
+                             index=pd.Index(np.asarray(keys, dtype=np.uint64)))
+        chunk = chunk.groupby(level=0, sort=False).agg(
+            count=("count", "sum"), label=("label", "first"))
+        summary = HeavyHitters(self.capacity)
+        summary.table = chunk.assign(error=np.int64(0))[["count", "error", "label"]]
+        summary.total = int(chunk["count"].sum())
+        summary._truncate()
+        return self.merge(summary)
+
+    def merge(self, other):
+        """
+        Add another summary to this one.
+
+        A key missing from a summary could have had up to its floor, so it
+        counts as floor, with an error of floor.
+        """
+        keys = self.table.index.union(other.table.index)
+        mine = self.table.reindex(keys)
+        theirs = other.table.reindex(keys)
+        self.table = pd.DataFrame({
+            "count": (mine["count"].fillna(self.floor)
+                      + theirs["count"].fillna(other.floor)).astype(np.int64),
+            "error": (mine["error"].fillna(self.floor)
+                      + theirs["error"].fillna(other.floor)).astype(np.int64),
+            "label": mine["label"].combine_first(theirs["label"]),
+        }, index=keys)
+        self.floor += other.floor
+        self.total += other.total
+        self._truncate()
+        return self
+
+    def top(self, k=100):
+        """
+        The k keys with the largest counts.
+
+        Returns:
+           pandas.core.frame.DataFrame: label, Upper and Lower bounds on the
+           total of each key, the Share of the stream's total weight of
+           Upper, and Guaranteed, whether the key is certainly among the true
+           top k, i.e. its Lower bound is at least the Upper bound of every
+           key not listed.
+        """
+        table = self.table.sort_values("count", ascending=False, kind="stable")
+        top = table.iloc[:k]
+        # the most any key not listed could have
+        unlisted = max([self.floor] + table["count"].iloc[k:k + 1].tolist())
+        lower = top["count"] - top["error"]
+        return pd.DataFrame({
+            "Rank": np.arange(1, len(top) + 1),
+            "label": top["label"].values,
+            "Upper": top["count"].values,
+            "Lower": lower.values,
+            "Share": (top["count"] / self.total).values if self.total else np.nan,
+            "Guaranteed": (lower >= unlisted).values,
+        })
+
+
+def summarise_file(filepath, variants, capacity=10000, chunksize=100000):
+    """
+    HeavyHitters of the journeys and of the page views of each variant in a
+    journey file, reading it a chunk at a time.
+
+    A journey is its Page_List, weighted by Occurrences, and each page view
+    in it is weighted by the journey's Occurrences.
+
+    Returns:
+       dict: (kind in KINDS, variant) to HeavyHitters.
+    """
+    logger.info(f"Summarising {filepath}...")
+    summaries = {(kind, variant): HeavyHitters(capacity)
+                 for kind in KINDS for variant in variants}
+    for df in iter_journeys(filepath, usecols=REQUIRED_COLUMNS,
+                            chunksize=chunksize):
+        # filter out any weird values like Object object
+        df = df[df["ABVariant"].isin(variants)]
+        page_lists = df["Page_List"].values
+        pages = df["Page_List"].map(ast.literal_eval)
+        lengths = pages.map(len).values
+        pages = np.array(list(chain.from_iterable(pages)), dtype=object)
+        page_variants = np.repeat(df["ABVariant"].values, lengths)
+        page_occurrences = np.repeat(df["Occurrences"].values, lengths)
+        for variant in variants:
+            rows = (df["ABVariant"] == variant).values
+            summaries["journey", variant].update(
+                hash_strings(page_lists[rows]), df["Occurrences"].values[rows],
+                page_lists[rows])
+            rows = page_variants == variant
+            summaries["page", variant].update(
+                hash_strings(pages[rows]), page_occurrences[rows], pages[rows])
+    return summaries
+
+
+def _summarise_file(args):
+    """summarise_file for a process pool, taking a tuple of its arguments."""
+    return summarise_file(*args)
+
+
+def summarise_files(filepath_list, variants, capacity=10000, chunksize=100000,
+                    workers=None):
+    """
+    summarise_file for many files, one process per file, merged.
+
+    Each file's summaries are merged in as they arrive, in file order, with
+    at most one file per worker in flight, so only that many summaries and
+    the running total are ever held, however many files there are.
+    """
+    tasks = [(filepath, variants, capacity, chunksize)
+             for filepath in filepath_list]
+    summaries = None
+    if len(tasks) > 1 and workers != 1:
+        window = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for task in tasks:
+                pending.append(executor.submit(_summarise_file, task))
+                if len(pending) >= window:
+                    summaries = merge_summaries(
+                        summaries, pending.popleft().result())
+            while pending:
+                summaries = merge_summaries(
+                    summaries, pending.popleft().result())
+    else:
+        for task in tasks:
+            summaries = merge_summaries(summaries, _summarise_file(task))
+    return summaries
+
+
+def merge_summaries(summaries, other):
+    """Merge two dicts of HeavyHitters from summarise_file."""
+    if summaries is None:
+        return other
+    for key, summary in other.items():
+        summaries[key].merge(summary)
+    return summaries
+
+
+def top_k_report(summaries, kind, k=100):
+    """
+    The top k of kind, e.g. journey, for each variant.
+
+    Returns:
+       pandas.core.frame.DataFrame: ABVariant followed by the columns of
+       HeavyHitters.top, with label named after kind.
+    """
+    reports = []
+    for (summary_kind, variant), summary in summaries.items():
+        if summary_kind == kind:
+            reports.append(summary.top(k).assign(ABVariant=variant))
+    df = pd.concat(reports, ignore_index=True).rename(
+        columns={"label": KINDS[kind]})
+    return df[["ABVariant"] + [c for c in df.columns if c != "ABVariant"]]
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Report the most common journeys and pages of each '
+                    'variant across every day of a test, in fixed memory',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filename_prefix', help='''
+        Prefix of the journey files to summarise. We will read from the
+        processed_journey directory (or --input_dir) in DATA_DIR, and write
+        topjourneys_<<filename_prefix>>.csv.gz and
+        toppages_<<filename_prefix>>.csv.gz to the
+        rl_sampled_processed_journey directory in DATA_DIR.
+        ''')
+    parser.add_argument(
+        '--input_dir', default="processed_journey",
+        help='directory in DATA_DIR to read, e.g. sampled_journey')
+    parser.add_argument(
+        '--variants', nargs='+', default=list(DEFAULT_VARIANTS),
+        help='variants to report, any other ABVariant values are dropped')
+    parser.add_argument(
+        '--k', default=100, type=int,
+        help='number of journeys and pages to report per variant')
+    parser.add_argument(
+        '--capacity', default=10000, type=int, help='''
+        number of journeys (and of pages) kept per variant while reading,
+        the larger it is compared to k the tighter the bounds
+        ''')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='number of processes, all cores if not given')
+    parser.add_argument(
+        '--chunksize', default=100000, type=int,
+        help='number of journeys to read at a time')
+    parser.add_argument(
+        '--output_format', default="csv", choices=list(OUTPUT_CODECS),
+        help='format of the report files')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('heavy_hitters')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+
+    filepath_list = list_journey_files(
+        os.path.join(DATA_DIR, args.input_dir), args.filename_prefix)
+    logger.info(f"work with files {filepath_list}")
+    summaries = summarise_files(
+        filepath_list, args.variants, capacity=args.capacity,
+        chunksize=args.chunksize, workers=args.workers)
+
+    codec = OUTPUT_CODECS[args.output_format][0]
+    for name, kind in [("topjourneys_", "journey"), ("toppages_", "page")]:
+        df_top = top_k_report(summaries, kind, k=args.k)
+        logger.info(f"{df_top['Guaranteed'].sum()} of {len(df_top)} top "
+                    f"{kind}s are certainly in their variant's top {args.k}")
+        out_path = os.path.join(
+            DATA_DIR, "rl_sampled_processed_journey",
+            name + args.filename_prefix
+            + output_extension(args.output_format, codec))
+        logger.info(f"Saving to {out_path}")
+        write_journeys(df_top, out_path, output_format=args.output_format,
+                       codec=codec, sep=",")
@@ -0,0 +1,303 @@
+import os
+import sys
+import argparse
+import logging.config
+from concurrent.futures import ProcessPoolExecutor
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+    from scipy import stats
+except ImportError:
+    logging.error("Missing pandas, numpy and/or scipy library")
+    sys.exit()
+
+from journey_io import read_journeys, strip_journey_extension, write_journeys
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('its')
+
+# the segmented regression terms, as in the 2021 R notebook:
+# value ~ Time + Intervention + TimeSince + harmonic(date, 2, 7)
+SEGMENT_TERMS = ["Intercept", "Time", "Intervention", "TimeSince"]
+
+
+def design_matrix(dates, intervention_date, harmonics=2, period=7):
+    """
+    Build the segmented regression design matrix shared by every series.
+
+    Time counts days from the start of the series, Intervention is 0 up to and
+    including intervention_date and 1 after it, and TimeSince counts the days
+    after the intervention. Seasonality is modelled with Fourier terms, like
+    tsModel::harmonic(date, harmonics, period) in R.
+
+    Parameters:
+        dates (pandas.DatetimeIndex): the dates of the series, sorted, with any
+            excluded dates already removed.
+        intervention_date (str): the last date before the intervention.
+        harmonics (int): number of sine and cosine pairs, 0 for none.
+        period (int): the period of the seasonality in days, 7 for weekly.
+
+    Returns:
+       (numpy.ndarray, list): the T x k design matrix and its column names.
+    """
+    dates = pd.DatetimeIndex(dates)
+    time = np.arange(1, len(dates) + 1)
+    intervention = (dates > pd.Timestamp(intervention_date)).astype(float)
+    time_since = np.cumsum(intervention)
+    columns = [np.ones(len(dates)), time, intervention, time_since]
+    names = list(SEGMENT_TERMS)
+
+    # days since the epoch, so the phase doesn't depend on the start date
+    days = (dates - pd.Timestamp("1970-01-01")).days.values
+    for k in range(1, harmonics + 1):
+        columns.append(np.sin(2 * np.pi * k * days / period))
+        columns.append(np.cos(2 * np.pi * k * days / period))
+        names += [f"sin{k}_{period}", f"cos{k}_{period}"]
+    return np.column_stack(columns).astype(float), names
+
+
+def default_maxlags(n_obs):
+    """Newey-West rule of thumb for the number of lags, floor(4(T/100)^(2/9))."""
+    return int(np.floor(4 * (n_obs / 100) ** (2 / 9)))
+
+
+def fit_segmented_regressions(X, Y, maxlags=None):
+    """
+    Fit the same least squares regression to every column of Y at once, with
+    Newey-West (Bartlett kernel, HAC) standard errors.
+
+    All the series share X, so the coefficients are one solve against the
+    T x S matrix Y, and the Newey-West covariance is built for every series
+    together with array operations. This matches statsmodels
+    OLS(...).fit(cov_type='HAC', cov_kwds={'maxlags': maxlags}), and R's
+    sandwich::NeweyWest with a fixed lag, no prewhitening and no adjustment.
+
+    Parameters:
+        X (numpy.ndarray): T x k design matrix, from design_matrix.
+        Y (numpy.ndarray): T x S matrix, one series per column.
+        maxlags (int): autocorrelation lags to allow for, defaults to
+            default_maxlags(T).
+
+    Returns:
+       (numpy.ndarray, numpy.ndarray): S x k coefficients and S x k standard
+       errors.
+    """
+    n_obs, n_terms = X.shape
+    if maxlags is None:
+        maxlags = default_maxlags(n_obs)
+
+    xtx_inv = np.linalg.inv(X.T @ X)
+    beta = xtx_inv @ X.T @ Y
+    residuals = Y - X @ beta
+
+    # scores x_t * e_t, T x k x S
+    scores = X[:, :, None] * residuals[:, None, :]
+    meat = np.einsum('tis,tjs->sij', scores, scores)
+    for lag in range(1, maxlags + 1):
+        weight = 1 - lag / (maxlags + 1)
+        gamma = np.einsum('tis,tjs->sij', scores[lag:], scores[:-lag])
+        meat += weight * (gamma + gamma.transpose(0, 2, 1))
+
+    cov = np.einsum('ij,sjk,kl->sil', xtx_inv, meat, xtx_inv)
+    std_err = np.sqrt(np.einsum('sii->si', cov))
+    return beta.T, std_err
+
+
+def _fit_chunk(args):
+    """Unpack arguments for fit_segmented_regressions in a worker process."""
+    return fit_segmented_regressions(*args)
+
+
+def wide_series(df, date_col, series_cols, value_col, exclude_dates=None):
+    """
+    Pivot a tidy table of daily values to one column per series, dropping
+    excluded dates and any series with missing days.
+
+    Returns:
+       pandas.core.frame.DataFrame: dates x series, indexed by date with
+       series_cols as the column levels.
+    """
+    df = df.copy()
+    df[date_col] = pd.to_datetime(df[date_col])
+    if exclude_dates:
+        df = df[~df[date_col].isin(pd.to_datetime(exclude_dates))]
+
+    wide = df.pivot_table(index=date_col, columns=series_cols,
+                          values=value_col, aggfunc="sum").sort_index()
+    incomplete = wide.isna().any()
+    if incomplete.any():
+        logger.warning(f"dropping {incomplete.sum()} of {len(incomplete)} "
+                       f"series with missing days")
+        wide = wide.loc[:, ~incomplete]
+    return wide
+
+
+def difference_from_control(df, group_col, value_col,
+                            intervention="intervention", control="control"):
+    """
+    Subtract the control series from the intervention series, date by date,
+    for a controlled interrupted time series (CITS) analysis.
+
+    Returns:
+       pandas.core.frame.DataFrame: the tidy table with one value per series
+       and date, the intervention minus control difference.
+    """
+    keys = [col for col in df.columns
+            if col not in (group_col, value_col)]
+    wide = df.pivot_table(index=keys, columns=group_col, values=value_col,
+                          aggfunc="sum")
+    diff = (wide[intervention] - wide[control]).rename(value_col)
+    return diff.dropna().reset_index()
+
+
+def interrupted_time_series(df, intervention_date, date_col="date",
+                            series_cols=("metric",), value_col="value",
+                            exclude_dates=None, harmonics=2, period=7,
+                            maxlags=None, alpha=0.05, workers=None,
+                            chunksize=5000):
+    """
+    Segmented regressions for many series at once, e.g. each metric for each
+    page, returning one tidy table of coefficients.
+
+    Parameters:
+        df (pandas.core.frame.DataFrame): tidy daily values, one row per date
+            and series.
+        intervention_date (str): the last date before the intervention.
+        date_col (str): column of dates.
+        series_cols (list): columns identifying a series, e.g. page and metric.
+        value_col (str): column of values to model.
+        exclude_dates (list): dates to drop, e.g. a day the intervention was
+            only partly live.
+        harmonics (int): number of Fourier pairs for seasonality.
+        period (int): the period of the seasonality in days.
+        maxlags (int): Newey-West lags, see default_maxlags.
+        alpha (float): the false positive rate, for the confidence intervals.
+        workers (int): number of processes, all cores if None.
+        chunksize (int): number of series per process.
+
+    Returns:
+       pandas.core.frame.DataFrame: one row per series and term with estimate,
+       std_err, t, p-value, ci_low, ci_upp and n_obs.
+    """
+    series_cols = list(series_cols)
+    wide = wide_series(df, date_col, series_cols, value_col,
+                       exclude_dates=exclude_dates)
+    X, names = design_matrix(wide.index, intervention_date,
+                             harmonics=harmonics, period=period)
+    Y = wide.values.astype(float)
+    n_obs, n_terms = X.shape
+    if maxlags is None:
+        maxlags = default_maxlags(n_obs)
+    logger.info(f"fitting {Y.shape[1]} series of {n_obs} days, "
+                f"{n_terms} terms, {maxlags} Newey-West lags")
+
+    chunks = [(X, Y[:, i:i + chunksize], maxlags)
+              for i in range(0, Y.shape[1], chunksize)]
+    if len(chunks) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_fit_chunk, chunks))
+    else:
+        results = [_fit_chunk(chunk) for chunk in chunks]
+    beta = np.concatenate([result[0] for result in results])
+    std_err = np.concatenate([result[1] for result in results])
+
+    # t distribution with residual degrees of freedom, as coeftest does for lm
+    dof = n_obs - n_terms
+    t_stat = beta / std_err
+    p_value = 2 * stats.t.sf(np.abs(t_stat), dof)
+    t_critical = stats.t.ppf(1 - 0.5 * alpha, dof)
+
+    series_index = wide.columns.to_frame(index=False)
+    results_df = pd.DataFrame({
+        "term": np.tile(names, len(series_index)),
+        "estimate": beta.ravel(),
+        "std_err": std_err.ravel(),
+        "t": t_stat.ravel(),
+        "p-value": p_value.ravel(),
+        "ci_low": (beta - t_critical * std_err).ravel(),
+        "ci_upp": (beta + t_critical * std_err).ravel(),
+        "n_obs": n_obs
+    })
+    series_df = series_index.loc[
+        series_index.index.repeat(n_terms)].reset_index(drop=True)
+    return pd.concat([series_df, results_df], axis=1)
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Interrupted time series analysis of many daily series '
+                    'at once',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filepath', help='''
+        Tidy table of daily values, one row per date and series, in any
+        format journey_io reads (e.g. a .csv.gz of the BigQuery metrics,
+        with a column per page and metric).
+        ''')
+    parser.add_argument(
+        'intervention_date', help='''
+        The last date before the intervention, e.g. 2021-11-20
+        ''')
+    parser.add_argument(
+        '--series_cols', nargs='+', default=["metric"], help='''
+        columns that identify a series, e.g. --series_cols pagePath metric
+        ''')
+    parser.add_argument('--date_col', default="date", help='column of dates')
+    parser.add_argument('--value_col', default="value",
+                        help='column of values to model')
+    parser.add_argument(
+        '--group_col', default=None, help='''
+        column with 'intervention' and 'control' values, if given the control
+        series is subtracted from the intervention series (CITS)
+        ''')
+    parser.add_argument(
+        '--exclude_dates', nargs='*', default=[], help='''
+        dates to leave out, e.g. when the intervention was only partly live
+        ''')
+    parser.add_argument('--harmonics', default=2, type=int,
+                        help='number of Fourier pairs for seasonality')
+    parser.add_argument('--period', default=7, type=int,
+                        help='period of the seasonality in days')
+    parser.add_argument('--maxlags', default=None, type=int,
+                        help='Newey-West lags, floor(4(T/100)^(2/9)) if not given')
+    parser.add_argument('--alpha', default=0.01, type=float,
+                        help='the false positive rate')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='number of processes, all cores if not given')
+    parser.add_argument('--sep', default="\t",
+                        help='field separator, if filepath is a csv')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('its')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    REPORTS_DIR = os.getenv("REPORTS_DIR")
+
+    logger.info(f"Reading in {args.filepath}")
+    df = read_journeys(args.filepath, sep=args.sep)
+    if args.group_col is not None:
+        logger.info("Subtracting control series from intervention series")
+        df = difference_from_control(
+            df, args.group_col, args.value_col)
+
+    df_its = interrupted_time_series(
+        df, args.intervention_date, date_col=args.date_col,
+        series_cols=args.series_cols, value_col=args.value_col,
+        exclude_dates=args.exclude_dates, harmonics=args.harmonics,
+        period=args.period, maxlags=args.maxlags, alpha=args.alpha,
+        workers=args.workers)
+
+    out_path = os.path.join(
+        REPORTS_DIR,
+        "its_" + strip_journey_extension(os.path.basename(args.filepath))
+        + ".csv.gz")
+    logger.info(f"Saving to {out_path}")
+    write_journeys(df_its, out_path, sep=",")
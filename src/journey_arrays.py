@@ -0,0 +1,495 @@
+import os
+import ast
+import sys
+import json
+import argparse
+import logging.config
+from itertools import chain
+from operator import itemgetter
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+except ImportError:
+    logging.error("Missing pandas and/or numpy library")
+    sys.exit()
+
+from journey_io import ARRAYS_EXTENSION, read_journeys, strip_journey_extension
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('journey_arrays')
+
+# columns of a processed journey file, in order
+REQUIRED_COLUMNS = ["Occurrences", "ABVariant", "Page_Event_List",
+                    "Page_List", "Event_cat_act_agg"]
+
+# the flat arrays each list column is stored as, besides its offsets: page
+# ids index the pages vocabulary, event ids the (category, action) events
+LIST_COLUMNS = {
+    "Page_List": ["page_ids"],
+    "Page_Event_List": ["page_ids", "event_ids"],
+    "Event_cat_act_agg": ["event_ids", "counts"],
+}
+
+ARRAY_DTYPES = {"page_ids": np.int32, "event_ids": np.int32,
+                "counts": np.int64}
+
+# the stratum of journeys from a single file, without --strata
+DEFAULT_STRATUM = "all"
+
+
+def array_name(column, name):
+    """The name of an array of a list column, e.g. page_list_page_ids, saved as page_list_page_ids.npy."""
+    return f"{column.lower()}_{name}"
+
+
+def is_journey_arrays(path):
+    """Is path a directory of journey arrays written by write_journey_arrays?"""
+    return os.path.isfile(os.path.join(path, "meta.json"))
+
+
+def segment_sums(values, starts, stops):
+    """Sum values[start:stop] for each start and stop, empty segments summing to 0."""
+    cumulative = np.zeros(len(values) + 1, dtype=np.result_type(values, np.int64))
+    np.cumsum(values, out=cumulative[1:])
+    return cumulative[stops] - cumulative[starts]
+
+
+class _Vocabulary(dict):
+    """A dict of item to id, giving each new item looked up the next id."""
+
+    def __missing__(self, item):
+        self[item] = len(self)
+        return self[item]
+
+    def encode(self, items, count=-1):
+        """The int64 id of each item, adding any new items, count the number of items if known."""
+        return np.fromiter(map(self.__getitem__, items), np.int64, count)
+
+
+def _parse(series):
+    """The lists of a list column, parsing them if they are the strings read from file."""
+    if len(series) and isinstance(series.iloc[0], str):
+        return series.map(ast.literal_eval)
+    return series
+
+
+def write_journey_arrays(frames, path):
+    """
+    Write processed journeys as flat arrays to the directory path, so they
+    can be opened memory-mapped by open_journey_arrays.
+
+    Each list column is stored as an offsets array, the start of each
+    journey's list, followed by the end of the last, and flat arrays of the
+    ids of every page and event in every list. Pages and (category, action)
+    events are stored once each, in pages.json and events.json. The journeys
+    are sorted by stratum and then variant, so every stratum, and every
+    variant within a stratum, is a contiguous run of rows.
+
+    This parses the list columns once, so nothing reading the arrays has to.
+
+    Parameters:
+        frames (dict): stratum name, e.g. loved or unloved, to a DataFrame of
+            processed journeys with REQUIRED_COLUMNS, the list columns either
+            as the strings read from file or already parsed.
+        path (str): the directory to write, conventionally ending in
+            ARRAYS_EXTENSION.
+    """
+    strata = list(frames)
+    df = pd.concat([frame[REQUIRED_COLUMNS].assign(Stratum=i)
+                    for i, frame in enumerate(frames.values())],
+                   ignore_index=True)
+    variants = sorted(df['ABVariant'].astype(str).unique())
+    variant_codes = pd.Categorical(df['ABVariant'].astype(str),
+                                   categories=variants).codes
+    stratum_codes = df['Stratum'].values
+    order = np.lexsort((variant_codes, stratum_codes))
+    df = df.iloc[order].reset_index(drop=True)
+    variant_codes = variant_codes[order]
+    stratum_codes = stratum_codes[order]
+
+    os.makedirs(path, exist_ok=True)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    pages, events = _Vocabulary(), _Vocabulary()
+    for column in LIST_COLUMNS:
+        logger.debug(f"Flattening {column}...")
+        lists = _parse(df[column])
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lists.map(len).values, out=offsets[1:])
+        flat = list(chain.from_iterable(lists))
+        if column == "Page_List":
+            arrays = {"page_ids": pages.encode(flat, len(flat))}
+        elif column == "Page_Event_List":
+            arrays = {"page_ids": pages.encode((page for page, _ in flat), len(flat)),
+                      "event_ids": events.encode((tuple(event) for _, event in flat),
+                                                 len(flat))}
+        else:
+            arrays = {"event_ids": events.encode((tuple(event) for event, _ in flat),
+                                                 len(flat)),
+                      "counts": [count for _, count in flat]}
+        np.save(os.path.join(path, array_name(column, "offsets") + ".npy"), offsets)
+        for name, values in arrays.items():
+            np.save(os.path.join(path, array_name(column, name) + ".npy"),
+                    np.array(values, dtype=ARRAY_DTYPES[name]))
+
+    np.save(os.path.join(path, "occurrences.npy"),
+            df['Occurrences'].values.astype(np.int64))
+    np.save(os.path.join(path, "variant_codes.npy"),
+            variant_codes.astype(np.int8))
+    np.save(os.path.join(path, "stratum_codes.npy"),
+            stratum_codes.astype(np.int16))
+    with open(os.path.join(path, "pages.json"), "w") as f:
+        json.dump(list(pages), f)
+    with open(os.path.join(path, "events.json"), "w") as f:
+        json.dump(list(events), f)
+
+    # the rows of each stratum and variant, as [start, stop)
+    groups = df.groupby([stratum_codes, variant_codes]).size()
+    stops = np.cumsum(groups.values)
+    meta = {
+        "strata": strata,
+        "variants": variants,
+        "groups": [[strata[s], variants[v], int(stop - size), int(stop)]
+                   for (s, v), size, stop in zip(groups.index, groups.values,
+                                                  stops)],
+    }
+    # written last, so a half written directory isn't mistaken for arrays
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=1)
+    logger.info(f"Wrote {len(df)} journeys, {len(pages)} pages and "
+                f"{len(events)} events to {path}")
+
+
+class JourneyArrays:
+    """
+    Processed journeys, memory-mapped from the flat arrays written by
+    write_journey_arrays.
+
+    Opening only reads the small metadata, the operating system pages the
+    arrays in as they are used and shares those pages between every process
+    that opens the same directory. A selection of one stratum, or of one
+    variant within a stratum, slices every array without copying it, and
+    pickles as the path and selection, so passing one to a worker process
+    doesn't copy the arrays either.
+    """
+
+    def __init__(self, path, rows=None):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.variants = self.meta["variants"]
+        self.strata = self.meta["strata"]
+        self._arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+            for name in ["occurrences", "variant_codes", "stratum_codes"]}
+        for column, names in LIST_COLUMNS.items():
+            for name in ["offsets"] + names:
+                name = array_name(column, name)
+                self._arrays[name] = np.load(
+                    os.path.join(path, f"{name}.npy"), mmap_mode='r')
+        n = len(self._arrays["occurrences"])
+        # a slice of contiguous rows, or an array of row numbers
+        self.rows = slice(0, n) if rows is None else rows
+        self._pages = None
+        self._events = None
+
+    def __getstate__(self):
+        return {"path": self.path, "rows": self.rows}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["rows"])
+
+    def _with_rows(self, rows):
+        """The same arrays, with a different selection of rows."""
+        # not copy.copy, which would reopen the arrays through __setstate__
+        selection = object.__new__(JourneyArrays)
+        selection.__dict__.update(self.__dict__, rows=rows)
+        return selection
+
+    def __len__(self):
+        if isinstance(self.rows, slice):
+            return self.rows.stop - self.rows.start
+        return len(self.rows)
+
+    @property
+    def pages(self):
+        """The page paths page ids index, as an object array."""
+        if self._pages is None:
+            with open(os.path.join(self.path, "pages.json")) as f:
+                self._pages = np.array(json.load(f), dtype=object)
+        return self._pages
+
+    @property
+    def events(self):
+        """The (category, action) tuples event ids index, as a list."""
+        if self._events is None:
+            with open(os.path.join(self.path, "events.json")) as f:
+                self._events = [tuple(event) for event in json.load(f)]
+        return self._events
+
+    def _rows_of(self, name):
+        return self._arrays[name][self.rows]
+
+    @property
+    def occurrences(self):
+        return self._rows_of("occurrences")
+
+    @property
+    def variant_codes(self):
+        return self._rows_of("variant_codes")
+
+    @property
+    def stratum_codes(self):
+        return self._rows_of("stratum_codes")
+
+    def ab_variants(self):
+        """The ABVariant of each selected journey, as a Categorical."""
+        return pd.Categorical.from_codes(self.variant_codes,
+                                         categories=self.variants)
+
+    def select(self, stratum=None, variant=None):
+        """
+        The journeys of a stratum and/or variant.
+
+        A stratum, or a variant within a stratum, or a variant when there is
+        only one stratum, is a contiguous run of rows, and the selection is a
+        view of the arrays. A variant across several strata gathers a row
+        number for each of its journeys, the pages and events are still not
+        copied.
+        """
+        if stratum is not None and stratum not in self.strata:
+            raise ValueError(f"{stratum} is not one of the strata {self.strata}")
+        if variant is not None and variant not in self.variants:
+            raise ValueError(f"{variant} is not one of the variants {self.variants}")
+        runs = [(start, stop) for group_stratum, group_variant, start, stop
+                in self.meta["groups"]
+                if stratum in (None, group_stratum)
+                and variant in (None, group_variant)]
+        if isinstance(self.rows, slice):
+            runs = [(max(start, self.rows.start), min(stop, self.rows.stop))
+                    for start, stop in runs]
+            runs = [(start, stop) for start, stop in runs if start < stop]
+            if not runs:
+                return self._with_rows(slice(0, 0))
+            if all(stop == next_start for (_, stop), (next_start, _)
+                   in zip(runs, runs[1:])):
+                return self._with_rows(slice(runs[0][0], runs[-1][1]))
+            rows = np.concatenate([np.arange(start, stop)
+                                   for start, stop in runs])
+        else:
+            in_runs = np.zeros(len(self.rows), dtype=bool)
+            for start, stop in runs:
+                in_runs |= (self.rows >= start) & (self.rows < stop)
+            rows = self.rows[in_runs]
+        return self._with_rows(rows)
+
+    def list_column(self, column):
+        """
+        The flat arrays of a list column for the selected journeys, and where
+        each journey's list starts and stops in them.
+
+        For a contiguous selection the flat arrays are views of just the part
+        of the memory-mapped arrays the selection covers.
+
+        Returns:
+           (dict, numpy.ndarray, numpy.ndarray): name in LIST_COLUMNS[column]
+           to flat array, and the start and stop of each journey's list.
+        """
+        offsets = self._arrays[array_name(column, "offsets")]
+        if isinstance(self.rows, slice):
+            starts = offsets[self.rows.start:self.rows.stop]
+            stops = offsets[self.rows.start + 1:self.rows.stop + 1]
+        else:
+            starts = offsets[self.rows]
+            stops = offsets[self.rows + 1]
+        low = int(starts.min()) if len(starts) else 0
+        high = int(stops.max()) if len(stops) else 0
+        arrays = {name: self._arrays[array_name(column, name)][low:high]
+                  for name in LIST_COLUMNS[column]}
+        return arrays, starts - low, stops - low
+
+    def page_list_lengths(self):
+        """The number of pages in each selected journey's Page_List."""
+        _, starts, stops = self.list_column("Page_List")
+        return stops - starts
+
+    def to_frame(self):
+        """
+        The selected journeys in the processed journey format, with the list
+        columns as lists, as the notebooks have them after
+        ast.literal_eval, but without parsing anything.
+        """
+        pages, events = self.pages, self.events
+        event_objects = np.empty(len(events), dtype=object)
+        event_objects[:] = events
+
+        def split(flat, starts, stops):
+            return [flat[start:stop].tolist() for start, stop in zip(starts, stops)]
+
+        df = pd.DataFrame({
+            "Occurrences": np.asarray(self.occurrences),
+            "ABVariant": np.array(self.variants, dtype=object)[self.variant_codes],
+        })
+
+        arrays, starts, stops = self.list_column("Page_Event_List")
+        pairs = np.empty(len(arrays["page_ids"]), dtype=object)
+        pairs[:] = list(zip(pages[arrays["page_ids"]],
+                            event_objects[arrays["event_ids"]]))
+        df["Page_Event_List"] = split(pairs, starts, stops)
+
+        arrays, starts, stops = self.list_column("Page_List")
+        df["Page_List"] = split(pages[arrays["page_ids"]], starts, stops)
+
+        arrays, starts, stops = self.list_column("Event_cat_act_agg")
+        pairs = np.empty(len(arrays["event_ids"]), dtype=object)
+        pairs[:] = list(zip(event_objects[arrays["event_ids"]],
+                            arrays["counts"].tolist()))
+        df["Event_cat_act_agg"] = split(pairs, starts, stops)
+        return df
+
+
+class EventArrays:
+    """
+    The events of a list column, Event_cat_act_agg or Page_Event_List,
+    dictionary encoded: the id of each event's (category, action) pair in
+    events, and its count, or for Page_Event_List its page id.
+
+    A predicate of an event is evaluated once per distinct (category,
+    action) pair, not once per event, and looked up by id for every event.
+    """
+
+    def __init__(self, event_ids, starts, stops, events, counts=None,
+                 page_ids=None, pages=None):
+        self.event_ids = event_ids
+        self.starts = starts
+        self.stops = stops
+        self.events = events
+        # Page_Event_List has one event per element, Event_cat_act_agg a count
+        self.counts = (np.ones(len(event_ids), dtype=np.int64)
+                       if counts is None else counts)
+        self.page_ids = page_ids
+        self.pages = pages
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    def evaluate(self, predicate):
+        """predicate of each distinct (category, action) pair, indexed by event id."""
+        return np.array([predicate(event) for event in self.events], dtype=np.int64)
+
+    def count(self, predicate):
+        """
+        The events each journey has for which predicate((category, action))
+        is true, adding up their counts.
+
+        Returns:
+           numpy.ndarray: int64 counts, one per journey.
+        """
+        matches = self.evaluate(predicate)[self.event_ids] * self.counts
+        return segment_sums(matches, self.starts, self.stops)
+
+
+def event_arrays(journeys, column="Event_cat_act_agg"):
+    """
+    The EventArrays of Event_cat_act_agg or Page_Event_List.
+
+    Parameters:
+        journeys: a DataFrame of processed journeys, with the list column
+            either as the strings read from file or already parsed, or
+            JourneyArrays, whose events are already encoded.
+        column (str): Event_cat_act_agg or Page_Event_List.
+    """
+    if hasattr(journeys, "list_column"):
+        arrays, starts, stops = journeys.list_column(column)
+        return EventArrays(arrays["event_ids"], starts, stops, journeys.events,
+                           counts=arrays.get("counts"),
+                           page_ids=arrays.get("page_ids"),
+                           pages=journeys.pages if "page_ids" in arrays else None)
+    lists = _parse(journeys[column])
+    lengths = np.fromiter(map(len, lists), np.int64, len(lists))
+    stops = np.cumsum(lengths)
+    starts = stops - lengths
+    flat = list(chain.from_iterable(lists))
+
+    def ids(position, vocabulary, convert=None):
+        items = map(itemgetter(position), flat)
+        # events are lists rather than tuples in e.g. journey_sql.py's nested parquet
+        return vocabulary.encode(items if convert is None else map(convert, items), len(flat))
+
+    events = _Vocabulary()
+    if column == "Event_cat_act_agg":
+        event_ids = ids(0, events, tuple)
+        counts = np.fromiter(map(itemgetter(1), flat), np.int64, len(flat))
+        page_ids, pages = None, None
+    else:
+        event_ids = ids(1, events, tuple)
+        counts = None
+        pages = _Vocabulary()
+        page_ids = ids(0, pages)
+        pages = np.array(list(pages), dtype=object)
+    return EventArrays(event_ids, starts, stops, list(events), counts=counts,
+                       page_ids=page_ids, pages=pages)
+
+
+def open_journey_arrays(path):
+    """Open the journey arrays in the directory path, memory-mapped."""
+    return JourneyArrays(path)
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Convert sampled or processed journey files to flat '
+                    'arrays that open memory-mapped in milliseconds',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filenames', nargs='+', help='''
+        Journey files to convert, in any format journey_io can read, e.g. the
+        loved and unloved samples of a test. We will read from the
+        sampled_journey directory from the DATA_DIR specified in your .envrc,
+        unless --input_dir is given.
+        ''')
+    parser.add_argument(
+        '--strata', nargs='+', default=None, help='''
+        A name for the journeys of each file, e.g. loved unloved, defaults to
+        the filenames without extensions, or all for a single file.
+        ''')
+    parser.add_argument(
+        '--output', default=None, help='''
+        Name of the directory to write in the input directory, defaults to the
+        first filename with its extension replaced by .journeys
+        ''')
+    parser.add_argument(
+        '--input_dir', default="sampled_journey",
+        help='directory in DATA_DIR to read from and write to')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('journey_arrays')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+    input_dir = os.path.join(DATA_DIR, args.input_dir)
+
+    strata = args.strata
+    if strata is None:
+        strata = ([DEFAULT_STRATUM] if len(args.filenames) == 1 else
+                  [strip_journey_extension(filename) for filename in args.filenames])
+    if len(strata) != len(args.filenames):
+        parser.error("give one stratum per filename")
+
+    frames = {}
+    for stratum, filename in zip(strata, args.filenames):
+        logger.info(f"Reading {filename}...")
+        frames[stratum] = read_journeys(os.path.join(input_dir, filename),
+                                        usecols=REQUIRED_COLUMNS)
+
+    output = args.output or strip_journey_extension(args.filenames[0]) + ARRAYS_EXTENSION
+    write_journey_arrays(frames, os.path.join(input_dir, output))
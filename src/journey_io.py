@@ -0,0 +1,240 @@
+import os
+import re
+import glob
+import logging
+# .. other safe imports
+try:
+    import pandas as pd
+except ImportError:
+    logging.error("Missing pandas library")
+    raise
+
+# optional codec libraries, only needed when the matching codec is used
+try:
+    # multithreaded gzip, output is plain gzip that any reader can open
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+logger = logging.getLogger('journey_io')
+
+# codecs we can write for each output format, the first is the default
+OUTPUT_CODECS = {
+    "csv": ["gzip", "zstd", "lz4", "none"],
+    "parquet": ["zstd", "snappy", "lz4", "gzip", "none"]
+}
+
+# file extension for each csv codec, parquet files are always .parquet
+CSV_EXTENSIONS = {
+    "gzip": ".csv.gz",
+    "zstd": ".csv.zst",
+    "lz4": ".csv.lz4",
+    "none": ".csv"
+}
+
+JOURNEY_EXTENSIONS = list(CSV_EXTENSIONS.values()) + [".parquet"]
+
+# directories of flat journey arrays written by journey_arrays.py
+ARRAYS_EXTENSION = ".journeys"
+
+# the day a processed journey file is for, e.g. taxon_ab_2019-02-14.csv.gz
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+# leading bytes of each file type, used to detect the format when reading
+MAGIC_BYTES = {
+    b"PAR1": ("parquet", None),
+    b"\x1f\x8b": ("csv", "gzip"),
+    b"\x28\xb5\x2f\xfd": ("csv", "zstd"),
+    b"\x04\x22\x4d\x18": ("csv", "lz4")
+}
+
+
+def output_extension(output_format="csv", codec="gzip"):
+    """
+    Get the file extension for an output format and codec, e.g. '.csv.gz'.
+    """
+    if output_format not in OUTPUT_CODECS:
+        raise ValueError(f"unknown output format {output_format}, "
+                         f"choose one of {list(OUTPUT_CODECS)}")
+    if codec not in OUTPUT_CODECS[output_format]:
+        raise ValueError(f"codec {codec} not supported for {output_format}, "
+                         f"choose one of {OUTPUT_CODECS[output_format]}")
+    if output_format == "parquet":
+        return ".parquet"
+    return CSV_EXTENSIONS[codec]
+
+
+def strip_journey_extension(filename):
+    """
+    Remove any known journey file extension from filename, so that the same
+    name can be written out in a different format.
+    """
+    # longest first so '.csv.gz' wins over '.csv'
+    extensions = JOURNEY_EXTENSIONS + [ARRAYS_EXTENSION]
+    for extension in sorted(extensions, key=len, reverse=True):
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+
+def list_journey_files(directory, filename_prefix, start_date=None,
+                       end_date=None):
+    """
+    Sorted list of journey files in directory beginning with filename_prefix,
+    in any of the formats we can read.
+
+    With start_date and/or end_date, e.g. 2019-02-14, only the files for the
+    days from start_date to end_date, inclusive, by the date in their names.
+    Files without a date in their names are then left out, with a warning,
+    and a ValueError is raised if none of the files have one.
+    """
+    filepath_list = []
+    for extension in JOURNEY_EXTENSIONS:
+        filepath_list.extend(
+            glob.glob(os.path.join(directory, f"{filename_prefix}*{extension}")))
+    if start_date is not None or end_date is not None:
+        undated = [filepath for filepath in filepath_list
+                   if DATE_PATTERN.search(os.path.basename(filepath)) is None]
+        if undated and len(undated) == len(filepath_list):
+            raise ValueError(
+                f"none of the {len(undated)} files starting with "
+                f"{filename_prefix} in {directory} have a YYYY-MM-DD date in "
+                f"their names, so can't be selected from {start_date} to "
+                f"{end_date}")
+        if undated:
+            logger.warning(f"leaving out {len(undated)} files without a "
+                           f"YYYY-MM-DD date in their names: {sorted(undated)}")
+        filepath_list = [
+            filepath for filepath in filepath_list
+            if _in_date_range(os.path.basename(filepath), start_date, end_date)]
+    # '*.csv' doesn't match '*.csv.gz', but be defensive about duplicates
+    return sorted(set(filepath_list))
+
+
+def _in_date_range(filename, start_date=None, end_date=None):
+    """Is the date in filename from start_date to end_date, inclusive?"""
+    match = DATE_PATTERN.search(filename)
+    if match is None:
+        return False
+    date = pd.Timestamp(match.group())
+    return ((start_date is None or date >= pd.Timestamp(start_date))
+            and (end_date is None or date <= pd.Timestamp(end_date)))
+
+
+def detect_format(filepath):
+    """
+    Work out the (format, codec) of a journey file from its first few bytes,
+    rather than trusting its extension.
+    """
+    with open(filepath, "rb") as f:
+        head = f.read(4)
+    for magic, file_format in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return file_format
+    return "csv", "none"
+
+
+def read_journeys(filepath, usecols=None, sep="\t"):
+    """
+    Read a journey file written by write_journeys, or a processed_journey file
+    from the data pipeline, whatever format and codec it is in.
+
+    Parameters:
+        filepath (str): path to the file.
+        usecols (list): columns to read, all columns if None.
+        sep (str): field separator, only used for csv files.
+
+    Returns:
+       pandas.core.frame.DataFrame: the journeys.
+    """
+    file_format, codec = detect_format(filepath)
+    logger.debug(f"{filepath} is {file_format} with codec {codec}")
+    if file_format == "parquet":
+        return pd.read_parquet(filepath, columns=usecols)
+    if codec == "lz4":
+        if lz4_frame is None:
+            raise ImportError("lz4 is needed to read lz4 compressed files")
+        with lz4_frame.open(filepath, "rb") as f:
+            return pd.read_csv(f, sep=sep, usecols=usecols)
+    # pandas handles gzip, zstd and plain csv itself
+    compression = None if codec == "none" else codec
+    return pd.read_csv(filepath, sep=sep, usecols=usecols,
+                       compression=compression)
+
+
+def iter_journeys(filepath, usecols=None, sep="\t", chunksize=100000):
+    """
+    Read a journey file in chunks of at most chunksize rows, so files bigger
+    than memory can be streamed. Accepts the same formats as read_journeys.
+
+    Yields:
+       pandas.core.frame.DataFrame: the next chunk of journeys.
+    """
+    file_format, codec = detect_format(filepath)
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(filepath)
+        for batch in parquet_file.iter_batches(batch_size=chunksize,
+                                               columns=usecols):
+            yield batch.to_pandas()
+        return
+    if codec == "lz4":
+        if lz4_frame is None:
+            raise ImportError("lz4 is needed to read lz4 compressed files")
+        with lz4_frame.open(filepath, "rb") as f:
+            yield from pd.read_csv(f, sep=sep, usecols=usecols,
+                                   chunksize=chunksize)
+        return
+    compression = None if codec == "none" else codec
+    with pd.read_csv(filepath, sep=sep, usecols=usecols,
+                     compression=compression, chunksize=chunksize) as reader:
+        yield from reader
+
+
+def write_journeys(df, out_path, output_format="csv", codec="gzip",
+                   threads=1, sep="\t"):
+    """
+    Write a DataFrame of journeys, or results, in the given format and codec.
+
+    Parameters:
+        df (pandas.core.frame.DataFrame): the data to write.
+        out_path (str): where to write it, use output_extension to get a
+            matching file extension.
+        output_format (str): 'csv' or 'parquet'.
+        codec (str): compression codec, see OUTPUT_CODECS for what each format
+            supports.
+        threads (int): number of compression threads to use, for gzip and
+            zstd csv files, parquet uses pyarrow's own thread pool.
+        sep (str): field separator, only used for csv files.
+
+    Returns:
+       None
+    """
+    # raises if the format and codec don't go together
+    output_extension(output_format, codec)
+    logger.debug(f"writing {out_path} as {output_format} with codec {codec}")
+
+    if output_format == "parquet":
+        df.to_parquet(out_path, compression=None if codec == "none" else codec,
+                      index=False)
+    elif codec == "gzip" and threads > 1:
+        if igzip_threaded is None:
+            raise ImportError("isal is needed for multithreaded gzip")
+        with igzip_threaded.open(out_path, "wb", threads=threads) as f:
+            df.to_csv(f, sep=sep, index=False)
+    elif codec == "gzip":
+        df.to_csv(out_path, sep=sep, compression="gzip", index=False)
+    elif codec == "zstd":
+        df.to_csv(out_path, sep=sep, index=False,
+                  compression={"method": "zstd", "threads": threads})
+    elif codec == "lz4":
+        if lz4_frame is None:
+            raise ImportError("lz4 is needed to write lz4 compressed files")
+        with lz4_frame.open(out_path, "wb") as f:
+            df.to_csv(f, sep=sep, index=False)
+    else:
+        df.to_csv(out_path, sep=sep, index=False)
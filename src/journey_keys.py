@@ -0,0 +1,67 @@
+import logging
+# .. other safe imports
+try:
+    import pandas as pd
+except ImportError:
+    logging.error("Missing pandas library")
+    raise
+
+# name of the 64-bit hash column identifying a journey type
+JOURNEY_KEY = "Journey_Key"
+
+# everything that makes a row of a processed or sampled journey file unique,
+# i.e. everything that isn't Occurrences
+REQUIRED_COLUMNS_WITHOUT_OCC = [
+    "ABVariant", "Page_Event_List", "Page_List",  "Event_cat_act_agg"]
+
+
+def hash_journeys(df, columns=REQUIRED_COLUMNS_WITHOUT_OCC):
+    """
+    A 64-bit hash of each row's columns, to group and merge on instead of the
+    long string columns.
+
+    The hash is deterministic across processes and runs, so keys computed for
+    different files can be compared. With 64 bits a collision is vanishingly
+    unlikely for the tens of millions of journey types we see in a test.
+
+    Parameters:
+        df (pandas.core.frame.DataFrame): journeys, with the columns as the
+            strings read from file.
+        columns (list): the columns that identify a journey.
+
+    Returns:
+       pandas.core.series.Series: uint64 keys, with df's index.
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).rename(
+        JOURNEY_KEY)
+
+
+def add_journey_key(df, columns=REQUIRED_COLUMNS_WITHOUT_OCC):
+    """Add a JOURNEY_KEY column to df, in place, and return df."""
+    df[JOURNEY_KEY] = hash_journeys(df, columns)
+    return df
+
+
+def roll_up(df, occurrences, columns=REQUIRED_COLUMNS_WITHOUT_OCC):
+    """
+    Group journeys by JOURNEY_KEY, keeping the string columns once per key.
+
+    This gives the same rows as
+    df.groupby(columns).sum() (or .count()).reset_index(), in a different
+    order, without grouping on the strings.
+
+    Parameters:
+        df (pandas.core.frame.DataFrame): journeys with a JOURNEY_KEY column,
+            and the columns.
+        occurrences (pandas.core.series.Series): Occurrences of each journey
+            type, indexed by JOURNEY_KEY, e.g. from grouping df by key.
+        columns (list): the string columns to keep.
+
+    Returns:
+       pandas.core.frame.DataFrame: columns followed by Occurrences, one row
+       per key in occurrences.
+    """
+    payload = df.drop_duplicates(JOURNEY_KEY).set_index(JOURNEY_KEY)[columns]
+    rolled_up = payload.loc[occurrences.index]
+    rolled_up["Occurrences"] = occurrences.values
+    return rolled_up.reset_index(drop=True)
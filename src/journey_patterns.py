@@ -0,0 +1,237 @@
+import re
+import logging
+from functools import lru_cache
+from itertools import chain
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+except ImportError:
+    logging.error("Missing pandas and/or numpy library")
+    raise
+
+from journey_arrays import event_arrays, segment_sums
+
+logger = logging.getLogger('journey_patterns')
+
+# ->, brackets, | and & and ! are tokens, as are quoted strings, everything
+# else up to whitespace or one of those is a word
+TOKEN = re.compile(r"""\s*(->|\[|\]|\||&|!|"[^"]*"|'[^']*'|[^\s\[\]|&!"']+)""")
+
+
+def _tokens(text):
+    """Split a pattern into tokens."""
+    text = text.strip()
+    tokens, position = [], 0
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(f"can't parse {text[position:]!r} in pattern {text!r}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def _is_quoted(token):
+    """Is token a quoted string?"""
+    return len(token) > 1 and token[0] == token[-1] and token[0] in "\"'"
+
+
+def _split(tokens, separator, text):
+    """Split tokens on separator, each part must have tokens."""
+    parts = [[]]
+    for token in tokens:
+        if token == separator:
+            parts.append([])
+        else:
+            parts[-1].append(token)
+    if not all(parts):
+        raise ValueError(f"missing a step around {separator!r} in pattern {text!r}")
+    return parts
+
+
+def _page_atom(tokens, text):
+    """A predicate of a page path and the named page sets."""
+    if tokens[0] == "!":
+        atom = _page_atom(tokens[1:], text)
+        return lambda page, page_sets: not atom(page, page_sets)
+    if len(tokens) != 1:
+        raise ValueError(f"expected one page in {' '.join(tokens)!r} in pattern {text!r}")
+    token = tokens[0]
+    if token == "*":
+        return lambda page, page_sets: True
+    if _is_quoted(token) or token.startswith("/"):
+        literal = token[1:-1] if _is_quoted(token) else token
+        return lambda page, page_sets: literal in page
+
+    def in_page_set(page, page_sets):
+        if token not in page_sets:
+            raise ValueError(f"unknown page set {token!r} in pattern {text!r}, "
+                             f"pass it in page_sets")
+        return page in page_sets[token]
+    return in_page_set
+
+
+def _event_atom(tokens, text):
+    """A predicate of a (category, action) event."""
+    if tokens[0] == "!":
+        atom = _event_atom(tokens[1:], text)
+        return lambda event, page_sets: not atom(event, page_sets)
+    terms = _split(tokens, "&", text)
+    if any(len(term) != 1 for term in terms):
+        raise ValueError(f"expected & between the terms of {' '.join(tokens)!r} in pattern {text!r}")
+    terms = [term[0][1:-1] if _is_quoted(term[0]) else term[0] for term in terms]
+    if terms == ["*"]:
+        return lambda event, page_sets: True
+    # as in analysis.is_nav_event, each term is the category or the action
+    return lambda event, page_sets: all(term in event for term in terms)
+
+
+def _alternatives(tokens, atom, text):
+    """The predicates of a step, either one atom or [atom|atom|...]."""
+    if tokens[0] != "[":
+        return [atom(tokens, text)]
+    if tokens[-1] != "]":
+        raise ValueError(f"missing ] in pattern {text!r}")
+    return [atom(part, text) for part in _split(tokens[1:-1], "|", text)]
+
+
+class JourneyPattern:
+    """
+    A pattern over the pages and events of journeys, compiled to numpy.
+
+    Two kinds of pattern are understood:
+
+    - pages in a row of Page_List, steps separated by ->, e.g.
+      thing -> /search?q= matches a search straight after a thing page.
+    - an event in Page_Event_List on a page, e.g.
+      [breadcrumbClicked|homeLinkClicked] on thing.
+
+    A page is a named page set, e.g. thing, passed in page_sets when
+    counting, a path such as /search?q= (or a quoted string) that matches
+    pages containing it, or * for any page. An event is a term that must be
+    its category or action, or several joined by &, e.g.
+    relatedLinkClicked&"Explore the topic", or * for any event. [a|b]
+    matches either a or b, and !a anything but a. Words are separated by
+    whitespace, quote anything with spaces or one of []|&!.
+
+    Each predicate is evaluated once per distinct page and event, then
+    every journey is matched at once.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        tokens = _tokens(text)
+        if not tokens:
+            raise ValueError("empty pattern")
+        if "on" in tokens:
+            on = tokens.index("on")
+            if on == 0 or on == len(tokens) - 1:
+                raise ValueError(f"expected an event and a page around 'on' in pattern {text!r}")
+            self.event = _alternatives(tokens[:on], _event_atom, text)
+            self.steps = [_alternatives(tokens[on + 1:], _page_atom, text)]
+        else:
+            self.event = None
+            self.steps = [_alternatives(step, _page_atom, text)
+                          for step in _split(tokens, "->", text)]
+
+    def __repr__(self):
+        return f"JourneyPattern({self.text!r})"
+
+    @property
+    def column(self):
+        """The list column the pattern matches in."""
+        return "Page_List" if self.event is None else "Page_Event_List"
+
+    def count(self, journeys, page_sets=None):
+        """
+        The number of matches in each journey, overlapping matches each
+        counting.
+
+        Parameters:
+            journeys: a DataFrame of processed journeys with parsed list
+                columns, or journey_arrays.JourneyArrays.
+            page_sets (dict): name to set of page paths, e.g.
+                {'thing': thing_page_paths}.
+
+        Returns:
+           numpy.ndarray: int64 counts, one per journey.
+        """
+        return self._count(_flatten(journeys, self.column), page_sets or {})
+
+    def _count(self, flat, page_sets):
+        arrays, starts, stops, pages, events = flat
+
+        def evaluate(predicates, vocabulary):
+            return np.array([any(predicate(item, page_sets) for predicate in predicates)
+                             for item in vocabulary], dtype=bool)
+
+        if self.event is not None:
+            matches = (evaluate(self.event, events)[arrays["event_ids"]]
+                       & evaluate(self.steps[0], pages)[arrays["page_ids"]])
+            return segment_sums(matches, starts, stops)
+
+        page_ids = arrays["page_ids"]
+        k = len(self.steps)
+        if len(page_ids) < k:
+            return np.zeros(len(starts), dtype=np.int64)
+        matches = np.ones(len(page_ids) - k + 1, dtype=bool)
+        for i, step in enumerate(self.steps):
+            matches &= evaluate(step, pages)[page_ids[i:len(page_ids) - k + 1 + i]]
+        # a match starting at a page must end in the same journey, so none
+        # start in the last k - 1 pages of a journey
+        matches = np.concatenate([matches, np.zeros(len(page_ids) - len(matches), dtype=bool)])
+        for from_end in range(1, k):
+            too_late = stops - from_end
+            matches[too_late[too_late >= starts]] = False
+        return segment_sums(matches, starts, stops)
+
+
+def _flatten(journeys, column):
+    """
+    The flat arrays of a list column, where each journey's list starts and
+    stops in them, and the pages and events their ids index.
+    """
+    if column == "Page_Event_List":
+        events = event_arrays(journeys, column)
+        return ({"page_ids": events.page_ids, "event_ids": events.event_ids},
+                events.starts, events.stops, events.pages, events.events)
+    if hasattr(journeys, "list_column"):
+        arrays, starts, stops = journeys.list_column(column)
+        return arrays, starts, stops, journeys.pages, journeys.events
+    lists = journeys[column]
+    lengths = lists.map(len).values.astype(np.int64)
+    stops = np.cumsum(lengths)
+    starts = stops - lengths
+    page_ids, pages = pd.factorize(np.array(list(chain.from_iterable(lists)), dtype=object))
+    return {"page_ids": page_ids}, starts, stops, pages, []
+
+
+@lru_cache(maxsize=None)
+def compile_pattern(text):
+    """Compile a journey pattern, see JourneyPattern, once per distinct text."""
+    return JourneyPattern(text)
+
+
+def count_patterns(journeys, patterns, page_sets=None):
+    """
+    Count the matches of several patterns in each journey, flattening each
+    list column once however many patterns match in it.
+
+    Parameters:
+        journeys: a DataFrame of processed journeys with parsed list columns,
+            or journey_arrays.JourneyArrays.
+        patterns (dict): column name to pattern text.
+        page_sets (dict): name to set of page paths, e.g.
+            {'thing': thing_page_paths}.
+
+    Returns:
+       pandas.core.frame.DataFrame: a column of counts for each pattern, with
+       journeys' index if it is a DataFrame.
+    """
+    compiled = {name: compile_pattern(text) for name, text in patterns.items()}
+    flattened = {column: _flatten(journeys, column)
+                 for column in {pattern.column for pattern in compiled.values()}}
+    counts = {name: pattern._count(flattened[pattern.column], page_sets or {})
+              for name, pattern in compiled.items()}
+    return pd.DataFrame(counts, index=getattr(journeys, "index", None))
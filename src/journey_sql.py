@@ -0,0 +1,325 @@
+import os
+import sys
+import ast
+import argparse
+import logging.config
+from concurrent.futures import ProcessPoolExecutor
+# .. other safe imports
+try:
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # embedded SQL engine, multi-threaded and spills to disk past its memory limit
+    import duckdb
+except ImportError:
+    logging.error("Missing pandas, pyarrow and/or duckdb library")
+    sys.exit()
+
+from journey_io import (OUTPUT_CODECS, iter_journeys, list_journey_files,
+                        output_extension, strip_journey_extension,
+                        write_journeys)
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('journey_sql')
+
+REQUIRED_COLUMNS = ["Occurrences", "ABVariant", "Page_Event_List",
+                    "Page_List",  "Event_cat_act_agg"]
+
+QUERIES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "queries")
+
+# the python literal strings in processed_journey files, as nested parquet types
+JOURNEY_SCHEMA = pa.schema([
+    ("Occurrences", pa.int64()),
+    ("ABVariant", pa.string()),
+    ("Page_List", pa.list_(pa.string())),
+    ("Page_Event_List", pa.list_(pa.struct([
+        ("page", pa.string()), ("category", pa.string()),
+        ("action", pa.string())]))),
+    ("Event_cat_act_agg", pa.list_(pa.struct([
+        ("category", pa.string()), ("action", pa.string()),
+        ("count", pa.int64())])))
+])
+
+# the per journey metrics we check against the pandas derivation in analysis.py
+METRIC_COLUMNS = ["Page_List_Length", "Related_Links_Clicks_per_seq",
+                  "Content_Page_Nav_Event_Count", "Content_Search_Event_Count",
+                  "Content_Nav_or_Search_Count"]
+
+
+def parse_page_event_list(page_event_list):
+    """[('/page', ('category', 'action')), ...] to a list of dicts."""
+    return [{"page": page, "category": event[0], "action": event[1]}
+            for page, event in ast.literal_eval(page_event_list)]
+
+
+def parse_event_cat_act_agg(event_cat_act_agg):
+    """[(('category', 'action'), count), ...] to a list of dicts."""
+    return [{"category": event[0], "action": event[1], "count": count}
+            for event, count in ast.literal_eval(event_cat_act_agg)]
+
+
+def convert_to_parquet(filepath, out_path, chunksize=100000):
+    """
+    Convert one processed_journey file to parquet with nested list columns,
+    so the metrics can be computed in SQL without parsing python literals.
+
+    The file is converted a chunk at a time. Rows are not filtered, so
+    file_row_number in the parquet file is the row number in the original.
+
+    Parameters:
+        filepath (str): processed_journey file, in any format journey_io reads.
+        out_path (str): where to write the parquet file.
+        chunksize (int): number of rows to convert at a time.
+
+    Returns:
+       str: out_path
+    """
+    logger.info(f"Converting {filepath} to {out_path}")
+    with pq.ParquetWriter(out_path, JOURNEY_SCHEMA,
+                          compression="zstd") as writer:
+        for df in iter_journeys(filepath, usecols=REQUIRED_COLUMNS,
+                                chunksize=chunksize):
+            df['Page_List'] = df['Page_List'].map(ast.literal_eval)
+            df['Page_Event_List'] = df['Page_Event_List'].map(
+                parse_page_event_list)
+            df['Event_cat_act_agg'] = df['Event_cat_act_agg'].map(
+                parse_event_cat_act_agg)
+            writer.write_table(pa.Table.from_pandas(
+                df, schema=JOURNEY_SCHEMA, preserve_index=False))
+    return out_path
+
+
+def convert_processed_journeys(data_dir, filename_prefix, workers=None):
+    """
+    Convert every processed_journey file beginning with filename_prefix to
+    parquet in data_dir/processed_journey_parquet, in parallel. Files whose
+    parquet copy is newer than the original are not converted again.
+
+    Returns:
+       list: the parquet filepaths, sorted.
+    """
+    out_dir = os.path.join(data_dir, "processed_journey_parquet")
+    os.makedirs(out_dir, exist_ok=True)
+
+    filepath_list = list_journey_files(
+        os.path.join(data_dir, "processed_journey"), filename_prefix)
+    logger.info(f"work with files {filepath_list}")
+
+    out_path_list = [
+        os.path.join(out_dir, strip_journey_extension(
+            os.path.basename(filepath)) + ".parquet")
+        for filepath in filepath_list]
+    to_convert = [
+        (filepath, out_path)
+        for filepath, out_path in zip(filepath_list, out_path_list)
+        if not os.path.exists(out_path)
+        or os.path.getmtime(out_path) < os.path.getmtime(filepath)]
+    logger.info(f"{len(to_convert)} of {len(filepath_list)} files need "
+                f"converting to parquet")
+
+    if to_convert:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(convert_to_parquet, *zip(*to_convert)))
+    return out_path_list
+
+
+def read_query(name, **kwargs):
+    """Read a query from the queries dir and fill in its placeholders."""
+    with open(os.path.join(QUERIES_DIR, f"{name}.sql")) as f:
+        return f.read().format(**kwargs)
+
+
+def connect(parquet_paths, thing_page_paths, variants, threads=None,
+            memory_limit=None):
+    """
+    Open an in-memory DuckDB database with the journey_metrics view over
+    parquet_paths.
+
+    Parameters:
+        parquet_paths (list): parquet files from convert_processed_journeys.
+        thing_page_paths (list): page paths of "thing" (content) pages.
+        variants (list): the ABVariant values to keep, e.g. ['B', 'C'].
+        threads (int): number of threads DuckDB can use, all cores if None.
+        memory_limit (str): e.g. '4GB', DuckDB spills to disk past this.
+
+    Returns:
+       duckdb.DuckDBPyConnection: the connection.
+    """
+    con = duckdb.connect()
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = '{memory_limit}'")
+
+    thing_pages = pd.DataFrame(
+        {"pagePath": sorted(set(thing_page_paths))})
+    con.register("thing_pages", thing_pages)
+    con.execute(read_query(
+        "journey_metrics", journey_paths=sql_list(parquet_paths),
+        variants=sql_list(variants)))
+    return con
+
+
+def sql_list(values):
+    """A python list of strings as a SQL list literal."""
+    quoted = ["'" + str(value).replace("'", "''") + "'" for value in values]
+    return "[" + ", ".join(quoted) + "]"
+
+
+def variant_metrics(con):
+    """Occurrence weighted totals, proportions and means per variant."""
+    return con.execute(read_query("variant_metrics")).df()
+
+
+def pandas_journey_metrics(filepath, thing_page_paths, variants):
+    """
+    The same per journey metrics as the journey_metrics view, derived with the
+    pandas functions in analysis.py, indexed by row number in filepath.
+    """
+    import analysis
+    # the analysis helpers look up thing pages in this module level variable
+    analysis.thing_page_paths = set(thing_page_paths)
+
+    df = pd.concat(iter_journeys(filepath, usecols=REQUIRED_COLUMNS))
+    df = df.reset_index(drop=True)
+    df = df[df.ABVariant.isin(variants)].copy()
+    df['Event_cat_act_agg'] = df['Event_cat_act_agg'].map(ast.literal_eval)
+    df['Page_Event_List'] = df['Page_Event_List'].map(ast.literal_eval)
+    df['Page_List'] = df['Page_List'].map(ast.literal_eval)
+
+    df['Page_List_Length'] = df['Page_List'].map(len)
+    df['Related_Links_Clicks_per_seq'] = df['Event_cat_act_agg'].map(
+        analysis.sum_related_click_events)
+    df['Content_Page_Nav_Event_Count'] = df['Page_Event_List'].map(
+        analysis.count_nav_events)
+    df['Content_Search_Event_Count'] = df['Page_List'].map(
+        analysis.count_search_from_content)
+    df['Content_Nav_or_Search_Count'] = (
+        df['Content_Page_Nav_Event_Count'] + df['Content_Search_Event_Count'])
+    return df[["Occurrences", "ABVariant"] + METRIC_COLUMNS]
+
+
+def check_against_pandas(con, filepath, parquet_path, thing_page_paths,
+                         variants):
+    """
+    Assert the SQL metrics for one file match the pandas derivation exactly.
+
+    Parameters:
+        con (duckdb.DuckDBPyConnection): from connect.
+        filepath (str): the original processed_journey file.
+        parquet_path (str): its parquet copy, which must be one of the files
+            con was opened with.
+        thing_page_paths (list): page paths of "thing" (content) pages.
+        variants (list): the ABVariant values to keep.
+
+    Returns:
+       int: the number of journey types checked.
+    """
+    logger.info(f"Checking SQL metrics against pandas for {filepath}")
+    sql_df = con.execute(
+        "SELECT * FROM journey_metrics WHERE filename = ? "
+        "ORDER BY file_row_number", [parquet_path]).df()
+    sql_df = sql_df.set_index("file_row_number")
+    sql_df.index.name = None
+
+    pandas_df = pandas_journey_metrics(filepath, thing_page_paths, variants)
+
+    pd.testing.assert_frame_equal(
+        sql_df[pandas_df.columns], pandas_df, check_dtype=False,
+        check_index_type=False)
+    logger.info(f"{len(pandas_df)} journey types match")
+    return len(pandas_df)
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Computing journey metrics per variant in SQL, over '
+                    'processed journey files converted to parquet',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filename_prefix', help='''
+        Prefix of the processed_journey files for the test, in the DATA_DIR
+        specified in your .envrc. They are converted to parquet in the
+        processed_journey_parquet directory in DATA_DIR the first time, and
+        the metrics per variant are saved as
+        sqlmetrics_<<filename_prefix>>.csv.gz in rl_sampled_processed_journey
+        ''')
+    parser.add_argument(
+        'document_types_filename', help='''
+        Filename of the lookup table in `./data/metadata` for page document
+        type including .csv.gz, to work out which pages are "thing" pages.
+        ''')
+    parser.add_argument(
+        '--control_group', default="B", help='''
+        Capital letter that defines the control variant (e.g., "B")
+        ''')
+    parser.add_argument(
+        '--intervention_group', default="C", help='''
+        Capital letter that defines the intervention variant (e.g., "C")
+        ''')
+    parser.add_argument(
+        '--threads', default=None, type=int, help='''
+        number of threads for DuckDB, and processes for converting to parquet,
+        all cores if not given
+        ''')
+    parser.add_argument(
+        '--memory_limit', default=None, help='''
+        memory DuckDB can use before spilling to disk, e.g. 4GB
+        ''')
+    parser.add_argument(
+        '--check', action='store_true', help='''
+        also derive the metrics with the pandas code in analysis.py and check
+        they match the SQL metrics exactly, this is slow
+        ''')
+    parser.add_argument(
+        '--output_format', default="csv", choices=list(OUTPUT_CODECS),
+        help='format of the metrics file, csv or parquet')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('journey_sql')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+    logger.debug(f"data directory {DATA_DIR}")
+
+    metadata_path = os.path.join(
+        DATA_DIR, 'metadata', args.document_types_filename)
+    logger.debug(f'Reading in metadata from {metadata_path}')
+    df_finding_thing = pd.read_csv(metadata_path, sep="\t",
+                                   compression="gzip")
+    thing_page_paths = df_finding_thing[
+        df_finding_thing['is_finding'] == 0]['pagePath'].tolist()
+
+    variants = [args.control_group, args.intervention_group]
+    parquet_paths = convert_processed_journeys(
+        DATA_DIR, args.filename_prefix, workers=args.threads)
+
+    con = connect(parquet_paths, thing_page_paths, variants,
+                  threads=args.threads, memory_limit=args.memory_limit)
+
+    logger.info('Computing metrics per variant...')
+    df_metrics = variant_metrics(con)
+    logger.info(f"\n{df_metrics.T}")
+
+    if args.check:
+        filepath_list = list_journey_files(
+            os.path.join(DATA_DIR, "processed_journey"), args.filename_prefix)
+        for filepath, parquet_path in zip(filepath_list, parquet_paths):
+            check_against_pandas(con, filepath, parquet_path,
+                                 thing_page_paths, variants)
+
+    out_path = os.path.join(
+        DATA_DIR, "rl_sampled_processed_journey",
+        f"sqlmetrics_{args.filename_prefix}"
+        f"{output_extension(args.output_format, OUTPUT_CODECS[args.output_format][0])}")
+    logger.info(f"Saving to {out_path}")
+    write_journeys(df_metrics, out_path, output_format=args.output_format,
+                   codec=OUTPUT_CODECS[args.output_format][0], sep=",")
@@ -0,0 +1,457 @@
+import os
+import sys
+import argparse
+import logging.config
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    logging.error("Missing pandas, numpy and/or scipy library")
+    sys.exit()
+
+from journey_io import (DATE_PATTERN, OUTPUT_CODECS, list_journey_files,
+                        output_extension, read_journeys,
+                        strip_journey_extension, write_journeys)
+from journey_keys import hash_journeys
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('journey_store')
+
+# the directory in DATA_DIR the stores are kept in, one per filename prefix
+STORE_DIR = "journey_store"
+
+# everything that makes a journey a journey, whichever variant it was in
+JOURNEY_COLUMNS = ["Page_Event_List", "Page_List", "Event_cat_act_agg"]
+
+# columns of a processed journey file, in order
+REQUIRED_COLUMNS = ["Occurrences", "ABVariant"] + JOURNEY_COLUMNS
+
+DEFAULT_VARIANTS = ("A", "B", "C")
+
+
+class JourneyStore:
+    """
+    Every distinct journey in a test, stored once, with a sparse
+    journeys x (day, variant) matrix of Occurrences.
+
+    Column day_index * len(variants) + variant_index of the matrix holds the
+    Occurrences of every journey for that variant on that day, so any date
+    range or variant is a slice of columns, without reading the day files
+    again.
+
+    sources holds the size and modification time of the file each day was
+    read from, so build_store can tell when a day file has changed.
+    """
+
+    def __init__(self, variants=DEFAULT_VARIANTS):
+        self.variants = list(variants)
+        self.days = []
+        self.sources = {}
+        self.journeys = pd.DataFrame(columns=JOURNEY_COLUMNS)
+        self.keys = pd.Index([], dtype=np.uint64)
+        self.occurrences = sparse.csc_matrix((0, 0), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.journeys)
+
+    def journey_ids(self, df):
+        """Look up, or add, the id of the journey in each row of df."""
+        keys = hash_journeys(df, JOURNEY_COLUMNS).values
+        ids = self.keys.get_indexer(keys)
+        new = ids == -1
+        if new.any():
+            new_keys, first = np.unique(keys[new], return_index=True)
+            payload = df[JOURNEY_COLUMNS].iloc[np.flatnonzero(new)[first]]
+            self.journeys = pd.concat(
+                [self.journeys, payload], ignore_index=True)
+            self.keys = self.keys.append(pd.Index(new_keys, dtype=np.uint64))
+            ids = self.keys.get_indexer(keys)
+        return ids
+
+    def add_day(self, day, df, source=None):
+        """
+        Add one day of processed journeys.
+
+        Parameters:
+            day (str): the name of the day, e.g. the processed journey
+                filename without extensions.
+            df (pandas.core.frame.DataFrame): the processed journeys, with
+                REQUIRED_COLUMNS as read from file. Rows for other variants
+                are dropped.
+            source (tuple): the size and modification time of the file df was
+                read from, see file_stamp.
+        """
+        if day in self.days:
+            raise ValueError(f"{day} is already in the store")
+        df = df[df["ABVariant"].isin(self.variants)]
+        ids = self.journey_ids(df)
+        variant_codes = pd.Categorical(
+            df["ABVariant"], categories=self.variants).codes
+
+        # duplicate journeys within a variant are summed
+        day_matrix = sparse.coo_matrix(
+            (df["Occurrences"].values.astype(np.int64), (ids, variant_codes)),
+            shape=(len(self), len(self.variants))).tocsc()
+        occurrences = self.occurrences.tocsc()
+        occurrences.resize((len(self), occurrences.shape[1]))
+        self.occurrences = sparse.hstack(
+            [occurrences, day_matrix], format="csc")
+        self.days.append(day)
+        self.sources[day] = source
+        logger.debug(f"{day} added, {len(self)} journeys in the store")
+
+    def remove_day(self, day):
+        """
+        Remove one day's Occurrences. Journeys only seen that day are kept,
+        with no Occurrences, as they cost little and may come back.
+        """
+        day_index = self.days.index(day)
+        keep = np.ones(self.occurrences.shape[1], dtype=bool)
+        keep[self.select_columns([day_index])] = False
+        self.occurrences = self.occurrences.tocsc()[:, np.flatnonzero(keep)]
+        del self.days[day_index]
+        del self.sources[day]
+
+    def order_days(self, days):
+        """Put the days, and their matrix columns, in the order of days."""
+        order = [self.days.index(day) for day in days]
+        self.occurrences = self.occurrences.tocsc()[
+            :, self.select_columns(order)]
+        self.days = list(days)
+
+    @property
+    def dates(self):
+        """The date of each day, NaT if the day's name has no date in it."""
+        return pd.to_datetime(
+            [match.group() if match else None
+             for match in map(DATE_PATTERN.search, self.days)])
+
+    def select_days(self, start_date=None, end_date=None):
+        """
+        The indices of the days from start_date to end_date, inclusive.
+
+        Days without a date in their names are left out, with a warning, and
+        a ValueError is raised if none of the days have one.
+        """
+        if start_date is None and end_date is None:
+            return np.arange(len(self.days))
+        dates = self.dates
+        if len(dates) and dates.isna().all():
+            raise ValueError(
+                f"none of the {len(dates)} days in the store have a "
+                f"YYYY-MM-DD date in their names, so can't be selected from "
+                f"{start_date} to {end_date}")
+        if dates.isna().any():
+            logger.warning(
+                f"leaving out days without a YYYY-MM-DD date in their names: "
+                f"{[day for day, date in zip(self.days, dates) if pd.isna(date)]}")
+        mask = np.ones(len(dates), dtype=bool)
+        if start_date is not None:
+            mask &= dates >= pd.Timestamp(start_date)
+        if end_date is not None:
+            mask &= dates <= pd.Timestamp(end_date)
+        return np.flatnonzero(mask)
+
+    def select_columns(self, days, variants=None):
+        """The matrix columns for some days and variants, day by day."""
+        variants = self.variants if variants is None else variants
+        variant_index = [self.variants.index(variant) for variant in variants]
+        return (np.asarray(days)[:, None] * len(self.variants)
+                + np.asarray(variant_index)[None, :]).ravel()
+
+    def total_occurrences(self, start_date=None, end_date=None,
+                          variants=None):
+        """
+        Total Occurrences per day and variant, like
+        get_df_total_occurrences_per_variant for every day file at once.
+
+        Returns:
+           pandas.core.frame.DataFrame: days x variants.
+        """
+        variants = self.variants if variants is None else list(variants)
+        days = self.select_days(start_date, end_date)
+        columns = self.select_columns(days, variants)
+        totals = np.asarray(self.occurrences[:, columns].sum(axis=0)).ravel()
+        return pd.DataFrame(
+            totals.reshape(len(days), len(variants)),
+            index=pd.Index([self.days[i] for i in days], name="day"),
+            columns=pd.Index(variants, name="ABVariant"))
+
+    def variant_occurrences(self, start_date=None, end_date=None,
+                            variants=None):
+        """
+        Occurrences of every journey in each variant, summed over the days
+        from start_date to end_date.
+
+        Returns:
+           scipy.sparse.csc_matrix: journeys x variants.
+        """
+        variants = self.variants if variants is None else list(variants)
+        days = self.select_days(start_date, end_date)
+        columns = self.select_columns(days, variants)
+        # sum the day columns of each variant together
+        summing = sparse.csr_matrix(
+            (np.ones(len(columns), dtype=np.int64),
+             (np.arange(len(columns)), np.tile(np.arange(len(variants)),
+                                               len(days)))),
+            shape=(len(columns), len(variants)))
+        return (self.occurrences[:, columns] @ summing).tocsc()
+
+    def to_processed(self, occurrences, variants=None):
+        """
+        Turn a journeys x variants matrix of Occurrences back into the
+        processed journey format, one row per journey and variant with any
+        Occurrences.
+        """
+        variants = self.variants if variants is None else list(variants)
+        counts = occurrences.tocoo()
+        counts.eliminate_zeros()
+        order = np.lexsort((counts.row, counts.col))
+        rows, cols = counts.row[order], counts.col[order]
+        df = self.journeys.iloc[rows].reset_index(drop=True)
+        df.insert(0, "ABVariant", np.asarray(variants, dtype=object)[cols])
+        df.insert(0, "Occurrences", counts.data[order])
+        return df[REQUIRED_COLUMNS]
+
+    def read_journeys(self, start_date=None, end_date=None, variants=None):
+        """
+        The processed journeys from start_date to end_date, rolled up, as if
+        all the day files were read in and grouped.
+
+        Parameters:
+            start_date (str): the first day to include, e.g. 2019-02-14, from
+                the first day in the store if None.
+            end_date (str): the last day to include, to the last day in the
+                store if None.
+            variants (list): the variants to include, all if None.
+
+        Returns:
+           pandas.core.frame.DataFrame: REQUIRED_COLUMNS, the journey columns
+           as strings in the processed journey format.
+        """
+        return self.to_processed(
+            self.variant_occurrences(start_date, end_date, variants),
+            variants)
+
+    def sample(self, k, variants=None, seed=1337, with_replacement=True,
+               start_date=None, end_date=None):
+        """
+        Sample k journeys per variant, weighted by Occurrences, from the days
+        from start_date to end_date.
+
+        Like sample_multiple_days_processed_journey, each day contributes in
+        proportion to its Occurrences for the variant, and the sample is
+        rolled up so Occurrences counts how many times a journey was drawn.
+
+        Returns:
+           pandas.core.frame.DataFrame: the sample, in the processed journey
+           format.
+        """
+        variants = self.variants if variants is None else list(variants)
+        rng = np.random.default_rng(seed)
+        totals = self.total_occurrences(start_date, end_date, variants)
+        days = self.select_days(start_date, end_date)
+        sampled = np.zeros((len(self), len(variants)), dtype=np.int64)
+
+        for j, variant in enumerate(variants):
+            total = totals[variant].sum()
+            if k > total:
+                raise ValueError(
+                    'sample size is greater than total occurrences')
+            k_list = np.round(totals[variant].values * k / total).astype(int)
+            logger.debug(f"sample size from each day for {variant} {k_list}")
+            for day, day_k in zip(days, k_list):
+                if day_k == 0:
+                    continue
+                column = self.occurrences[
+                    :, self.select_columns([day], [variant])[0]].tocoo()
+                weights = column.data / column.data.sum()
+                drawn = rng.choice(len(weights), size=day_k,
+                                   replace=with_replacement, p=weights)
+                sampled[:, j] += np.bincount(column.row[drawn],
+                                             minlength=len(self))
+
+        return self.to_processed(sparse.csc_matrix(sampled), variants)
+
+    def save(self, path, output_format="parquet", codec=None):
+        """
+        Save the store to the directory path, as a journeys file in any
+        journey_io format and the keys and occurrence matrix in a .npz.
+        """
+        os.makedirs(path, exist_ok=True)
+        codec = codec or OUTPUT_CODECS[output_format][0]
+        for old_path in list_journey_files(path, "journeys"):
+            os.remove(old_path)
+        write_journeys(self.journeys,
+                       os.path.join(path, "journeys" + output_extension(
+                           output_format, codec)),
+                       output_format=output_format, codec=codec)
+        occurrences = self.occurrences.tocsc()
+        np.savez_compressed(
+            os.path.join(path, "occurrences.npz"),
+            keys=self.keys.values, days=np.array(self.days, dtype=str),
+            # -1 for a day of unknown source
+            source_sizes=np.array([(self.sources[day] or (-1, -1))[0]
+                                   for day in self.days], dtype=np.int64),
+            source_mtimes=np.array([(self.sources[day] or (-1, -1))[1]
+                                    for day in self.days], dtype=np.int64),
+            variants=np.array(self.variants, dtype=str),
+            data=occurrences.data, indices=occurrences.indices,
+            indptr=occurrences.indptr, shape=np.array(occurrences.shape))
+
+    @classmethod
+    def load(cls, path):
+        """Load a store saved in the directory path."""
+        with np.load(os.path.join(path, "occurrences.npz")) as arrays:
+            store = cls(variants=arrays["variants"].tolist())
+            store.days = arrays["days"].tolist()
+            # stores saved before sources were kept have no record of them
+            sources = (zip(arrays["source_sizes"].tolist(),
+                           arrays["source_mtimes"].tolist())
+                       if "source_sizes" in arrays else [])
+            store.sources = {day: None for day in store.days}
+            store.sources.update(
+                (day, source) for day, source in zip(store.days, sources)
+                if source != (-1, -1))
+            store.keys = pd.Index(arrays["keys"], dtype=np.uint64)
+            store.occurrences = sparse.csc_matrix(
+                (arrays["data"], arrays["indices"], arrays["indptr"]),
+                shape=tuple(arrays["shape"]))
+        store.journeys = read_journeys(
+            list_journey_files(path, "journeys")[0])[JOURNEY_COLUMNS]
+        return store
+
+
+def store_path(data_dir, filename_prefix):
+    """The directory of the store for the processed journeys filename_prefix."""
+    return os.path.join(data_dir, STORE_DIR, filename_prefix)
+
+
+def date_range_suffix(start_date=None, end_date=None):
+    """A suffix for the names of files made from a date range of a store."""
+    if start_date is None and end_date is None:
+        return ""
+    return f"_{start_date or 'first'}_to_{end_date or 'last'}"
+
+
+def file_stamp(filepath):
+    """The size and modification time, in ns, of the file filepath."""
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def load_store(data_dir, filename_prefix):
+    """Load the store built by build_store for filename_prefix."""
+    return JourneyStore.load(store_path(data_dir, filename_prefix))
+
+
+def build_store(data_dir, filename_prefix, variants=None,
+                output_format="parquet", codec=None):
+    """
+    Build, or bring up to date, the store of every processed journey file
+    beginning with filename_prefix in data_dir/processed_journey.
+
+    Days already in the store are not read again unless their file's size or
+    modification time has changed, so after a new day of processed journeys
+    arrives only that file is read.
+
+    Parameters:
+        variants (list): the variants to keep, those of the existing store,
+            or DEFAULT_VARIANTS for a new one, if None. A ValueError is
+            raised if they differ from those of an existing store, which has
+            to be deleted and built again to change them.
+
+    Returns:
+       JourneyStore: the store, also saved in data_dir/journey_store.
+    """
+    path = store_path(data_dir, filename_prefix)
+    if os.path.exists(os.path.join(path, "occurrences.npz")):
+        store = JourneyStore.load(path)
+        logger.info(f"{len(store.days)} days already in {path}")
+        if variants is not None and list(variants) != store.variants:
+            raise ValueError(
+                f"{path} holds variants {store.variants}, not {list(variants)}"
+                f", delete it to build it again with other variants")
+    else:
+        store = JourneyStore(
+            variants=DEFAULT_VARIANTS if variants is None else variants)
+
+    filepath_list = list_journey_files(
+        os.path.join(data_dir, "processed_journey"), filename_prefix)
+    days = [strip_journey_extension(os.path.basename(filepath))
+            for filepath in filepath_list]
+    changed = False
+    for day, filepath in zip(days, filepath_list):
+        source = file_stamp(filepath)
+        if day in store.days:
+            if store.sources[day] == source:
+                continue
+            logger.info(f"Reading {filepath} again, "
+                        + ("it has changed since it was stored"
+                           if store.sources[day] else
+                           "the store has no record of its size and time"))
+            store.remove_day(day)
+        else:
+            logger.info(f"Adding {filepath}")
+        store.add_day(day, read_journeys(filepath, usecols=REQUIRED_COLUMNS),
+                      source=source)
+        changed = True
+
+    if changed:
+        # in file order, as if built from scratch, with any days whose files
+        # are gone at the end
+        store.order_days([day for day in days if day in store.days]
+                         + [day for day in store.days if day not in days])
+        logger.info(f"Saving {len(store)} journeys over {len(store.days)} "
+                    f"days to {path}")
+        store.save(path, output_format=output_format, codec=codec)
+    return store
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Build a store of every journey in an A/B test, each '
+                    'journey once with its Occurrences per day and variant',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filename_prefix', help='''
+        Prefix of the processed journey files to store. We will read from the
+        processed_journey directory from the DATA_DIR specified in your
+        .envrc, and write to journey_store/<<filename_prefix>> in DATA_DIR.
+        Days already in the store are not read again unless their file has
+        changed.
+        ''')
+    parser.add_argument(
+        '--variants', nargs='+', default=None,
+        help='variants to keep, any other ABVariant values are dropped. '
+             'Defaults to those of an existing store, or A B C for a new '
+             'one, and must match those of an existing store')
+    parser.add_argument(
+        '--output_format', default="parquet", choices=list(OUTPUT_CODECS),
+        help='format of the journeys file')
+    parser.add_argument(
+        '--codec', default=None,
+        choices=sorted(set(sum(OUTPUT_CODECS.values(), []))),
+        help='compression codec for the journeys file, defaults to gzip for '
+             'csv and zstd for parquet')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('journey_store')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+
+    journey_store = build_store(
+        DATA_DIR, args.filename_prefix, variants=args.variants,
+        output_format=args.output_format, codec=args.codec)
+    logger.info(f"Occurrences per day and variant:\n"
+                f"{journey_store.total_occurrences()}")
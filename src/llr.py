@@ -0,0 +1,345 @@
+import os
+import sys
+import ast
+import argparse
+import logging.config
+from concurrent.futures import ProcessPoolExecutor
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    logging.error("Missing pandas, numpy and/or scipy library")
+    sys.exit()
+
+from journey_io import (iter_journeys, list_journey_files, write_journeys)
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('llr')
+
+# pages we never want to recommend or generate related links for, as in
+# llr/queries/llr_pages_content_id_split_up_hitNumber.sql
+EXCLUDED_PAGE_PREFIXES = ("/search",)
+EXCLUDED_PAGES = {"/"}
+
+
+class CoOccurrences:
+    """
+    A growing page vocabulary and sparse page_1 x page_2 matrix of how many
+    journeys viewed page_2 after page_1, weighted by Occurrences.
+
+    Accumulators for different files can be merged, so files can be counted
+    in separate processes.
+    """
+
+    def __init__(self):
+        self.pages = []
+        self.page_index = {}
+        self.matrix = sparse.csr_matrix((0, 0), dtype=np.int64)
+
+    def page_ids(self, pages):
+        """Look up, or add, the id of each page."""
+        ids = np.empty(len(pages), dtype=np.int64)
+        for i, page in enumerate(pages):
+            page_id = self.page_index.get(page)
+            if page_id is None:
+                page_id = len(self.pages)
+                self.page_index[page] = page_id
+                self.pages.append(page)
+            ids[i] = page_id
+        return ids
+
+    def add(self, rows, cols, weights):
+        """Add co-occurrence counts for page id pairs."""
+        size = len(self.pages)
+        counts = sparse.coo_matrix((weights, (rows, cols)),
+                                   shape=(size, size)).tocsr()
+        self.matrix = resize(self.matrix, size) + counts
+
+    def merge(self, other):
+        """Add another accumulator's counts to this one."""
+        mapping = self.page_ids(other.pages)
+        counts = other.matrix.tocoo()
+        self.add(mapping[counts.row], mapping[counts.col], counts.data)
+        return self
+
+
+def resize(matrix, size):
+    """Pad a square sparse matrix with empty rows and columns."""
+    matrix = matrix.tocsr()
+    if matrix.shape[0] == size:
+        return matrix
+    matrix.resize((size, size))
+    return matrix
+
+
+def first_views(page_list, excluded_pages=frozenset(), max_pages=50):
+    """
+    The distinct pages in a journey in order of when they were first viewed,
+    leaving out excluded and "finding" pages, up to max_pages pages.
+    """
+    pages = dict.fromkeys(
+        page for page in page_list
+        if page not in EXCLUDED_PAGES and page not in excluded_pages
+        and not page.startswith(EXCLUDED_PAGE_PREFIXES))
+    return list(pages)[:max_pages]
+
+
+def ordered_pairs(offsets, page_ids, weights):
+    """
+    Every (page_1, page_2) pair where page_2 was first viewed after page_1,
+    for journeys stored as flat arrays, with each journey's weight.
+
+    Journeys of the same length share their upper triangle indices, so pairs
+    are generated with one gather per journey length.
+
+    Parameters:
+        offsets (numpy.ndarray): start of each journey in page_ids, with the
+            end of the last journey appended.
+        page_ids (numpy.ndarray): page ids of all journeys, one after another.
+        weights (numpy.ndarray): Occurrences of each journey.
+
+    Returns:
+       (numpy.ndarray, numpy.ndarray, numpy.ndarray): page_1 ids, page_2 ids
+       and weights.
+    """
+    lengths = np.diff(offsets)
+    starts = offsets[:-1]
+    rows, cols, pair_weights = [], [], []
+    for length in np.unique(lengths[lengths > 1]):
+        in_group = lengths == length
+        first, second = np.triu_indices(length, k=1)
+        group_starts = starts[in_group][:, None]
+        rows.append(page_ids[group_starts + first].ravel())
+        cols.append(page_ids[group_starts + second].ravel())
+        pair_weights.append(np.repeat(weights[in_group], len(first)))
+    if not rows:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty
+    return (np.concatenate(rows), np.concatenate(cols),
+            np.concatenate(pair_weights))
+
+
+def count_file(filepath, excluded_pages=frozenset(), variants=None,
+               max_pages=50, chunksize=100000):
+    """
+    Count page co-occurrences in one processed_journey file, a chunk at a
+    time.
+
+    Parameters:
+        filepath (str): processed_journey file, in any format journey_io reads.
+        excluded_pages (set): page paths to leave out, e.g. "finding" pages.
+        variants (list): only count journeys in these variants, all if None.
+        max_pages (int): only the first max_pages distinct pages of each
+            journey are paired, so one long journey can't blow up memory.
+        chunksize (int): number of journeys to read at a time.
+
+    Returns:
+       CoOccurrences: the counts for this file.
+    """
+    logger.info(f"Counting co-occurrences in {filepath}")
+    co_occurrences = CoOccurrences()
+    for df in iter_journeys(filepath, usecols=["Occurrences", "ABVariant",
+                                               "Page_List"],
+                            chunksize=chunksize):
+        if variants is not None:
+            df = df[df.ABVariant.isin(variants)]
+        page_lists = [
+            first_views(ast.literal_eval(page_list)
+                        if isinstance(page_list, str) else page_list,
+                        excluded_pages, max_pages)
+            for page_list in df['Page_List']]
+        lengths = np.array([len(pages) for pages in page_lists],
+                           dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        page_ids = co_occurrences.page_ids(
+            [page for pages in page_lists for page in pages])
+        co_occurrences.add(*ordered_pairs(
+            offsets, page_ids, df['Occurrences'].values.astype(np.int64)))
+    return co_occurrences
+
+
+def _count_file(args):
+    """Unpack arguments for count_file in a worker process."""
+    return count_file(*args)
+
+
+def count_files(filepath_list, excluded_pages=frozenset(), variants=None,
+                max_pages=50, workers=None):
+    """
+    Count page co-occurrences in many files in parallel, one file per process,
+    and merge the counts.
+
+    Returns:
+       CoOccurrences: the counts for all files.
+    """
+    tasks = [(filepath, excluded_pages, variants, max_pages)
+             for filepath in filepath_list]
+    co_occurrences = CoOccurrences()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for file_co_occurrences in executor.map(_count_file, tasks):
+            co_occurrences.merge(file_co_occurrences)
+    return co_occurrences
+
+
+def xlogx_over_n(k, n):
+    """k * log(k / n), and 0 where k is 0."""
+    k = np.asarray(k, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(k > 0, k * np.log(k / n), 0.0)
+
+
+def llr_scores(matrix):
+    """
+    Dunning's log-likelihood ratio for every page pair that co-occurs, as in
+    llr/queries/llr_pages_content_id_split_up_hitNumber.sql.
+
+    Notation from http://tdunning.blogspot.com/2008/03/surprise-and-coincidence.html,
+    k11 is the co-occurrences of page_1 then page_2, page_1_occurrences and
+    page_2_occurrences are the row and column totals of the co-occurrence
+    matrix, and N is its grand total.
+
+    Returns:
+       (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray,
+       numpy.ndarray): page_1 ids, page_2 ids, k11, page_1_occurrences and
+       llr scores, for every non-zero pair.
+    """
+    matrix = matrix.tocoo()
+    page_1_occurrences = np.asarray(matrix.sum(axis=1)).ravel()
+    page_2_occurrences = np.asarray(matrix.sum(axis=0)).ravel()
+    n = matrix.data.sum()
+
+    k11 = matrix.data.astype(float)
+    k11_k21 = page_1_occurrences[matrix.row].astype(float)
+    k11_k12 = page_2_occurrences[matrix.col].astype(float)
+    k12 = k11_k12 - k11
+    k21 = k11_k21 - k11
+    k22 = n - k11_k12 - k11_k21 + k11
+    k21_k22 = n - k11_k12
+    k12_k22 = n - k11_k21
+
+    h_k = (xlogx_over_n(k11, n) + xlogx_over_n(k12, n) +
+           xlogx_over_n(k21, n) + xlogx_over_n(k22, n))
+    h_rowsums_k = xlogx_over_n(k11_k12, n) + xlogx_over_n(k21_k22, n)
+    h_colsums_k = xlogx_over_n(k11_k21, n) + xlogx_over_n(k12_k22, n)
+    return (matrix.row, matrix.col, matrix.data, k11_k21.astype(np.int64),
+            2 * (h_k - h_rowsums_k - h_colsums_k))
+
+
+def top_k_related_links(co_occurrences, k=100, min_co_occurrences=1):
+    """
+    The top k page_2s for each page_1 by llr score, ranked with ties sharing a
+    rank as in the SQL, so a page_1 can have slightly more than k links.
+
+    Returns:
+       pandas.core.frame.DataFrame: page_1, page_2, page_1_occurrences,
+       co_occurrences, llr_score and rank, sorted by page_1 and rank.
+    """
+    page_1, page_2, k11, page_1_occurrences, scores = llr_scores(
+        co_occurrences.matrix)
+    keep = k11 >= min_co_occurrences
+    page_1, page_2, k11 = page_1[keep], page_2[keep], k11[keep]
+    page_1_occurrences, scores = page_1_occurrences[keep], scores[keep]
+
+    # sort by page_1 then score, descending, and rank within each page_1
+    order = np.lexsort((-scores, page_1))
+    page_1, page_2, k11 = page_1[order], page_2[order], k11[order]
+    page_1_occurrences, scores = page_1_occurrences[order], scores[order]
+    group_start = np.r_[True, page_1[1:] != page_1[:-1]]
+    # a new rank wherever the score changes within a page_1
+    new_rank = group_start | np.r_[True, scores[1:] != scores[:-1]]
+    position = np.arange(len(page_1))
+    first_of_group = np.maximum.accumulate(np.where(group_start, position, 0))
+    first_of_rank = np.maximum.accumulate(np.where(new_rank, position, 0))
+    rank = first_of_rank - first_of_group + 1
+
+    keep = rank <= k
+    pages = np.array(co_occurrences.pages, dtype=object)
+    return pd.DataFrame({
+        "page_1": pages[page_1[keep]],
+        "page_2": pages[page_2[keep]],
+        "page_1_occurrences": page_1_occurrences[keep],
+        "co_occurrences": k11[keep],
+        "llr_score": scores[keep],
+        "rank": rank[keep]
+    })
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Generating LLR related links from processed journeys, '
+                    'without BigQuery',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filename_prefix', help='''
+        Prefix of the processed_journey files to count page co-occurrences in,
+        in the DATA_DIR specified in your .envrc. The related links are saved
+        as llr_recs_<<filename_prefix>>.csv.gz in the llr directory in DATA_DIR
+        ''')
+    parser.add_argument(
+        '--document_types_filename', default=None, help='''
+        Filename of the lookup table in `./data/metadata` for page document
+        type including .csv.gz, if given "finding" pages are left out.
+        ''')
+    parser.add_argument(
+        '--variants', nargs='*', default=None, help='''
+        only count journeys in these variants, e.g. the control group, all
+        journeys if not given
+        ''')
+    parser.add_argument('--k', default=100, type=int,
+                        help='number of related links to keep per page')
+    parser.add_argument(
+        '--min_co_occurrences', default=2, type=int, help='''
+        leave out pairs seen together fewer times, single co-occurrences give
+        some bad links
+        ''')
+    parser.add_argument(
+        '--max_pages', default=50, type=int, help='''
+        only pair up the first max_pages distinct pages of each journey
+        ''')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='number of processes, all cores if not given')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('llr')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+    logger.debug(f"data directory {DATA_DIR}")
+
+    excluded_pages = frozenset()
+    if args.document_types_filename is not None:
+        metadata_path = os.path.join(
+            DATA_DIR, 'metadata', args.document_types_filename)
+        logger.debug(f'Reading in metadata from {metadata_path}')
+        df_finding_thing = pd.read_csv(metadata_path, sep="\t",
+                                       compression="gzip")
+        excluded_pages = frozenset(df_finding_thing[
+            df_finding_thing['is_finding'] == 1]['pagePath'])
+
+    filepath_list = list_journey_files(
+        os.path.join(DATA_DIR, "processed_journey"), args.filename_prefix)
+    logger.info(f"work with files {filepath_list}")
+
+    co_occurrences = count_files(
+        filepath_list, excluded_pages=excluded_pages, variants=args.variants,
+        max_pages=args.max_pages, workers=args.workers)
+    logger.info(f"{len(co_occurrences.pages)} pages, "
+                f"{co_occurrences.matrix.nnz} page pairs")
+
+    df_llr_recs = top_k_related_links(
+        co_occurrences, k=args.k, min_co_occurrences=args.min_co_occurrences)
+
+    out_dir = os.path.join(DATA_DIR, "llr")
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, f"llr_recs_{args.filename_prefix}.csv.gz")
+    logger.info(f"Saving {len(df_llr_recs)} related links to {out_path}")
+    write_journeys(df_llr_recs, out_path, sep=",")
@@ -0,0 +1,404 @@
+import os
+import sys
+import json
+import types
+import hashlib
+import argparse
+import logging.config
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+# .. other safe imports
+try:
+    import pandas as pd
+except ImportError:
+    logging.error("Missing pandas library")
+    sys.exit()
+
+import analysis
+import sample_processed
+import sample_processed_bc
+import stratify
+from journey_io import (list_journey_files, output_extension,
+                        strip_journey_extension)
+from journey_store import date_range_suffix
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('pipeline')
+
+# where each step's signature is kept, in DATA_DIR
+STATE_DIR = "pipeline"
+
+# the directory of our modules, whose source is part of a step's signature
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# what a test in the config gets unless it says otherwise
+DEFAULTS = {
+    "filename_prefix": "taxon_ab",
+    "start_date": None,
+    "end_date": None,
+    "control_group": "A",
+    "intervention_group": "B",
+    "strata": [],
+    "k": 1000,
+    "seed": 1337,
+    "alpha": 0.05,
+    "m": 4,
+    "boot_reps": 10000,
+    "bootstrap_weights": "dirichlet",
+    "document_types_filename": "document_types.csv.gz",
+    "lean": True,
+}
+
+# the module that samples each pair of variants
+SAMPLERS = {
+    ("A", "B"): sample_processed,
+    ("B", "C"): sample_processed_bc,
+}
+
+
+def local_modules(module):
+    """
+    The paths of module's source and of every module in SOURCE_DIR it
+    imports, directly or through other modules in SOURCE_DIR, found from the
+    modules, functions and classes in their globals.
+
+    Returns:
+       list: sorted absolute paths.
+    """
+    found = set()
+    stack = [module]
+    while stack:
+        module = stack.pop()
+        path = getattr(module, "__file__", None)
+        if path is None:
+            continue
+        path = os.path.abspath(path)
+        if os.path.dirname(path) != SOURCE_DIR or path in found:
+            continue
+        found.add(path)
+        for value in vars(module).values():
+            if isinstance(value, types.ModuleType):
+                stack.append(value)
+            elif isinstance(value, (types.FunctionType, type)):
+                stack.append(sys.modules.get(value.__module__))
+    return sorted(found)
+
+
+class Step:
+    """
+    A call of a module level function, so it can run in a worker process,
+    with the files it reads and writes and the steps that must run first.
+
+    Its signature is a hash of the function, its parameters, the source of
+    pipeline.py and of the module doing the work and every module of ours it
+    imports, see local_modules, and the size and modification time of each
+    input, so a step whose signature is the same as when it last ran, with
+    every output still there, needn't run again.
+    """
+
+    def __init__(self, name, function, parameters, inputs, outputs,
+                 module, deps=()):
+        self.name = name
+        self.function = function
+        self.parameters = parameters
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.module = module
+        self.deps = list(deps)
+
+    def __repr__(self):
+        return f"Step({self.name!r})"
+
+    def signature(self):
+        """A hash of everything the step's outputs depend on."""
+        code = {}
+        for path in sorted(set(local_modules(self.module))
+                           | {os.path.abspath(__file__)}):
+            with open(path, "rb") as f:
+                code[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()
+        inputs = {}
+        for path in self.inputs:
+            stat = os.stat(path) if os.path.exists(path) else None
+            inputs[path] = [stat.st_size, stat.st_mtime_ns] if stat else None
+        description = {"function": self.function.__name__,
+                       "parameters": self.parameters, "code": code,
+                       "inputs": inputs}
+        return hashlib.sha256(json.dumps(description, sort_keys=True,
+                                         default=str).encode()).hexdigest()
+
+
+def run_stratify(data_dir, filepath):
+    """Split a processed journey file into strata, see stratify.stratify_file."""
+    return stratify.stratify_file(filepath, stratify.load_loved_pages(data_dir))
+
+
+def run_sample(data_dir, variants, filename_prefix, start_date, end_date, k,
+               seed, sample_name):
+    """Sample the days of a test, see sample_processed.sample_multiple_days_processed_journey."""
+    return SAMPLERS[tuple(variants)].sample_multiple_days_processed_journey(
+        data_dir, filename_prefix, seed=seed, k=k, start_date=start_date,
+        end_date=end_date, sample_name=sample_name)
+
+
+def run_analysis(data_dir, filename, document_types_filename, variants,
+                 alpha, m, boot_reps, bootstrap_weights, test, stratum, lean):
+    """Analyse a sample, see analysis.analyse_sampled_processed_journey."""
+    df_finding_thing = pd.read_csv(
+        os.path.join(data_dir, 'metadata', document_types_filename), sep="\t",
+        compression="gzip")
+    analysis.set_thing_page_paths(
+        df_finding_thing[df_finding_thing['is_finding'] == 0]['pagePath'])
+    analysis.analyse_sampled_processed_journey(
+        data_dir, filename, alpha=alpha / m, boot_reps=boot_reps,
+        variants=variants, bootstrap_weights=bootstrap_weights, test=test,
+        stratum=stratum, lean=lean)
+
+
+def load_config(path):
+    """
+    Read a pipeline config, a JSON object of settings shared by every test,
+    any of DEFAULTS, and "tests", an object of test name to its own
+    settings, e.g.
+
+    {"k": 500000,
+     "tests": {"ab1": {"start_date": "2019-02-14", "end_date": "2019-02-20",
+                       "strata": ["loved", "unloved"]}}}
+
+    Returns:
+       dict: test name to its complete settings.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    tests = config.pop("tests")
+    unknown = (set(config) | {setting for settings in tests.values()
+                              for setting in settings}) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown settings {sorted(unknown)}, choose from "
+                         f"{sorted(DEFAULTS)}")
+    return {test: {**DEFAULTS, **config, **settings}
+            for test, settings in tests.items()}
+
+
+def build_steps(data_dir, tests):
+    """
+    The steps to run every test in tests, from load_config, end to end:
+    stratify each day (once, whichever tests share it), sample each stratum
+    of each test, or the whole test if it has no strata, and analyse each
+    sample.
+
+    Returns:
+       dict: step name to Step.
+    """
+    processed_dir = os.path.join(data_dir, "processed_journey")
+    metadata_dir = os.path.join(data_dir, "metadata")
+    sampled_dir = os.path.join(data_dir, "sampled_journey")
+    steps = {}
+    for test, settings in tests.items():
+        variants = [settings["control_group"], settings["intervention_group"]]
+        if tuple(variants) not in SAMPLERS:
+            raise ValueError(f"test {test} can only compare one of "
+                             f"{list(SAMPLERS)}, not {variants}")
+        sampler = SAMPLERS[tuple(variants)]
+        start_date, end_date = settings["start_date"], settings["end_date"]
+        days = list_journey_files(processed_dir, settings["filename_prefix"],
+                                  start_date=start_date, end_date=end_date)
+        if not days:
+            raise ValueError(f"no processed journey files for test {test}")
+
+        for stratum in settings["strata"] or [None]:
+            if stratum is None:
+                filename_prefix, inputs, deps = (
+                    settings["filename_prefix"], days, [])
+            else:
+                if stratum not in stratify.STRATA:
+                    raise ValueError(f"stratum {stratum} of test {test} isn't "
+                                     f"one of {stratify.STRATA}")
+                if start_date is None or end_date is None:
+                    # the stratum files of every test are side by side
+                    raise ValueError(f"test {test} needs a start_date and "
+                                     f"end_date to be stratified")
+                filename_prefix, inputs, deps = stratum, [], []
+                for day in days:
+                    name = f"stratify {os.path.basename(day)}"
+                    steps[name] = Step(
+                        name, run_stratify, {"data_dir": data_dir, "filepath": day},
+                        [day, os.path.join(metadata_dir, stratify.CLEAN_CONTENT_FILENAME),
+                         os.path.join(metadata_dir, stratify.HMRC_CONTACT_PAGES_FILENAME)],
+                        [os.path.join(processed_dir, stratify.stratum_filename(day, s))
+                         for s in stratify.STRATA],
+                        stratify)
+                    inputs.append(os.path.join(processed_dir,
+                                               stratify.stratum_filename(day, stratum)))
+                    deps.append(name)
+
+            # the variants are in the name, as tests of different variants
+            # can sample the same days
+            sample = (f"full_sample_{filename_prefix}"
+                      f"{date_range_suffix(start_date, end_date)}_"
+                      f"{''.join(variants)}_{settings['k']}")
+            sample_filename = sample + output_extension("csv", "gzip")
+            # each day's sample is kept in a directory of the sample's own
+            day_samples = [
+                os.path.join(sampled_dir, sample + "_days",
+                             strip_journey_extension(os.path.basename(path))
+                             + output_extension("csv", "gzip"))
+                for path in inputs]
+            sample_name = f"sample {test} {stratum or 'all'}"
+            steps[sample_name] = Step(
+                sample_name, run_sample,
+                {"data_dir": data_dir, "variants": variants,
+                 "filename_prefix": filename_prefix, "start_date": start_date,
+                 "end_date": end_date, "k": settings["k"], "seed": settings["seed"],
+                 "sample_name": sample},
+                inputs, [os.path.join(sampled_dir, sample_filename)] + day_samples,
+                sampler, deps)
+
+            analysis_name = f"analyse {test} {stratum or 'all'}"
+            results_dir = os.path.join(data_dir, "rl_sampled_processed_journey")
+            steps[analysis_name] = Step(
+                analysis_name, run_analysis,
+                {"data_dir": data_dir, "filename": sample_filename,
+                 "document_types_filename": settings["document_types_filename"],
+                 "variants": variants, "alpha": settings["alpha"], "m": settings["m"],
+                 "boot_reps": settings["boot_reps"],
+                 "bootstrap_weights": settings["bootstrap_weights"], "test": test,
+                 "stratum": stratum, "lean": settings["lean"]},
+                [os.path.join(sampled_dir, sample_filename),
+                 os.path.join(metadata_dir, settings["document_types_filename"])],
+                [os.path.join(results_dir, results + sample_filename)
+                 for results in ["zprop_", "bayesbootstrap_", "ratio_"]],
+                analysis, [sample_name])
+
+    writers = {}
+    for step in steps.values():
+        for output in step.outputs:
+            if writers.setdefault(output, step.name) != step.name:
+                raise ValueError(f"{step.name} and {writers[output]} would both "
+                                 f"write {output}")
+    return steps
+
+
+def _state_path(data_dir, step):
+    return os.path.join(data_dir, STATE_DIR, step.name.replace(" ", "_") + ".json")
+
+
+def is_up_to_date(data_dir, step, signature):
+    """Did step last run with signature, and are its outputs still there?"""
+    path = _state_path(data_dir, step)
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        state = json.load(f)
+    return (state["signature"] == signature
+            and all(os.path.exists(output) for output in step.outputs))
+
+
+def _record_run(data_dir, step, signature):
+    os.makedirs(os.path.join(data_dir, STATE_DIR), exist_ok=True)
+    with open(_state_path(data_dir, step), "w") as f:
+        json.dump({"signature": signature, "outputs": step.outputs}, f, indent=1)
+
+
+def run_steps(data_dir, steps, workers=None, force=False, dry_run=False):
+    """
+    Run steps, each as soon as the steps it depends on have finished, up to
+    workers at once in a process pool, skipping any that are up to date.
+
+    A step is only checked once the steps it depends on have run, so it
+    sees their new outputs. If a step fails, the steps depending on it are
+    not run, everything else is.
+
+    Parameters:
+        force (bool): run every step, up to date or not.
+        dry_run (bool): only log what would run; any step depending on one
+            that would run is assumed to run too.
+
+    Returns:
+       dict: step name to ran, up to date, would run, failed or blocked.
+    """
+    status = {}
+    pending = dict(steps)
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name, step in list(pending.items()):
+                if any(status.get(dep) in ("failed", "blocked") for dep in step.deps):
+                    logger.warning(f"Not running {name}, a step it depends on failed")
+                    status[name] = "blocked"
+                    del pending[name]
+                elif all(status.get(dep) in ("ran", "up to date", "would run")
+                         for dep in step.deps):
+                    del pending[name]
+                    signature = step.signature()
+                    if not force and not any(status[dep] == "would run" for dep in step.deps) \
+                            and is_up_to_date(data_dir, step, signature):
+                        logger.info(f"{name} is up to date")
+                        status[name] = "up to date"
+                    elif dry_run:
+                        logger.info(f"Would run {name}")
+                        status[name] = "would run"
+                    else:
+                        logger.info(f"Running {name}...")
+                        running[executor.submit(step.function, **step.parameters)] = step
+            if not running:
+                # skipping steps may have let others start
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f"{step.name} failed")
+                    status[step.name] = "failed"
+                    continue
+                # the signature after running, as the step may have read
+                # inputs written by the steps it depends on
+                _record_run(data_dir, step, step.signature())
+                logger.info(f"Finished {step.name}")
+                status[step.name] = "ran"
+    return status
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Stratify, sample and analyse every test in a config, '
+                    'running independent steps in parallel and skipping any '
+                    'that are up to date',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'config', help='''
+        JSON file of the tests to run, with their date ranges, variants,
+        strata and analysis settings, see load_config
+        ''')
+    parser.add_argument('--tests', nargs='+', default=None,
+                        help='only run these tests of the config')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='number of processes, all cores if not given')
+    parser.add_argument('--force', action='store_true',
+                        help='run every step, even those that are up to date')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='only list the steps that would run')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('pipeline')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+
+    tests = load_config(args.config)
+    if args.tests is not None:
+        tests = {test: tests[test] for test in args.tests}
+    status = run_steps(DATA_DIR, build_steps(DATA_DIR, tests),
+                       workers=args.workers, force=args.force,
+                       dry_run=args.dry_run)
+    counts = pd.Series(status).value_counts()
+    logger.info(", ".join(f"{count} {state}" for state, count in counts.items()))
+    if counts.get("failed", 0) or counts.get("blocked", 0):
+        sys.exit(1)
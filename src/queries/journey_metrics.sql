@@ -0,0 +1,83 @@
+-- per journey type metrics for related links A/B tests, the same definitions as the pandas
+-- derivation in analysis.py, run over processed_journey files converted to parquet by journey_sql.py
+--
+-- expects:
+-- {journey_paths} a list of parquet files, Page_List, Page_Event_List and Event_cat_act_agg are
+--     lists rather than python literal strings
+-- {variants} the ABVariant values to keep, e.g. ['B', 'C'], anything else (like [object Object]) is junk
+-- thing_pages a registered table of distinct pagePath for "thing" (content) pages from document_types.csv.gz
+
+CREATE OR REPLACE VIEW journey_metrics AS
+WITH journeys AS (
+    SELECT
+    filename,
+    file_row_number,
+    Occurrences,
+    ABVariant,
+    Page_List,
+    Page_Event_List,
+    Event_cat_act_agg
+    FROM read_parquet({journey_paths}, filename = true, file_row_number = true)
+    WHERE ABVariant IN {variants}
+),
+
+-- nav events on a thing page; breadcrumbs, links to the homepage and "Explore the topic" links,
+-- like is_nav_event this tests whether the value is the category or the action, not a substring
+nav_events AS (
+    SELECT
+    filename,
+    file_row_number,
+    COUNT(*) AS Content_Page_Nav_Event_Count
+    FROM (
+        SELECT filename, file_row_number, UNNEST(Page_Event_List) AS page_event
+        FROM journeys)
+    INNER JOIN thing_pages ON thing_pages.pagePath = page_event.page
+    WHERE 'breadcrumbClicked' IN (page_event.category, page_event.action)
+        OR 'homeLinkClicked' IN (page_event.category, page_event.action)
+        OR ('relatedLinkClicked' IN (page_event.category, page_event.action)
+            AND 'Explore the topic' IN (page_event.category, page_event.action))
+    GROUP BY
+    filename,
+    file_row_number
+),
+
+-- a GOV.UK search straight after a thing page
+search_events AS (
+    SELECT
+    filename,
+    file_row_number,
+    COUNT(*) AS Content_Search_Event_Count
+    FROM (
+        SELECT
+        filename,
+        file_row_number,
+        Page_List[page_index - 1] AS previous_page,
+        Page_List[page_index] AS page
+        FROM (
+            SELECT filename, file_row_number, Page_List, GENERATE_SUBSCRIPTS(Page_List, 1) AS page_index
+            FROM journeys)
+        WHERE page_index > 1)
+    INNER JOIN thing_pages ON thing_pages.pagePath = previous_page
+    WHERE CONTAINS(page, '/search?q=')
+    GROUP BY
+    filename,
+    file_row_number
+)
+
+SELECT
+journeys.filename,
+journeys.file_row_number,
+Occurrences,
+ABVariant,
+LEN(Page_List) AS Page_List_Length,
+-- events with category 'relatedLinkClicked' and an action including 'Related content'
+COALESCE(LIST_SUM(LIST_TRANSFORM(
+    LIST_FILTER(Event_cat_act_agg,
+        event -> event.category = 'relatedLinkClicked' AND CONTAINS(event.action, 'Related content')),
+    event -> event.count)), 0) AS Related_Links_Clicks_per_seq,
+COALESCE(Content_Page_Nav_Event_Count, 0) AS Content_Page_Nav_Event_Count,
+COALESCE(Content_Search_Event_Count, 0) AS Content_Search_Event_Count,
+COALESCE(Content_Page_Nav_Event_Count, 0) + COALESCE(Content_Search_Event_Count, 0) AS Content_Nav_or_Search_Count
+FROM journeys
+LEFT JOIN nav_events USING (filename, file_row_number)
+LEFT JOIN search_events USING (filename, file_row_number);
@@ -0,0 +1,23 @@
+-- occurrence weighted totals per variant from the journey_metrics view (see journey_metrics.sql),
+-- the x and n of the z proportion tests and the numerators of the mean metrics in analysis.py
+
+SELECT
+ABVariant,
+SUM(Occurrences) AS journeys,
+SUM(CASE WHEN Related_Links_Clicks_per_seq > 0 THEN Occurrences ELSE 0 END) AS journeys_with_related,
+SUM(CASE WHEN Content_Nav_or_Search_Count = 0 THEN Occurrences ELSE 0 END) AS journeys_with_no_nav_or_search,
+SUM(Related_Links_Clicks_per_seq * Occurrences) AS related_links_clicks,
+SUM(Content_Page_Nav_Event_Count * Occurrences) AS content_page_nav_events,
+SUM(Content_Search_Event_Count * Occurrences) AS content_search_events,
+SUM(Content_Nav_or_Search_Count * Occurrences) AS content_nav_or_search_events,
+SUM(Page_List_Length * Occurrences) AS pages_viewed,
+-- proportions and means
+ROUND(journeys_with_related / journeys, 5) AS p_has_related,
+ROUND(journeys_with_no_nav_or_search / journeys, 5) AS p_has_no_nav_or_search,
+content_nav_or_search_events / journeys AS mean_content_nav_or_search_count,
+pages_viewed / journeys AS mean_page_list_length
+FROM journey_metrics
+GROUP BY
+ABVariant
+ORDER BY
+ABVariant
@@ -0,0 +1,194 @@
+import logging
+from contextlib import nullcontext
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+    from scipy import special
+except ImportError:
+    logging.error("Missing pandas, numpy and/or scipy library")
+    raise
+
+from journey_keys import hash_journeys
+from streaming_bootstrap import (WEIGHTS, gamma_weights, poisson_weights,
+                                 replicate_keys)
+
+logger = logging.getLogger('ratio_metrics')
+
+# ratio metrics, the occurrence weighted total of the numerator column over
+# the total of the denominator column, or over the number of journeys if None
+RATIO_METRICS = {
+    'Nav_Search_per_Related_Click': ('Content_Nav_or_Search_Count',
+                                     'Related Links Clicks per seq'),
+    'Related_Clicks_per_Journey': ('Related Links Clicks per seq', None),
+}
+
+# the sums of a variant's journeys a ratio metric's tests need, each weighted
+# by Occurrences, where x is the numerator and y the denominator
+SUFFICIENT_STATISTICS = ["n", "sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy"]
+
+
+def ratio_columns(ratio_metrics=RATIO_METRICS):
+    """The derived metric columns the ratio metrics are made from."""
+    columns = []
+    for numerator, denominator in ratio_metrics.values():
+        for column in [numerator, denominator]:
+            if column is not None and column not in columns:
+                columns.append(column)
+    return columns
+
+
+def ratio_histograms(df, ratio_metrics=RATIO_METRICS):
+    """
+    Occurrences per variant, numerator and denominator value of each ratio
+    metric.
+
+    Like analysis.metric_histograms these are small, can be added together
+    across files or chunks, and are all the tests need.
+
+    Returns:
+       dict: ratio metric name to a pandas Series of Occurrences indexed by
+       ABVariant, numerator and denominator.
+    """
+    histograms = {}
+    for metric, (numerator, denominator) in ratio_metrics.items():
+        y = df[denominator] if denominator is not None else np.ones(len(df), dtype=np.int64)
+        histogram = df.groupby([df['ABVariant'], df[numerator], y],
+                               observed=True)['Occurrences'].sum().astype(np.int64)
+        # the same index dtypes whatever the dtypes of df, so histograms can be added together
+        levels = [histogram.index.get_level_values(level) for level in range(3)]
+        histogram.index = pd.MultiIndex.from_arrays(
+            [levels[0].astype(object)] + [level.astype(np.int64) for level in levels[1:]],
+            names=['ABVariant', 'numerator', 'denominator'])
+        histograms[metric] = histogram
+    return histograms
+
+
+def sufficient_statistics(histogram):
+    """
+    The SUFFICIENT_STATISTICS of each variant, in one pass over a
+    ratio_histograms histogram.
+
+    Returns:
+       pandas.core.frame.DataFrame: indexed by ABVariant.
+    """
+    df = histogram.rename('n').reset_index()
+    x = df['numerator'].astype(np.float64)
+    y = df['denominator'].astype(np.float64)
+    n = df['n'].astype(np.float64)
+    df = pd.DataFrame({'ABVariant': df['ABVariant'], 'n': n,
+                       'sum_x': n * x, 'sum_y': n * y,
+                       'sum_xx': n * x * x, 'sum_yy': n * y * y,
+                       'sum_xy': n * x * y})
+    return df.groupby('ABVariant')[SUFFICIENT_STATISTICS].sum()
+
+
+def delta_method(statistics):
+    """
+    Each variant's ratio of means and its variance by the delta method,
+    from sufficient_statistics.
+
+    var(R) is approximately (var_x - 2 R cov_xy + R^2 var_y) / (n mean_y^2),
+    with the variances and covariance of a single journey.
+
+    Returns:
+       pandas.core.frame.DataFrame: ratio and variance, indexed by ABVariant.
+    """
+    n = statistics['n']
+    mean_x = statistics['sum_x'] / n
+    mean_y = statistics['sum_y'] / n
+    var_x = (statistics['sum_xx'] - n * mean_x ** 2) / (n - 1)
+    var_y = (statistics['sum_yy'] - n * mean_y ** 2) / (n - 1)
+    cov_xy = (statistics['sum_xy'] - n * mean_x * mean_y) / (n - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = mean_x / mean_y
+        variance = (var_x - 2 * ratio * cov_xy + ratio ** 2 * var_y) / (n * mean_y ** 2)
+    return pd.DataFrame({'ratio': ratio, 'variance': variance})
+
+
+def delta_method_intervals(statistics, variant_dict, alpha=0.05):
+    """
+    Closed form 1-alpha confidence intervals of each variant's ratio and of
+    the difference between them, B's ratio less A's, from the delta method.
+
+    Returns:
+       dict: a_ratio and b_ratio, then the keys of analysis.bb_hdi, with
+       prob_b_>_a the normal approximation of the probability that B's ratio
+       is greater than A's.
+    """
+    estimates = delta_method(statistics)
+    a = estimates.loc[variant_dict['CONTROL_GROUP']]
+    b = estimates.loc[variant_dict['INTERVENTION_GROUP']]
+    z_critical = special.ndtri(1 - 0.5 * alpha)
+    a_se, b_se = np.sqrt(a['variance']), np.sqrt(b['variance'])
+    diff = b['ratio'] - a['ratio']
+    # the variants are independent samples
+    diff_se = np.sqrt(a['variance'] + b['variance'])
+    return {'a_ratio': a['ratio'], 'b_ratio': b['ratio'],
+            'a_ci_low': a['ratio'] - z_critical * a_se, 'a_ci_hi': a['ratio'] + z_critical * a_se,
+            'b_ci_low': b['ratio'] - z_critical * b_se, 'b_ci_hi': b['ratio'] + z_critical * b_se,
+            'diff_mean': diff,
+            'diff_ci_low': diff - z_critical * diff_se, 'diff_ci_hi': diff + z_critical * diff_se,
+            'prob_b_>_a': special.ndtr(diff / diff_se)}
+
+
+def bootstrap_ratio(histogram, variants, boot_reps=10000, seed=1337, weights="dirichlet",
+                    block_size=100):
+    """
+    Bayesian bootstrap replicates of each variant's ratio metric, from a
+    ratio_histograms histogram.
+
+    Each replicate draws one weight per distinct (numerator, denominator)
+    pair of a variant, and the same weights make its weighted numerator and
+    denominator totals, so a replicate's ratio costs two dot products over
+    the histogram, as a mean metric's costs one.
+
+    Parameters:
+        histogram (pandas.core.series.Series): from ratio_histograms.
+        variants (list): the control and intervention variants.
+        boot_reps (int): number of replicates.
+        seed (int): random seed for reproducibility.
+        weights (str): 'dirichlet' draws the weights of each variant's pairs
+            from a Dirichlet of their Occurrences, as
+            analysis.bayesian_bootstrap_analysis does for a mean, 'gamma' or
+            'poisson' from a hash of the variant, pair and replicate, see
+            streaming_bootstrap.
+        block_size (int): number of replicates to draw hashed weights for at
+            a time, to bound memory.
+
+    Returns:
+       dict: variant to a numpy array of boot_reps ratios.
+    """
+    if weights not in ["dirichlet"] + list(WEIGHTS):
+        raise ValueError(f"weights must be dirichlet or one of {WEIGHTS}")
+    df = histogram.rename('Occurrences').reset_index()
+    df = df[df['ABVariant'].isin(variants)]
+    row_keys = hash_journeys(df, ['ABVariant', 'numerator', 'denominator']).values
+    if weights == "dirichlet":
+        from astropy.utils import NumpyRNGContext
+        # one stream for both variants, as bayesian_bootstrap_analysis
+        context = NumpyRNGContext(seed)
+    else:
+        context = nullcontext()
+    bootstraps = {}
+    with context:
+        for variant in variants:
+            rows = (df['ABVariant'] == variant).values
+            x = df.loc[rows, 'numerator'].values.astype(np.float64)
+            y = df.loc[rows, 'denominator'].values.astype(np.float64)
+            occurrences = df.loc[rows, 'Occurrences'].values
+            if weights == "dirichlet":
+                matrix = np.random.dirichlet(occurrences, boot_reps)
+                sum_x, sum_y = matrix @ x, matrix @ y
+            else:
+                draw = gamma_weights if weights == "gamma" else poisson_weights
+                sum_x, sum_y = np.zeros(boot_reps), np.zeros(boot_reps)
+                for start in range(0, boot_reps, block_size):
+                    stop = min(start + block_size, boot_reps)
+                    matrix = draw(row_keys[rows], occurrences,
+                                  replicate_keys(np.arange(start, stop), seed))
+                    sum_x[start:stop] = x @ matrix
+                    sum_y[start:stop] = y @ matrix
+            with np.errstate(invalid='ignore', divide='ignore'):
+                bootstraps[variant] = sum_x / sum_y
+    return bootstraps
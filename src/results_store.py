@@ -0,0 +1,313 @@
+import os
+import sys
+import sqlite3
+import argparse
+import logging.config
+from contextlib import contextmanager
+from datetime import datetime
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+except ImportError:
+    logging.error("Missing pandas and/or numpy library")
+    sys.exit()
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('results_store')
+
+# the directory in DATA_DIR the store is kept in
+RESULTS_DIR = "results_store"
+
+DATABASE = "results.sqlite"
+
+# the bootstrap replicates of each run, one compressed .npz per run
+POSTERIORS_DIR = "posteriors"
+
+# what a run is recorded with, and can be looked up by
+RUN_COLUMNS = ["test", "stratum", "filename", "control_group",
+               "intervention_group", "alpha", "boot_reps",
+               "bootstrap_weights"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TEXT,
+    test TEXT,
+    stratum TEXT,
+    filename TEXT,
+    control_group TEXT,
+    intervention_group TEXT,
+    alpha REAL,
+    boot_reps INTEGER,
+    bootstrap_weights TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_test_stratum ON runs (test, stratum);
+
+CREATE TABLE IF NOT EXISTS zprop (
+    run_id INTEGER REFERENCES runs (run_id),
+    metric_name TEXT,
+    stats_method TEXT,
+    x_ab INTEGER, n_ab INTEGER, p REAL,
+    x_a INTEGER, n_a INTEGER, p_a REAL,
+    x_b INTEGER, n_b INTEGER, p_b REAL,
+    test_statistic REAL,
+    p_value REAL,
+    ci_low REAL,
+    ci_upp REAL
+);
+CREATE INDEX IF NOT EXISTS zprop_metric ON zprop (metric_name, run_id);
+
+CREATE TABLE IF NOT EXISTS bayesbootstrap (
+    run_id INTEGER REFERENCES runs (run_id),
+    metric TEXT,
+    a_ci_low REAL, a_ci_hi REAL,
+    b_ci_low REAL, b_ci_hi REAL,
+    diff_mean REAL, diff_ci_low REAL, diff_ci_hi REAL,
+    prob_b_gt_a REAL
+);
+CREATE INDEX IF NOT EXISTS bayesbootstrap_metric
+    ON bayesbootstrap (metric, run_id);
+
+CREATE TABLE IF NOT EXISTS ratio (
+    run_id INTEGER REFERENCES runs (run_id),
+    metric TEXT,
+    stats_method TEXT,
+    a_ratio REAL, b_ratio REAL,
+    a_ci_low REAL, a_ci_hi REAL,
+    b_ci_low REAL, b_ci_hi REAL,
+    diff_mean REAL, diff_ci_low REAL, diff_ci_hi REAL,
+    prob_b_gt_a REAL
+);
+CREATE INDEX IF NOT EXISTS ratio_metric ON ratio (metric, run_id);
+
+CREATE TABLE IF NOT EXISTS posteriors (
+    run_id INTEGER REFERENCES runs (run_id),
+    metric TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS posteriors_run ON posteriors (run_id, metric);
+"""
+
+# results file columns that aren't valid SQL names
+RENAMED_COLUMNS = {"p-value": "p_value", "Metric": "metric",
+                   "prob_b_>_a": "prob_b_gt_a"}
+
+# the tables of test results, and the column naming the metric in each
+RESULT_TABLES = {"zprop": "metric_name", "bayesbootstrap": "metric",
+                 "ratio": "metric"}
+
+
+def _check_run_columns(run):
+    """Raise a ValueError unless every key of run is one of RUN_COLUMNS."""
+    unknown = set(run) - set(RUN_COLUMNS)
+    if unknown:
+        raise ValueError(f"unknown run columns {sorted(unknown)}, "
+                         f"choose from {RUN_COLUMNS}")
+
+
+class ResultsStore:
+    """
+    Every analysis run, its z_prop, Bayesian bootstrap and ratio metric
+    results and its bootstrap replicates, in a SQLite database and compressed numpy files
+    in the directory path.
+
+    Results can be looked up by test, stratum, metric and any of the
+    RUN_COLUMNS, so comparing tests or re-plotting posteriors doesn't need
+    the analysis to be run again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, POSTERIORS_DIR), exist_ok=True)
+        with self.connect() as con:
+            # so parallel runs, e.g. one per stratum, can record at once
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """
+        A connection to the database, in a transaction committed at the end
+        of the with block, waiting for any other process writing to it.
+        """
+        con = sqlite3.connect(os.path.join(self.path, DATABASE), timeout=60)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def record(self, df_ab, df_bayes, bootstraps=None, df_ratio=None, **run):
+        """
+        Record the results of an analysis run.
+
+        Parameters:
+            df_ab (pandas.core.frame.DataFrame): z_prop results.
+            df_bayes (pandas.core.frame.DataFrame): Bayesian bootstrap
+                results.
+            bootstraps (dict): metric name to (a_bootstrap, b_bootstrap), the
+                replicates of the Bayesian bootstraps.
+            df_ratio (pandas.core.frame.DataFrame): ratio metric results,
+                from analysis.test_ratio_histograms.
+            run: values of RUN_COLUMNS.
+
+        Returns:
+           int: the run_id of the run.
+        """
+        _check_run_columns(run)
+        columns = ["created"] + list(run)
+        values = [datetime.now().isoformat(timespec="seconds")] + [
+            value.item() if isinstance(value, np.generic) else value
+            for value in run.values()]
+        with self.connect() as con:
+            run_id = con.execute(
+                f"INSERT INTO runs ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})", values).lastrowid
+            for table, df in [("zprop", df_ab), ("bayesbootstrap", df_bayes),
+                              ("ratio", df_ratio)]:
+                if df is None:
+                    continue
+                df = df.rename(columns=RENAMED_COLUMNS)
+                df.insert(0, "run_id", run_id)
+                df.infer_objects().to_sql(table, con, if_exists="append",
+                                          index=False)
+            if bootstraps:
+                posterior_path = os.path.join(POSTERIORS_DIR,
+                                              f"run_{run_id}.npz")
+                np.savez_compressed(
+                    os.path.join(self.path, posterior_path),
+                    **{f"{metric}__{variant}": np.asarray(bootstrap)
+                       for metric, (a_bootstrap, b_bootstrap)
+                       in bootstraps.items()
+                       for variant, bootstrap in [("a", a_bootstrap),
+                                                  ("b", b_bootstrap)]})
+                con.executemany(
+                    "INSERT INTO posteriors (run_id, metric, path) "
+                    "VALUES (?, ?, ?)",
+                    [(run_id, metric, posterior_path) for metric in bootstraps])
+        logger.info(f"Recorded run {run_id} in {self.path}")
+        return run_id
+
+    @staticmethod
+    def _where(conditions):
+        """A WHERE clause and its parameters, for a dict of column to value, None matching anything."""
+        conditions = {column: value for column, value in conditions.items()
+                      if value is not None}
+        if not conditions:
+            return "", []
+        clauses = [f"{column} = ?" for column in conditions]
+        return " WHERE " + " AND ".join(clauses), list(conditions.values())
+
+    def runs(self, **run):
+        """The runs with the given values of RUN_COLUMNS, e.g. test='ab1'."""
+        _check_run_columns(run)
+        where, parameters = self._where(
+            {f"runs.{column}": value for column, value in run.items()})
+        with self.connect() as con:
+            return pd.read_sql_query(f"SELECT * FROM runs{where} ORDER BY run_id",
+                                     con, params=parameters)
+
+    def results(self, table="bayesbootstrap", metric=None, latest=False, **run):
+        """
+        Test results with their run's parameters, e.g. every test's
+        Page_List_Length bootstrap results for the loved stratum.
+
+        Parameters:
+            table (str): zprop, bayesbootstrap or ratio.
+            metric (str): only this metric.
+            latest (bool): only the latest run of each test, stratum and
+                filename with the parameters.
+            run: values of RUN_COLUMNS the runs must have.
+
+        Returns:
+           pandas.core.frame.DataFrame: the run columns followed by the
+           results columns, one row per run and metric.
+        """
+        if table not in RESULT_TABLES:
+            raise ValueError(f"table must be one of {list(RESULT_TABLES)}")
+        _check_run_columns(run)
+        conditions = {f"runs.{column}": value for column, value in run.items()}
+        conditions[f"{table}.{RESULT_TABLES[table]}"] = metric
+        where, parameters = self._where(conditions)
+        with self.connect() as con:
+            df = pd.read_sql_query(
+                f"SELECT * FROM {table} JOIN runs USING (run_id){where} "
+                f"ORDER BY run_id", con, params=parameters)
+        if latest:
+            latest_runs = df.groupby(["test", "stratum", "filename"],
+                                     dropna=False)["run_id"].transform("max")
+            df = df[df["run_id"] == latest_runs].reset_index(drop=True)
+        run_columns = ["run_id", "created"] + RUN_COLUMNS
+        return df[run_columns + [c for c in df.columns if c not in run_columns]]
+
+    def posterior(self, run_id, metric):
+        """
+        The bootstrap replicates of metric in a run.
+
+        Returns:
+           (numpy.ndarray, numpy.ndarray): a_bootstrap and b_bootstrap.
+        """
+        with self.connect() as con:
+            row = con.execute(
+                "SELECT path FROM posteriors WHERE run_id = ? AND metric = ?",
+                (int(run_id), metric)).fetchone()
+        if row is None:
+            raise KeyError(f"no posterior of {metric} for run {run_id}")
+        with np.load(os.path.join(self.path, row[0])) as arrays:
+            return arrays[f"{metric}__a"], arrays[f"{metric}__b"]
+
+
+def results_store_path(data_dir):
+    """The directory of the results store in data_dir."""
+    return os.path.join(data_dir, RESULTS_DIR)
+
+
+def open_results_store(data_dir):
+    """Open, or create, the results store in data_dir."""
+    return ResultsStore(results_store_path(data_dir))
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Look up recorded A/B test results',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'table', choices=["runs"] + list(RESULT_TABLES), help='''
+        what to list, the runs, or their zprop, bayesbootstrap or ratio
+        results, from the results store in DATA_DIR
+        ''')
+    parser.add_argument('--test', default=None, help='only this test, e.g. ab1')
+    parser.add_argument('--stratum', default=None,
+                        help='only this stratum, e.g. loved')
+    parser.add_argument('--metric', default=None,
+                        help='only this metric, e.g. Page_List_Length')
+    parser.add_argument('--bootstrap_weights', default=None,
+                        help='only runs with these bootstrap weights')
+    parser.add_argument('--latest', action='store_true',
+                        help='only the latest run of each test and stratum')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('results_store')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+
+    store = open_results_store(DATA_DIR)
+    run = {"test": args.test, "stratum": args.stratum,
+           "bootstrap_weights": args.bootstrap_weights}
+    if args.table == "runs":
+        df = store.runs(**run)
+    else:
+        df = store.results(args.table, metric=args.metric, latest=args.latest,
+                           **run)
+    with pd.option_context("display.max_rows", None,
+                           "display.max_columns", None, "display.width", None):
+        print(df)
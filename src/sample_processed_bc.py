@@ -1,7 +1,6 @@
 import sys
 import os
 import argparse
-import glob
 # import random
 import logging.config
 # .. other safe imports
@@ -15,8 +14,16 @@ except ImportError:
     # raise ImportError("Missing pandas library")
     sys.exit()
 
+from journey_io import (OUTPUT_CODECS, list_journey_files, output_extension,
+                        read_journeys, strip_journey_extension, write_journeys)
+from journey_keys import JOURNEY_KEY, add_journey_key, roll_up
+from journey_store import date_range_suffix, load_store
+
 logging.debug("other modules loaded")
 
+# the same logger the command line sets up, so the functions also log when imported
+logger = logging.getLogger('sample_processed_journey')
+
 
 # other cols we might want are:"Sequence", 'PageSequence', 'Event_List',
 # 'num_event_cats', "Event_cats_agg"
@@ -29,7 +36,7 @@ REQUIRED_COLUMNS_WITHOUT_OCC = [
 
 def get_df_total_occurrences_per_variant(filepath):
     logger.info(f"reading in occurrences from {filepath}")
-    df = pd.read_csv(filepath, sep="\t", usecols=["Occurrences", "ABVariant"])
+    df = read_journeys(filepath, usecols=["Occurrences", "ABVariant"])
     logger.info("getting total occurrences per variant for this file")
     total_occurrences = df.groupby('ABVariant').sum()
     return total_occurrences
@@ -37,7 +44,8 @@ def get_df_total_occurrences_per_variant(filepath):
 
 def sample_one_file_processed_journey(
         data_dir, filepath, seed=1337, b_k=500, c_k=500,
-        with_replacement=True):
+        with_replacement=True, output_format="csv", codec="gzip", threads=1,
+        out_dir=None):
     """
     Samples from processed journey file.
 
@@ -54,21 +62,32 @@ def sample_one_file_processed_journey(
         a_k (int): The number of journeys in the sample for variant A.
         b_k (int): The number of journeys in the sample for variant B.
         with_replacement (bool): Whether the sample is with or without replacement.
+        output_format (str): 'csv' or 'parquet', the format of the sample file.
+        codec (str): compression codec for the sample file, see
+            journey_io.OUTPUT_CODECS.
+        threads (int): number of threads to compress with.
+        out_dir (str): The directory to save the sample in,
+            data_dir/sampled_journey if None.
 
     Returns:
-       pandas.core.frame.DataFrame: A sampled data frame.
+       str: The filepath the sample was saved to.
     """
 
     # having issue with global env, $PWD not recognised in pycharm, so can't use DATA_DIR
     # assume current work dir is project dir
     filename = os.path.basename(filepath)
     logger.info(f"Reading in file {filename}")
-    df = pd.read_csv(filepath, sep='\t', usecols=REQUIRED_COLUMNS)
+    df = read_journeys(filepath, usecols=REQUIRED_COLUMNS)
     logger.debug(f'{filename} DataFrame shape {df.shape}')
 
+    # hash each journey type once, so we sample and roll up integer keys
+    # rather than grouping on the long string columns
+    add_journey_key(df, REQUIRED_COLUMNS_WITHOUT_OCC)
+
     logger.info("Finished reading, now removing any  B or C variants")
     # filter out any weird values like Object object, select useful cols
-    clean_thin_df = df.query("ABVariant in ['B', 'C']")[REQUIRED_COLUMNS]
+    clean_thin_df = df.query("ABVariant in ['B', 'C']")[
+        REQUIRED_COLUMNS + [JOURNEY_KEY]]
     logger.debug(f'Cleaned DataFrame shape {clean_thin_df.shape}')
 
     logger.info("Finished removing any non  B or C variants, now sampling")
@@ -78,35 +97,42 @@ def sample_one_file_processed_journey(
     #     random_state=seed)
     # logger.debug(f'Sampled A variant DataFrame shape {a_df_sampled.shape}')
 
-    b_df_sampled = clean_thin_df[clean_thin_df["ABVariant"] == 'B'].sample(
+    b_keys_sampled = clean_thin_df.loc[
+        clean_thin_df["ABVariant"] == 'B', JOURNEY_KEY].sample(
         n=b_k, replace=with_replacement, weights=clean_thin_df.Occurrences,
         random_state=seed)
-    logger.debug(f'Sampled B variant DataFrame shape {b_df_sampled.shape}')
+    logger.debug(f'Sampled B variant keys shape {b_keys_sampled.shape}')
 
-    c_df_sampled = clean_thin_df[clean_thin_df["ABVariant"] == 'C'].sample(
+    c_keys_sampled = clean_thin_df.loc[
+        clean_thin_df["ABVariant"] == 'C', JOURNEY_KEY].sample(
         n=b_k, replace=with_replacement, weights=clean_thin_df.Occurrences,
         random_state=seed)
-    logger.debug(f'Sampled C variant DataFrame shape {b_df_sampled.shape}')
+    logger.debug(f'Sampled C variant keys shape {c_keys_sampled.shape}')
 
-    # instead of setting all rows of Occurrences col to one, we can just group
-    # by the other things and count the rows instead of summing
-    # occurrences, to roll up data
+    # instead of setting all rows of Occurrences col to one, we can just count
+    # how many times each key was sampled, to roll up data
 
-    df_sampled = pd.concat([b_df_sampled, c_df_sampled])
-    logger.debug(f'Overall sampled DataFrame shape {df_sampled.shape}')
+    keys_sampled = pd.concat([b_keys_sampled, c_keys_sampled])
+    logger.debug(f'Overall sampled keys shape {keys_sampled.shape}')
 
     logger.info("rolling up data")
 
-    df_sampled_grouped = df_sampled.groupby(
-        REQUIRED_COLUMNS_WITHOUT_OCC).count().reset_index()
+    df_sampled_grouped = roll_up(
+        clean_thin_df, keys_sampled.value_counts(sort=False),
+        REQUIRED_COLUMNS_WITHOUT_OCC)
 
     logger.debug(f'Sampled and rolled up DataFrame shape '
                  f'{df_sampled_grouped.shape}')
 
-    logger.info(f"Saving to data/sampled_journey/{filename}")
-    out_path = os.path.join(data_dir, "sampled_journey", filename)
-    df_sampled_grouped.to_csv(out_path, sep="\t", compression="gzip",
-                              index=False)
+    out_filename = strip_journey_extension(filename) + output_extension(
+        output_format, codec)
+    out_dir = out_dir or os.path.join(data_dir, "sampled_journey")
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, out_filename)
+    logger.info(f"Saving to {out_path}")
+    write_journeys(df_sampled_grouped, out_path, output_format=output_format,
+                   codec=codec, threads=threads)
+    return out_path
 
 
 def get_k_list_for_variant(k, variant, occurrences_df_list):
@@ -140,33 +166,48 @@ def get_k_list_for_variant(k, variant, occurrences_df_list):
 
 
 def sample_multiple_days_processed_journey(
-        data_dir, filename_prefix, seed=1337, k=1000, with_replacement=True):
+        data_dir, filename_prefix, seed=1337, k=1000, with_replacement=True,
+        output_format="csv", codec="gzip", threads=1, start_date=None,
+        end_date=None, sample_name=None):
     """
     Samples from multiple processed journey files, to get one proportional
     sample of k journeys, saved in one file in the sampled_journey directory.
     First it samples each file beginning with filename_prefix in
     data_dir/processed_journey, then saves that file's sample in
-    data_dir/sampled_journey, then takes all the files beginning with
-    filename_prefix in data_dir/sampled_journey and combines them to get one
-    sample file. Make sure there aren't any rogue files in
-    data_dir/sampled_journey when you start!
+    data_dir/sampled_journey, then takes all the files it just saved and
+    combines them to get one sample file.
 
     Parameters:
         data_dir: The directory processed_journey and sampled_journey can be
             found in
         filename_prefix (str): The filename prefix of the processed journeys,
             we will sample from all the days that start with this file prefix
-            and end with .csv.gz that are found in data_dir/processed_journey.
+            that are found in data_dir/processed_journey, in any format
+            journey_io can read.
         seed (int): The random seed for reproducibility.
         k (int): The number of journeys in the sample for each variant.
         with_replacement (bool): Whether the sample is with or without replacement.
+        output_format (str): 'csv' or 'parquet', the format of the sample files.
+        codec (str): compression codec for the sample files, see
+            journey_io.OUTPUT_CODECS.
+        threads (int): number of threads to compress with.
+        start_date (str): The first day to sample, e.g. 2019-02-14, by the
+            date in the file names, from the first day if None.
+        end_date (str): The last day to sample, to the last day if None.
+        sample_name (str): The name of the sample file, without extension,
+            full_sample_<<filename_prefix>><<date range>>_<<k>> if None.
+            If given, each file's sample is saved in the directory
+            <<sample_name>>_days in data_dir/sampled_journey instead, so
+            samples of the same days running at once don't overwrite each
+            other's.
 
     Returns:
-       None
+       str: The filepath the sample was saved to.
     """
 
-    filepath_list = sorted(glob.glob(
-        f'{data_dir}/processed_journey/{filename_prefix}*.csv.gz'))
+    filepath_list = list_journey_files(
+        os.path.join(data_dir, "processed_journey"), filename_prefix,
+        start_date=start_date, end_date=end_date)
 
     logger.info(f"work with files {filepath_list}")
 
@@ -184,27 +225,91 @@ def sample_multiple_days_processed_journey(
 
     logger.debug(f"B and C occurrences per file: {b_c_occ_list}")
 
-    for filepath, b_k, c_k in zip(filepath_list, b_k_list, c_k_list):
+    day_dir = None
+    if sample_name is not None:
+        day_dir = os.path.join(data_dir, "sampled_journey",
+                               sample_name + "_days")
+    sampled_filepath_list = [
         sample_one_file_processed_journey(
-            data_dir, filepath, seed=seed, b_k=int(round(b_k)), c_k=int(round(b_k)), with_replacement=with_replacement
+            data_dir, filepath, seed=seed, b_k=int(round(b_k)), c_k=int(round(b_k)), with_replacement=with_replacement,
+            output_format=output_format, codec=codec, threads=threads,
+            out_dir=day_dir
         )
-
-    sampled_filepath_list = glob.glob(
-        f'{data_dir}/sampled_journey/{filename_prefix}*.csv.gz')
+        for filepath, b_k, c_k in zip(filepath_list, b_k_list, c_k_list)]
 
     logger.info(f"Reading in all sampled journeys {sampled_filepath_list}")
     all_sample_df = pd.concat(
-        [pd.read_csv(f, sep="\t") for f in sampled_filepath_list])
+        [read_journeys(f) for f in sampled_filepath_list])
+    add_journey_key(all_sample_df, REQUIRED_COLUMNS_WITHOUT_OCC)
 
     logger.info("rolling up all sample DataFrame")
-    grouped_all_sample_df = all_sample_df.groupby(
-        REQUIRED_COLUMNS_WITHOUT_OCC).sum().reset_index()
+    grouped_all_sample_df = roll_up(
+        all_sample_df,
+        all_sample_df.groupby(JOURNEY_KEY, sort=False)['Occurrences'].sum(),
+        REQUIRED_COLUMNS_WITHOUT_OCC)
+
+    if sample_name is None:
+        sample_name = (f"full_sample_{filename_prefix}"
+                       f"{date_range_suffix(start_date, end_date)}_{k}")
+    out_path = os.path.join(
+        data_dir, "sampled_journey",
+        sample_name + output_extension(output_format, codec))
+    logger.info(f"Saving overall sample to {out_path}")
+    write_journeys(grouped_all_sample_df, out_path,
+                   output_format=output_format, codec=codec, threads=threads)
+    return out_path
+
+
+def sample_store_processed_journey(
+        data_dir, filename_prefix, seed=1337, k=1000, with_replacement=True,
+        start_date=None, end_date=None, output_format="csv", codec="gzip",
+        threads=1):
+    """
+    Samples k journeys per variant from the journey store for
+    filename_prefix (see journey_store.py), instead of reading every
+    processed journey file, saving one sample file in the sampled_journey
+    directory.
+
+    Each day in the date range contributes to the sample in proportion to its
+    occurrences, as in sample_multiple_days_processed_journey, but the day
+    samples are not saved.
+
+    Parameters:
+        data_dir: The directory journey_store and sampled_journey can be
+            found in
+        filename_prefix (str): The filename prefix the store was built for.
+        seed (int): The random seed for reproducibility.
+        k (int): The number of journeys in the sample for each variant.
+        with_replacement (bool): Whether the sample is with or without replacement.
+        start_date (str): The first day to sample, e.g. 2019-02-14, from the
+            first day in the store if None.
+        end_date (str): The last day to sample, to the last day in the store
+            if None.
+        output_format (str): 'csv' or 'parquet', the format of the sample file.
+        codec (str): compression codec for the sample file, see
+            journey_io.OUTPUT_CODECS.
+        threads (int): number of threads to compress with.
 
-    out_path = os.path.join(data_dir, "sampled_journey",
-                            f"full_sample_{filename_prefix}_{k}.csv.gz")
+    Returns:
+       str: The filepath the sample was saved to.
+    """
+    store = load_store(data_dir, filename_prefix)
+    logger.info(f"sampling {k} journeys per variant from {len(store)} "
+                f"journeys in the store")
+    sample_df = store.sample(
+        k, variants=['B', 'C'], seed=seed, with_replacement=with_replacement,
+        start_date=start_date, end_date=end_date)
+    logger.debug(f'Sampled and rolled up DataFrame shape {sample_df.shape}')
+
+    out_path = os.path.join(
+        data_dir, "sampled_journey",
+        f"full_sample_{filename_prefix}"
+        f"{date_range_suffix(start_date, end_date)}_{k}"
+        f"{output_extension(output_format, codec)}")
     logger.info(f"Saving overall sample to {out_path}")
-    grouped_all_sample_df.to_csv(
-        out_path, sep="\t", compression="gzip", index=False)
+    write_journeys(sample_df, out_path, output_format=output_format,
+                   codec=codec, threads=threads)
+    return out_path
 
 
 # for each DF get total occurrences
@@ -225,7 +330,8 @@ if __name__ == "__main__":  # our module is being executed as a program
         Prefix of files we want to sample. We will read from the 
         processed_journey directory from the DATA_DIR specified in you .envrc, 
         and write to the sampled_journey directory in DATA_DIR, the overall 
-        sample will be saved as full_sample_<<filename_prefix>>_<<k>>.csv.gz
+        sample will be saved as full_sample_<<filename_prefix>>_<<k>>.csv.gz,
+        or with the extension for the chosen --output_format and --codec
         ''')
     parser.add_argument(
         '--seed', help='''
@@ -241,22 +347,65 @@ if __name__ == "__main__":  # our module is being executed as a program
         '--with_replacement',
         help='do you want to sample with or without replacement?',
         default=True, type=bool)
+    parser.add_argument(
+        '--output_format', help='''
+        format of the sample files, parquet is columnar and much quicker to
+        read back in than csv
+        ''', default="csv", choices=list(OUTPUT_CODECS))
+    parser.add_argument(
+        '--codec', help='''
+        compression codec for the sample files, defaults to gzip for csv and
+        zstd for parquet
+        ''', default=None,
+        choices=sorted(set(sum(OUTPUT_CODECS.values(), []))))
+    parser.add_argument(
+        '--threads', help='''
+        number of threads to compress csv files with, gzip needs isal and lz4
+        is always single threaded
+        ''', default=1, type=int)
+    parser.add_argument(
+        '--store', action='store_true', help='''
+        sample from the journey store for filename_prefix built by
+        journey_store.py, instead of the processed_journey files
+        ''')
+    parser.add_argument(
+        '--start_date', default=None, help='''
+        the first day to sample, e.g. 2019-02-14, from the store with --store
+        or by the date in the processed journey file names
+        ''')
+    parser.add_argument(
+        '--end_date', default=None, help='''
+        the last day to sample
+        ''')
     parser.add_argument(
         '--debug-level',
         help='debug level of messages (DEBUG, INFO, WARNING, etc...)',
         default="INFO")
     args = parser.parse_args()
+    codec = args.codec or OUTPUT_CODECS[args.output_format][0]
 
     # Logger setup
     LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
-    logging.config.fileConfig(LOGGING_CONFIG)
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
     logger = logging.getLogger('sample_processed_journey')
     logger.setLevel(getattr(logging, args.debug_level))
 
     DATA_DIR = os.getenv("DATA_DIR")
     logger.debug(f"data directory {DATA_DIR}")
     logger.debug(f"Args: seed={args.seed}, k={args.k}, "
-                 f"with_replacement={args.with_replacement}")
-    sample_multiple_days_processed_journey(
-        DATA_DIR, args.filename_prefix, seed=args.seed, k=args.k,
-        with_replacement=args.with_replacement)
+                 f"with_replacement={args.with_replacement}, "
+                 f"output_format={args.output_format}, codec={codec}")
+    if args.store:
+        sample_store_processed_journey(
+            DATA_DIR, args.filename_prefix, seed=args.seed, k=args.k,
+            with_replacement=args.with_replacement,
+            start_date=args.start_date, end_date=args.end_date,
+            output_format=args.output_format, codec=codec,
+            threads=args.threads)
+    else:
+        sample_multiple_days_processed_journey(
+            DATA_DIR, args.filename_prefix, seed=args.seed, k=args.k,
+            with_replacement=args.with_replacement,
+            output_format=args.output_format, codec=codec,
+            threads=args.threads, start_date=args.start_date,
+            end_date=args.end_date)
@@ -0,0 +1,194 @@
+import os
+import re
+import ast
+import sys
+import json
+import argparse
+import logging.config
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+except ImportError:
+    logging.error("Missing pandas and/or numpy library")
+    sys.exit()
+
+from journey_arrays import event_arrays, segment_sums
+from journey_io import (DATE_PATTERN, list_journey_files, read_journeys,
+                        strip_journey_extension, write_journeys)
+
+logging.debug("other modules loaded")
+
+logger = logging.getLogger('stratify')
+
+REQUIRED_COLUMNS = ["Occurrences", "ABVariant", "Page_Event_List",
+                    "Page_List", "Event_cat_act_agg"]
+
+# loved journeys have at least one loved page, unloved journeys none
+STRATA = ["loved", "unloved"]
+
+# the metadata loved pages are worked out from, in DATA_DIR/metadata
+CLEAN_CONTENT_FILENAME = "clean_content_links.csv"
+HMRC_CONTACT_PAGES_FILENAME = "hmrc_contact_pages.json"
+
+# content items with any of these have related links
+RELATED_LINK_COLUMNS = ["related_mainstream_content", "ordered_related_items",
+                        "part_of_step_navs", "quick_links"]
+
+LOVED_PAGE_PATTERN = re.compile(
+    r'/foreign-travel-advice/|/find-local-council/|/premises-licence/')
+
+LOVED_PAGES = {
+    '/help', '/help/terms-conditions', '/help/about-govuk',
+    '/help/accessibility', '/help/privacy-policy', '/help/cookies',
+    '/help/update-email-notifications', '/help/browsers', '/help/beta',
+    '/visit-europe-brexit', '/apply-company-tachograph-card', '/cymraeg',
+    '/guidance/apprenticeship-funding-rules'}
+
+# pages whose paths contain any of these are loved
+LOVED_PAGE_PARTS = [
+    '/food-premises-approval', '/marriage-abroad',
+    '/guidance/transport-goods-out-of-the-uk-by-road-if-the-uk-leaves-the-eu-without-a-deal-checklist-for-hauliers',
+    '/check-british-citizenship', '/renew-driving-licence']
+
+
+def related_link_page_paths(clean_content_df):
+    """
+    The page paths of content items with related links, each base path and
+    base path/slug, as in the page level part of
+    get_unloved_and_loved_journeys.ipynb.
+
+    Returns:
+       (set, list): the loved page paths, and the paths of smart answers
+       followed by /, as each answer gets its own slug.
+    """
+    df = clean_content_df[
+        clean_content_df[RELATED_LINK_COLUMNS].notnull().any(axis=1)].copy()
+    # the plain base path is a page too, whether or not it has an empty slug
+    df['slugs'] = df['slugs'].fillna("['']").map(ast.literal_eval).map(
+        lambda slugs: list(set([''] + list(slugs))))
+    df = df.explode('slugs')
+    df['pagePath'] = df['base_path'] + df['slugs'].map(
+        lambda slug: '' if slug == '' else '/' + slug)
+    smart_answers = df.loc[df['document_type'] == 'simple_smart_answer',
+                           'pagePath'] + '/'
+    return set(df['pagePath']), sorted(set(smart_answers))
+
+
+class LovedPages:
+    """Whether a page is loved, see the README."""
+
+    def __init__(self, page_paths, smart_answers, hmrc_contact_pages):
+        self.page_paths = set(page_paths)
+        self.smart_answers = list(smart_answers)
+        self.hmrc_contact_pages = set(hmrc_contact_pages)
+
+    def is_loved_page(self, page):
+        """Is page, a page path maybe with a query string, a loved page?"""
+        page = page.split('?')[0]
+        return bool(
+            LOVED_PAGE_PATTERN.match(page)
+            or page in self.hmrc_contact_pages
+            or page in self.page_paths
+            or page in LOVED_PAGES
+            or any(path in page for path in self.smart_answers)
+            or any(path in page for path in LOVED_PAGE_PARTS))
+
+
+def load_loved_pages(data_dir):
+    """LovedPages from the clean content and HMRC contact pages in data_dir/metadata."""
+    metadata_dir = os.path.join(data_dir, 'metadata')
+    page_paths, smart_answers = related_link_page_paths(
+        pd.read_csv(os.path.join(metadata_dir, CLEAN_CONTENT_FILENAME)))
+    # the pages linked to from https://www.gov.uk/government/organisations/hm-revenue-customs/contact
+    with open(os.path.join(metadata_dir, HMRC_CONTACT_PAGES_FILENAME)) as f:
+        contact_pages = json.load(f)
+    hmrc_contact_pages = [link['base_path']
+                          for link in contact_pages['links']['children']]
+    return LovedPages(page_paths, smart_answers, hmrc_contact_pages)
+
+
+def is_loved_journey(df, loved_pages):
+    """
+    Whether each journey has at least one loved page in its Page_Event_List,
+    checking each distinct page once.
+
+    Page_Event_List rather than Page_List, as Page_List is made from it so
+    always includes more.
+    """
+    events = event_arrays(df, 'Page_Event_List')
+    is_loved = np.array([loved_pages.is_loved_page(page)
+                         for page in events.pages], dtype=np.int64)
+    return segment_sums(is_loved[events.page_ids], events.starts,
+                        events.stops) > 0
+
+
+def stratum_filename(filepath, stratum):
+    """
+    The name of the file of a stratum of a processed journey file, e.g.
+    loved_2019-02-14.csv.gz for taxon_ab_2019-02-14.csv.gz.
+    """
+    filename = os.path.basename(filepath)
+    match = DATE_PATTERN.search(filename)
+    day = match.group() if match else strip_journey_extension(filename)
+    return f"{stratum}_{day}.csv.gz"
+
+
+def stratify_file(filepath, loved_pages):
+    """
+    Split a processed journey file into loved and unloved journeys, saved
+    next to it as stratum_filename.
+
+    Returns:
+       list: the paths of the loved and unloved files.
+    """
+    logger.info(f"Stratifying {filepath}...")
+    df = read_journeys(filepath, usecols=REQUIRED_COLUMNS)
+    loved = is_loved_journey(df, loved_pages)
+    occurrences = df['Occurrences'].values
+    logger.info(f"{occurrences[~loved].sum() / occurrences.sum():2.2%} of "
+                f"journeys are unloved in {os.path.basename(filepath)}")
+    out_paths = []
+    for stratum, rows in zip(STRATA, [loved, ~loved]):
+        out_path = os.path.join(os.path.dirname(filepath),
+                                stratum_filename(filepath, stratum))
+        logger.info(f"Saving to {out_path}")
+        write_journeys(df[rows], out_path)
+        out_paths.append(out_path)
+    return out_paths
+
+
+if __name__ == "__main__":  # our module is being executed as a program
+    parser = argparse.ArgumentParser(
+        description='Split processed journeys into loved and unloved '
+                    'journeys, as get_unloved_and_loved_journeys.ipynb does',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        'filename_prefix', help='''
+        Prefix of the processed journey files to stratify, in the
+        processed_journey directory in DATA_DIR. Each file's loved and
+        unloved journeys are saved next to it as loved_<<date>>.csv.gz and
+        unloved_<<date>>.csv.gz
+        ''')
+    parser.add_argument('--start_date', default=None,
+                        help='the first day to stratify, e.g. 2019-02-14')
+    parser.add_argument('--end_date', default=None,
+                        help='the last day to stratify')
+    parser.add_argument(
+        '--debug-level', default="INFO",
+        help='debug level of messages (DEBUG, INFO, WARNING etc...)')
+    args = parser.parse_args()
+
+    # Logger setup
+    LOGGING_CONFIG = os.getenv("LOGGING_CONFIG")
+    logging.config.fileConfig(LOGGING_CONFIG, disable_existing_loggers=False)
+    logger = logging.getLogger('stratify')
+    logger.setLevel(getattr(logging, args.debug_level))
+
+    DATA_DIR = os.getenv("DATA_DIR")
+
+    loved_pages = load_loved_pages(DATA_DIR)
+    for filepath in list_journey_files(
+            os.path.join(DATA_DIR, "processed_journey"), args.filename_prefix,
+            start_date=args.start_date, end_date=args.end_date):
+        stratify_file(filepath, loved_pages)
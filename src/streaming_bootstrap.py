@@ -0,0 +1,228 @@
+import logging
+# .. other safe imports
+try:
+    import pandas as pd
+    import numpy as np
+    from scipy import special
+except ImportError:
+    logging.error("Missing pandas, numpy and/or scipy library")
+    raise
+
+logger = logging.getLogger('streaming_bootstrap')
+
+# the ways a replicate can weight a journey row with Occurrences n:
+# gamma, Gamma(n, 1), the sum of an Exp(1) weight per occurrence, which once
+# normalised is the Dirichlet of the Bayesian bootstrap;
+# poisson, Poisson(n), a Poisson(1) count per occurrence, the classical
+# bootstrap for very large samples
+WEIGHTS = ("gamma", "poisson")
+
+# Gamma(n, 1) weights are sums of n exponentials up to this n, and use the
+# Wilson-Hilferty cube of a normal above it, where its error is below 0.1%
+MAX_EXACT_GAMMA = 16
+
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+def mix64(x):
+    """The splitmix64 finaliser, a 64-bit hash of each element of a uint64 array."""
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def replicate_keys(replicates, seed=1337):
+    """A 64-bit key for each replicate index, so each replicate draws different weights."""
+    replicates = np.asarray(replicates, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        return mix64(replicates + mix64(np.array([seed], dtype=np.uint64)))
+
+
+def hashed_uniforms(row_keys, rep_keys, stream=0):
+    """
+    A uniform on (0, 1) for every row and replicate, a hash of the row's key,
+    the replicate's key and stream, so the same row always gets the same
+    uniforms wherever and in whatever chunk it is read.
+
+    Returns:
+       numpy.ndarray: rows x replicates.
+    """
+    with np.errstate(over='ignore'):
+        stream_keys = mix64(np.asarray(rep_keys, dtype=np.uint64)
+                            + np.uint64(stream) * GOLDEN_GAMMA)
+    x = mix64(np.asarray(row_keys, dtype=np.uint64)[:, None]
+              ^ stream_keys[None, :])
+    # the top 53 bits, centred in their interval so never 0 or 1
+    return ((x >> np.uint64(11)).astype(np.float64) + 0.5) * 2.0 ** -53
+
+
+def _groups(values):
+    """The distinct values and the indices of the rows with each one."""
+    distinct, inverse = np.unique(values, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(distinct)))[:-1]
+    return distinct, np.split(order, bounds)
+
+
+def gamma_weights(row_keys, occurrences, rep_keys):
+    """
+    Gamma(Occurrences, 1) weights for every row and replicate.
+
+    Returns:
+       numpy.ndarray: rows x replicates.
+    """
+    occurrences = np.asarray(occurrences)
+    weights = np.empty((len(occurrences), len(rep_keys)))
+    small = occurrences <= MAX_EXACT_GAMMA
+
+    distinct, groups = _groups(occurrences[small])
+    small_rows = np.flatnonzero(small)
+    for n, rows in zip(distinct, groups):
+        rows = small_rows[rows]
+        log_uniforms = np.zeros((len(rows), len(rep_keys)))
+        for stream in range(int(n)):
+            log_uniforms += np.log(
+                hashed_uniforms(row_keys[rows], rep_keys, stream))
+        weights[rows] = -log_uniforms
+
+    large_rows = np.flatnonzero(~small)
+    if len(large_rows):
+        n = occurrences[large_rows].astype(np.float64)[:, None]
+        z = special.ndtri(hashed_uniforms(row_keys[large_rows], rep_keys))
+        weights[large_rows] = n * np.maximum(
+            1 - 1 / (9 * n) + z / np.sqrt(9 * n), 0) ** 3
+    return weights
+
+
+def poisson_weights(row_keys, occurrences, rep_keys):
+    """
+    Poisson(Occurrences) weights for every row and replicate, by inverting
+    the exact CDF, tabulated once for each distinct Occurrences value.
+
+    Returns:
+       numpy.ndarray: rows x replicates.
+    """
+    occurrences = np.asarray(occurrences)
+    uniforms = hashed_uniforms(row_keys, rep_keys)
+    weights = np.empty(uniforms.shape)
+    distinct, groups = _groups(occurrences)
+    for n, rows in zip(distinct, groups):
+        # beyond 10 standard deviations has probability below 1e-20
+        spread = 10 * np.sqrt(n) + 10
+        low = int(max(0, np.floor(n - spread)))
+        counts = np.arange(low, int(np.ceil(n + spread)) + 1)
+        # the Poisson CDF, as scipy.stats.poisson.cdf computes it
+        cdf = special.pdtr(counts, n)
+        weights[rows] = low + np.searchsorted(cdf, uniforms[rows])
+    return weights
+
+
+class BootstrapAccumulator:
+    """
+    Per replicate sums of weights and of weighted values of some metrics, for
+    each variant.
+
+    Each journey row is weighted by a draw that only depends on the row's key
+    and the replicate, so rows can be added a chunk at a time, and
+    accumulators for different chunks, files or worker processes added
+    together, giving the same replicates as adding every row at once.
+
+    Drawing the weights is most of the cost, so each block of weights is
+    drawn once and applied to every metric, which share them as the metrics
+    of a row share its bootstrap weight.
+
+    Gamma(n, 1) and Poisson(n) draws add up, a sum of independent Gamma(n_i,
+    1) draws being Gamma(sum n_i, 1), and likewise Poisson. One draw per
+    distinct (variant, value) cell of a histogram, with the cell's total
+    Occurrences, therefore has the same distribution as a draw per journey
+    row, which is how bayesian_bootstrap_analysis(weights=...) bootstraps a
+    histogram.
+    """
+
+    def __init__(self, metrics, variants, boot_reps=10000, seed=1337,
+                 weights="gamma", block_size=100):
+        if weights not in WEIGHTS:
+            raise ValueError(f"weights must be one of {WEIGHTS}")
+        self.metrics = list(metrics)
+        self.variants = list(variants)
+        self.boot_reps = boot_reps
+        self.seed = seed
+        self.weights = weights
+        self.block_size = block_size
+        self.sum_weights = np.zeros((len(self.variants), boot_reps))
+        self.sum_weighted = np.zeros(
+            (len(self.metrics), len(self.variants), boot_reps))
+
+    def add(self, variant, values, occurrences, row_keys):
+        """
+        Add journey rows of one variant.
+
+        Parameters:
+            variant (str): the ABVariant of the rows.
+            values (array like): rows x metrics, the value of each metric in
+                each row.
+            occurrences (array like): the Occurrences of each row.
+            row_keys (array like): uint64 keys identifying each row, e.g.
+                from journey_keys.hash_journeys. Rows must have different
+                keys unless they are meant to share their weights.
+        """
+        i = self.variants.index(variant)
+        # metrics x rows, so each metric's values are contiguous
+        values = np.ascontiguousarray(
+            np.asarray(values, dtype=np.float64).reshape(
+                -1, len(self.metrics)).T)
+        occurrences = np.asarray(occurrences)
+        row_keys = np.asarray(row_keys, dtype=np.uint64)
+        draw = gamma_weights if self.weights == "gamma" else poisson_weights
+        # a block of replicates at a time, to bound memory
+        for start in range(0, self.boot_reps, self.block_size):
+            stop = min(start + self.block_size, self.boot_reps)
+            rep_keys = replicate_keys(np.arange(start, stop), self.seed)
+            weights = draw(row_keys, occurrences, rep_keys)
+            self.sum_weights[i, start:stop] += weights.sum(axis=0)
+            for m, metric_values in enumerate(values):
+                self.sum_weighted[m, i, start:stop] += metric_values @ weights
+
+    def add_frame(self, df, row_keys):
+        """Add every row of df, for each of the accumulator's variants and metrics."""
+        row_keys = np.asarray(row_keys, dtype=np.uint64)
+        for variant in self.variants:
+            rows = (df['ABVariant'] == variant).values
+            self.add(variant, df.loc[rows, self.metrics].values,
+                     df.loc[rows, 'Occurrences'].values, row_keys[rows])
+        return self
+
+    def merge(self, other):
+        """Add another accumulator's sums to this one."""
+        if (other.metrics, other.variants, other.boot_reps, other.seed,
+                other.weights) != (self.metrics, self.variants,
+                                   self.boot_reps, self.seed, self.weights):
+            raise ValueError("can only merge accumulators with the same "
+                             "metrics, variants, boot_reps, seed and weights")
+        self.sum_weights += other.sum_weights
+        self.sum_weighted += other.sum_weighted
+        return self
+
+    def means(self):
+        """
+        The weighted mean of each metric in each replicate, for each variant.
+
+        Returns:
+           dict: metric to a dict of variant to a numpy array of boot_reps
+           means.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.sum_weighted / self.sum_weights[None, :, :]
+        return {metric: dict(zip(self.variants, metric_means))
+                for metric, metric_means in zip(self.metrics, means)}
+
+
+def salt_keys(row_keys, salt):
+    """
+    Combine row keys with a salt, e.g. the name of the file the rows are
+    from, so the same journey on different days gets independent weights.
+    """
+    salt_key = pd.util.hash_array(np.array([str(salt)], dtype=object))
+    return mix64(np.asarray(row_keys, dtype=np.uint64) ^ salt_key)